@@ -1,24 +1,166 @@
-import base64
-import uvicorn
-from fastapi import FastAPI, File, Form, UploadFile, HTTPException
-from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+import time
+from utils.timing_handler import startup_timer
+
+_import_start = time.perf_counter()
+
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+from contextlib import asynccontextmanager
+
+with startup_timer.span("import:fastapi"):
+    import uvicorn
+    from fastapi import FastAPI, File, Form, UploadFile, HTTPException, Request
+    from fastapi.middleware.cors import CORSMiddleware
+    from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+    from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field
 from typing import Optional, List
 
-# 从 rag_service 导入已有的 Pydantic 模型和 service 实例
-from rag.rag_service import NutritionRAGService, logger, DishItem
+# 从 rag_service 导入已有的 Pydantic 模型；service 实例在第一次使用时创建
+with startup_timer.span("import:rag_service"):
+    from rag.rag_service import NutritionRAGService, DishItem
+from model.call_guard import ModelCallError, ModelOverloadedError, ModelTimeoutError, ModelUnavailableError
+from utils.config_handler import rag_config
+from utils.image_handler import ImageDecodeError, ImageTooLargeError, decode_data_url, prepare_image, read_upload
+from utils.logger_handler import logger, new_request_id, reset_request_id, set_request_id
+from utils.metrics_handler import (HTTP_REQUEST_SECONDS, current_timings, render_metrics, reset_request_timings,
+                                   server_timing_header, start_request_timings)
+
+startup_timer.record("import:app", time.perf_counter() - _import_start)
+
+_service: Optional[NutritionRAGService] = None
+_service_lock = threading.Lock()
+
+
+def get_service() -> NutritionRAGService:
+    """第一次调用时创建 NutritionRAGService（模型客户端、营养表），导入 app 本身不做任何初始化"""
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                with startup_timer.span("service"):
+                    _service = NutritionRAGService()
+    return _service
+
+
+def preload_service() -> dict:
+    """
+    多进程部署（serve.py）的主进程在 fork worker 之前调用：新建 service 并加载只读数据，
+    之后 fork 出的 worker 中 get_service() 直接返回这个实例。知识库更新后再次调用即换成新的实例
+    """
+    global _service
+    with startup_timer.span("service"):
+        service = NutritionRAGService()
+    result = service.preload()
+    with _service_lock:
+        _service = service
+    return result
+
 
-app = FastAPI(title="营养分析 RAG 服务", version="1.0.0")
+async def aget_service() -> NutritionRAGService:
+    # 首次创建放到线程池中执行，避免阻塞事件循环
+    if _service is not None:
+        return _service
+    return await asyncio.get_running_loop().run_in_executor(None, get_service)
+
+
+async def run_warmup() -> dict:
+    service = await aget_service()
+    return await asyncio.get_running_loop().run_in_executor(None, service.warmup)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warmup_task = None
+    if (rag_config.get('warmup') or {}).get('on_startup', False):
+        # 后台预热，worker 启动后立即可以接收请求
+        warmup_task = asyncio.create_task(run_warmup())
+        warmup_task.add_done_callback(_log_warmup_error)
+    yield
+    if warmup_task is not None and not warmup_task.done():
+        warmup_task.cancel()
+
+
+def _log_warmup_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("启动预热失败: %s", task.exception(), exc_info=task.exception())
+
+
+app = FastAPI(title="营养分析 RAG 服务", version="1.0.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    # 允许浏览器端读取阶段耗时和请求 ID
+    expose_headers=["Server-Timing", "X-Request-ID"],
 )
 
-service = NutritionRAGService()
 
+@app.middleware("http")
+async def upload_limit_middleware(request: Request, call_next):
+    """
+    按 Content-Length 提前拒绝超大的请求体，不必等到整个请求读取、解析完
+    单图接口留出 1MB 给表单字段和 JSON 中 base64 的膨胀，精确的限制在读取图片时检查；
+    批量接口的上限为 batch.max_body_mb
+    """
+    content_length = request.headers.get("content-length")
+    has_length = bool(content_length and content_length.isdigit())
+    if request.method == "POST" and request.url.path == "/analyze_batch":
+        # 批量接口的 JSON 请求体会整体读入内存再解析，必须带 Content-Length，分块传输无法提前检查大小
+        if not has_length:
+            return JSONResponse(status_code=411, content={"detail": "批量接口需要 Content-Length 请求头"})
+        if int(content_length) > max_batch_body_bytes():
+            return JSONResponse(status_code=413, content={"detail": "请求体过大"})
+    elif request.method == "POST" and has_length:
+        if int(content_length) > max_image_bytes() * 4 // 3 + 1024 * 1024:
+            return JSONResponse(status_code=413, content={"detail": "请求体过大"})
+    return await call_next(request)
+
+
+@app.middleware("http")
+async def timing_middleware(request: Request, call_next):
+    """
+    记录 HTTP 耗时；config/rag.yml 中 metrics.server_timing 开启时在响应头中返回各阶段耗时
+    每个请求分配一个 request_id（沿用客户端传入的 X-Request-ID），本次请求的所有日志都带上它，
+    请求结束时写一条带各阶段耗时的访问日志
+    """
+    request_id = (request.headers.get("x-request-id") or new_request_id())[:64]
+    id_token = set_request_id(request_id)
+    token = start_request_timings()
+    start = time.perf_counter()
+    status = 500
+    timings = None
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Request-ID"] = request_id
+        timings = current_timings()
+        if timings and (rag_config.get('metrics') or {}).get('server_timing', False):
+            timings["total"] = time.perf_counter() - start
+            response.headers["Server-Timing"] = server_timing_header(timings)
+        return response
+    finally:
+        elapsed = time.perf_counter() - start
+        # 按路由模板统计，避免路径参数造成标签爆炸
+        route = request.scope.get("route")
+        path = getattr(route, "path", "unmatched")
+        HTTP_REQUEST_SECONDS.observe(elapsed, path=path, method=request.method, status=status)
+        logger.log(
+            logging.WARNING if status >= 500 else logging.INFO,
+            "%s %s %d %.1fms", request.method, path, status, elapsed * 1000,
+            extra={
+                "status": status,
+                "duration_ms": round(elapsed * 1000, 1),
+                "stage_timings": {name: round(seconds * 1000, 1) for name, seconds in (timings or {}).items()},
+            },
+        )
+        reset_request_timings(token)
+        reset_request_id(id_token)
 
 # ---------- 请求/响应模型 ----------
 
@@ -32,34 +174,162 @@ class AnalyzeResponse(BaseModel):
     items: List[DishItem]
     total_calories: int
     advice: str
+    # 热量计算路径：llm 为 kcal 模型计算，local 为命中营养表后本地计算
+    calc_path: str = "llm"
+
+
+# 单次批量请求允许指定的最大并发数
+BATCH_MAX_CONCURRENCY = 64
+
+
+class AnalyzeBatchRequest(BaseModel):
+    items: List[AnalyzeRequest]
+    # 不传时使用 config/rag.yml 中 batch.max_concurrency
+    max_concurrency: Optional[int] = Field(default=None, gt=0, le=BATCH_MAX_CONCURRENCY)
+
+
+# 单条结果：成功时 result 有值，失败时 error 有值，互不影响
+class BatchItemResult(BaseModel):
+    index: int
+    result: Optional[AnalyzeResponse] = None
+    error: Optional[str] = None
+
+
+class AnalyzeBatchResponse(BaseModel):
+    results: List[BatchItemResult]
 
 
 # ---------- 工具函数 ----------
 
-def image_file_to_data_url(file: UploadFile) -> str:
-    contents = file.file.read()
-    base64_str = base64.b64encode(contents).decode("utf-8")
-    mime_type = file.content_type or "image/jpeg"
-    return f"data:{mime_type};base64,{base64_str}"
+def image_config() -> dict:
+    return rag_config.get('image') or {}
+
+
+def batch_config() -> dict:
+    return rag_config.get('batch') or {}
+
+
+def max_image_bytes() -> int:
+    return int(image_config().get('max_upload_mb', 10) * 1024 * 1024)
+
+
+def max_batch_body_bytes() -> int:
+    return int(batch_config().get('max_body_mb', 32) * 1024 * 1024)
+
+
+async def image_file_to_data_url(file: UploadFile) -> tuple[str, str]:
+    """
+    分块读取上传的图片（超过大小限制立即返回 413），按配置缩放后编码为 data URL
+    返回 (data URL, 原图内容哈希)；哈希用于结果缓存和识别结果去重，同一张图片不重复识别
+    """
+    try:
+        contents, image_hash = await read_upload(file, max_image_bytes())
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    if not contents:
+        raise HTTPException(status_code=400, detail="上传的图片为空")
+    # 缩放和 base64 编码是 CPU 密集操作，放到线程池中执行
+    data_url = await run_in_threadpool(prepare_image, contents, file.content_type or "image/jpeg", image_config())
+    return data_url, image_hash
+
+
+async def prepare_image_url(image_url: Optional[str]) -> tuple[Optional[str], Optional[str]]:
+    """JSON 请求中的 data URL 同样做大小限制和缩放；普通图片地址原样传给模型"""
+    if not image_url or not image_url.startswith("data:"):
+        return image_url, None
+    try:
+        contents, mime = decode_data_url(image_url, max_image_bytes())
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ImageDecodeError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    image_hash = hashlib.sha256(contents).hexdigest()
+    return await run_in_threadpool(prepare_image, contents, mime, image_config()), image_hash
+
+
+async def prepare_batch_image(image_url: Optional[str]) -> tuple[Optional[str], Optional[str], Optional[str]]:
+    """批量接口中单张图片过大、无法解码时只作为该条的错误，返回 (图片, 哈希, 错误信息)"""
+    try:
+        image_data, image_hash = await prepare_image_url(image_url)
+    except HTTPException as e:
+        return None, None, e.detail
+    return image_data, image_hash, None
+
+
+# 模型调用保护的错误：排队已满 429、超时 504、熔断 503，其余仍为 500
+MODEL_ERROR_RESPONSES = {
+    ModelOverloadedError: (429, "服务繁忙，请稍后重试"),
+    ModelTimeoutError: (504, "模型响应超时，请稍后重试"),
+    ModelUnavailableError: (503, "模型服务暂不可用，请稍后重试"),
+}
+
+
+def model_error_response(error: ModelCallError) -> tuple[int, str]:
+    return MODEL_ERROR_RESPONSES.get(type(error), (503, "模型服务暂不可用，请稍后重试"))
+
+
+def model_error_to_http(error: ModelCallError) -> HTTPException:
+    logger.warning("模型调用失败: %s", error)
+    status_code, detail = model_error_response(error)
+    headers = None
+    if status_code == 429:
+        headers = {"Retry-After": "1"}
+    elif status_code == 503:
+        breaker_config = (rag_config.get('model_guard') or {}).get('circuit_breaker') or {}
+        headers = {"Retry-After": str(breaker_config.get('open_seconds', 30))}
+    return HTTPException(status_code=status_code, detail=detail, headers=headers)
+
+
+def sse_response(user_input: Optional[str], image_data: Optional[str],
+                 image_hash: Optional[str] = None) -> StreamingResponse:
+    """把 service.analyze_stream 的阶段结果包装成 Server-Sent Events"""
+    async def event_stream():
+        try:
+            service = await aget_service()
+            async for event, data in service.analyze_stream(
+                    user_input=user_input, image_data=image_data, image_hash=image_hash):
+                yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        except ModelCallError as e:
+            # 响应头已经发出，状态码放在 error 事件中
+            logger.warning("流式分析模型调用失败: %s", e)
+            status_code, detail = model_error_response(e)
+            error = json.dumps({"error": detail, "status": status_code}, ensure_ascii=False)
+            yield f"event: error\ndata: {error}\n\n"
+        except Exception as e:
+            logger.error("流式分析异常: %s", e, exc_info=True)
+            error = json.dumps({"error": "服务内部错误，请稍后重试"}, ensure_ascii=False)
+            yield f"event: error\ndata: {error}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 # ---------- 路由端点 ----------
 
 @app.post("/analyze", response_model=AnalyzeResponse)
 async def analyze_json(request: AnalyzeRequest):
-    logger.info(f"接收到请求: text={request.text}")
+    logger.info("接收到请求: text=%s", request.text)
     try:
-        # 调用核心分析逻辑
-        result = service.analyze(user_input=request.text, image_data=request.image_url)
+        image_data, image_hash = await prepare_image_url(request.image_url)
+        # 调用核心分析逻辑（异步，不阻塞事件循环）
+        service = await aget_service()
+        result = await service.analyze_async(user_input=request.text, image_data=image_data, image_hash=image_hash)
 
         # 检查业务逻辑错误（如识别失败）
         if isinstance(result, dict) and "error" in result:
-            logger.warning(f"分析失败: {result['error']}")
+            logger.warning("分析失败: %s", result["error"])
             raise HTTPException(status_code=400, detail=result["error"])
 
         return result
+    except HTTPException:
+        raise
+    except ModelCallError as e:
+        raise model_error_to_http(e)
     except Exception as e:
-        logger.error(f"分析异常: {str(e)}")
+        logger.error("分析异常: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail="服务内部错误，请稍后重试")
 
 
@@ -69,16 +339,109 @@ async def analyze_with_image(
         image: UploadFile = File(None)
 ):
     try:
-        image_data = image_file_to_data_url(image) if image else None
-        result = service.analyze(user_input=text, image_data=image_data)
+        image_data, image_hash = await image_file_to_data_url(image) if image else (None, None)
+        service = await aget_service()
+        result = await service.analyze_async(user_input=text, image_data=image_data, image_hash=image_hash)
 
         if isinstance(result, dict) and "error" in result:
             raise HTTPException(status_code=400, detail=result["error"])
         return result
+    except HTTPException:
+        raise
+    except ModelCallError as e:
+        raise model_error_to_http(e)
     except Exception as e:
-        logger.error(f"图片上传分析异常: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.error("图片上传分析异常: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail="服务内部错误，请稍后重试")
+
+
+@app.post("/analyze_stream")
+async def analyze_stream(request: AnalyzeRequest):
+    logger.info("接收到流式请求: text=%s", request.text)
+    image_data, image_hash = await prepare_image_url(request.image_url)
+    return sse_response(request.text, image_data, image_hash)
+
+
+@app.post("/analyze_with_image_stream")
+async def analyze_with_image_stream(
+        text: Optional[str] = Form(None),
+        image: UploadFile = File(None)
+):
+    image_data, image_hash = await image_file_to_data_url(image) if image else (None, None)
+    return sse_response(text, image_data, image_hash)
+
+
+@app.post("/analyze_batch", response_model=AnalyzeBatchResponse)
+async def analyze_batch(request: AnalyzeBatchRequest):
+    max_items = batch_config().get('max_items', 200)
+    if len(request.items) > max_items:
+        raise HTTPException(status_code=400, detail=f"单次批量请求最多 {max_items} 条")
+    logger.info("接收到批量请求: %d 条", len(request.items))
+    prepared = await asyncio.gather(*(prepare_batch_image(item.image_url) for item in request.items))
+    outcomes: list[Optional[dict]] = [
+        {"error": error} if error is not None else None for _, _, error in prepared
+    ]
+    valid = [index for index, outcome in enumerate(outcomes) if outcome is None]
+    try:
+        service = await aget_service()
+        results = await service.analyze_batch_async(
+            [
+                {"text": request.items[index].text, "image_url": prepared[index][0], "image_hash": prepared[index][1]}
+                for index in valid
+            ],
+            max_concurrency=request.max_concurrency,
+        ) if valid else []
+    except Exception as e:
+        logger.error("批量分析异常: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail="服务内部错误，请稍后重试")
+    for index, outcome in zip(valid, results):
+        outcomes[index] = outcome
+
+    return {
+        "results": [
+            {"index": index, **outcome}
+            for index, outcome in enumerate(outcomes)
+        ]
+    }
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """结果缓存与向量化缓存的命中率统计"""
+    return (await aget_service()).cache_stats()
+
+
+@app.get("/models/health")
+async def models_health():
+    """各模型的熔断状态、在途/排队调用数与各阶段近期 p95 耗时"""
+    return (await aget_service()).guard_stats()
+
+
+@app.post("/warmup")
+async def warmup():
+    """打开向量库、创建模型客户端并预先检索常见菜品，可用作就绪探针"""
+    try:
+        result = await run_warmup()
+    except Exception as e:
+        logger.error("预热异常: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail="预热失败，请查看日志")
+    return {"warmup": result, "startup": startup_timer.report()}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """
+    Prometheus 文本格式的阶段耗时、缓存命中、错误类型与 token 用量
+    多进程部署时为所有 worker 的汇总，需要读写快照文件，放到线程池中执行
+    """
+    content = await run_in_threadpool(render_metrics)
+    return PlainTextResponse(content, media_type="text/plain; version=0.0.4; charset=utf-8")
+
 
+@app.get("/startup")
+async def startup():
+    """导入与各组件初始化耗时"""
+    return startup_timer.report()
 
 
 if __name__ == "__main__":
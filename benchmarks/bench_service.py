@@ -0,0 +1,284 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_models import FakeChatModel, FakeEmbeddings
+from model.factory import override_models
+from utils.config_handler import chroma_config, rag_config
+
+
+"""
+服务整体的离线基准测试：用本地假模型替换 ChatTongyi / DashScopeEmbeddings（延迟可配置），
+在进程内通过 ASGI 直接调用 /analyze、/analyze_with_image，并直接调用 retrieve_context，
+按不同并发数统计 p50/p95/p99 延迟、每秒请求数和内存占用；不需要网络，也不会改动项目内的向量库和缓存
+
+用法:
+    python benchmarks/bench_service.py --concurrency 1,8,32 --requests 200 --chat-latency 0.3
+    python benchmarks/bench_service.py --json result.json
+    python benchmarks/bench_service.py --baseline result.json --tolerance 0.2   # 退化超过 20% 时返回码为 1
+"""
+SCENARIOS = ("analyze", "analyze_with_image", "retrieve_context")
+COOKING = ["红烧", "清蒸", "干煸", "酸辣", "黑椒", "糖醋", "香煎", "蒜蓉", "麻辣", "椒盐", "白灼", "葱爆"]
+INGREDIENTS = ["牛肉", "鸡翅", "排骨", "豆腐", "茄子", "土豆丝", "鲈鱼", "虾仁", "西兰花", "五花肉",
+               "鸡胸肉", "藕片", "豆角", "冬瓜", "肥肠", "羊肉", "带鱼", "菜心"]
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def rss_mb() -> float:
+    """当前常驻内存（MB），读取 /proc/self/status"""
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def peak_rss_mb() -> float:
+    # Linux 下 ru_maxrss 单位为 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def build_dataset(workdir: str, dishes: int, seed: int) -> tuple[list[str], list[str]]:
+    """生成营养表数据，返回 (营养表中有的菜品, 营养表中没有、需要向量检索的菜品)"""
+    rng = random.Random(seed)
+    names = [cooking + ingredient for cooking in COOKING for ingredient in INGREDIENTS]
+    rng.shuffle(names)
+    known, unknown = names[:dishes], names[dishes:] or ["家常小炒", "杂粮饭"]
+    records = [
+        {
+            "name": name,
+            "calories": rng.randint(40, 400),
+            "unit": "100g",
+            "protein": f"{rng.randint(1, 30)}g",
+            "description": f"{name}，家常做法，口味适中。",
+        }
+        for name in known
+    ]
+    data_dir = os.path.join(workdir, "data")
+    os.makedirs(data_dir, exist_ok=True)
+    with open(os.path.join(data_dir, "dishes.json"), "w", encoding="utf-8") as f:
+        json.dump(records, f, ensure_ascii=False)
+    return known, unknown
+
+
+def configure(workdir: str, args):
+    """所有持久化路径指向临时目录，关闭启动预热，按参数开关结果缓存"""
+    chroma_config['backend'] = args.backend
+    chroma_config['data_path'] = os.path.join(workdir, "data")
+    chroma_config['persist_directory'] = os.path.join(workdir, "chroma_db")
+    chroma_config['manifest_store'] = os.path.join(workdir, "manifest.json")
+    chroma_config['generation_file'] = os.path.join(workdir, "index_generation.json")
+    chroma_config['numpy_store'] = {
+        **(chroma_config.get('numpy_store') or {}),
+        "persist_directory": os.path.join(workdir, "numpy_db"),
+    }
+    rag_config['embedding_cache'] = {**(rag_config.get('embedding_cache') or {}), "disk_path": None}
+    rag_config['result_cache'] = {
+        **(rag_config.get('result_cache') or {}), "enabled": args.result_cache, "disk_enabled": False,
+    }
+    rag_config['warmup'] = {**(rag_config.get('warmup') or {}), "on_startup": False}
+
+
+class Workload(object):
+    """生成每个请求的输入：known_ratio 控制菜品命中营养表（本地计算路径）的比例"""
+
+    def __init__(self, known: list[str], unknown: list[str], known_ratio: float, image_kb: int, seed: int):
+        self.known = known
+        self.unknown = unknown
+        self.known_ratio = known_ratio
+        self.image_kb = image_kb
+        self.rng = random.Random(seed)
+        self.counter = 0
+
+    def _dishes(self) -> list[str]:
+        count = self.rng.randint(1, 3)
+        if self.rng.random() < self.known_ratio:
+            return self.rng.sample(self.known, min(count, len(self.known)))
+        return self.rng.sample(self.unknown, min(count, len(self.unknown)))
+
+    def text(self) -> str:
+        # 序号保证每个请求的输入都不同，除非开启结果缓存并希望测量命中情况
+        self.counter += 1
+        return "我吃了" + "、".join(f"一份{name}" for name in self._dishes()) + f"（{self.counter}）"
+
+    def image(self) -> bytes:
+        return os.urandom(self.image_kb * 1024)
+
+    def items(self) -> list[dict]:
+        return [{"name": name, "weight_g": 150, "is_estimated": True} for name in self._dishes()]
+
+
+async def run_level(call, requests: int, concurrency: int) -> dict:
+    latencies: list[float] = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            start = time.perf_counter()
+            try:
+                ok = await call()
+            except Exception:
+                ok = False
+            latencies.append((time.perf_counter() - start) * 1000)
+            if not ok:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+    return {
+        "p50_ms": round(statistics.median(latencies), 1),
+        "p95_ms": round(percentile(latencies, 0.95), 1),
+        "p99_ms": round(percentile(latencies, 0.99), 1),
+        "rps": round(len(latencies) / seconds, 1),
+        "errors": errors,
+        "rss_mb": round(rss_mb(), 1),
+        "peak_mb": round(peak_rss_mb(), 1),
+    }
+
+
+async def run(args, workdir: str) -> list[dict]:
+    known, unknown = build_dataset(workdir, args.dishes, args.seed)
+    configure(workdir, args)
+    all_names = known + unknown
+    override_models(
+        version=FakeChatModel(latency=args.vision_latency, jitter=args.jitter,
+                              dish_names=all_names, default_dishes=unknown[:2]),
+        kcal=FakeChatModel(latency=args.chat_latency, jitter=args.jitter, dish_names=all_names),
+        embeddings=FakeEmbeddings(size=args.dim, latency=args.embed_latency),
+    )
+
+    import httpx
+    import app as app_module
+
+    if not args.verbose:
+        logging.getLogger("agent").setLevel(logging.WARNING)
+
+    start = time.perf_counter()
+    service = app_module.get_service()
+    service.vector_store.load_document()
+    service.warmup()
+    print(f"setup: {time.perf_counter() - start:.2f}s, dishes={len(known)} (+{len(unknown)} unknown), "
+          f"backend={args.backend}, rss={rss_mb():.1f}MB")
+
+    workload = Workload(known, unknown, args.known_ratio, args.image_kb, args.seed)
+    transport = httpx.ASGITransport(app=app_module.app)
+    results = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        async def call_analyze():
+            response = await client.post("/analyze", json={"text": workload.text()})
+            return response.status_code == 200
+
+        async def call_analyze_with_image():
+            response = await client.post(
+                "/analyze_with_image",
+                files={"image": ("meal.jpg", workload.image(), "image/jpeg")},
+            )
+            return response.status_code == 200
+
+        async def call_retrieve_context():
+            await service.aretrieve_context(workload.items())
+            return True
+
+        calls = {
+            "analyze": call_analyze,
+            "analyze_with_image": call_analyze_with_image,
+            "retrieve_context": call_retrieve_context,
+        }
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                row = {"scenario": scenario, "concurrency": concurrency}
+                row.update(await run_level(calls[scenario], args.requests, concurrency))
+                results.append(row)
+                print(f"  {scenario} c={concurrency}: p95={row['p95_ms']}ms rps={row['rps']}", flush=True)
+    return results
+
+
+def compare(results: list[dict], baseline_path: str, tolerance: float) -> list[str]:
+    """与基线结果对比 p95 和 rps，返回超出容忍度的退化项"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {(row["scenario"], row["concurrency"]): row for row in json.load(f)["results"]}
+    regressions = []
+    for row in results:
+        base = baseline.get((row["scenario"], row["concurrency"]))
+        if base is None:
+            continue
+        if base["p95_ms"] and row["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{row['scenario']} c={row['concurrency']}: p95 {base['p95_ms']} -> {row['p95_ms']}ms")
+        if base["rps"] and row["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"{row['scenario']} c={row['concurrency']}: rps {base['rps']} -> {row['rps']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="使用本地假模型的服务吞吐量与延迟基准测试")
+    parser.add_argument("--scenarios", type=lambda value: value.split(","), default=list(SCENARIOS),
+                        help=f"逗号分隔，可选 {','.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", type=lambda value: [int(part) for part in value.split(",")],
+                        default=[1, 8, 32], help="逗号分隔的并发数")
+    parser.add_argument("--requests", type=int, default=200, help="每个并发等级的请求数")
+    parser.add_argument("--chat-latency", type=float, default=0.3, help="文本模型单次调用延迟（秒）")
+    parser.add_argument("--vision-latency", type=float, default=0.6, help="视觉模型单次调用延迟（秒）")
+    parser.add_argument("--embed-latency", type=float, default=0.02, help="向量化模型单次调用延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="模型调用额外的随机延迟上限（秒）")
+    parser.add_argument("--dim", type=int, default=256, help="假向量的维度")
+    parser.add_argument("--dishes", type=int, default=120, help="营养表中的菜品数")
+    parser.add_argument("--known-ratio", type=float, default=0.5, help="请求中菜品命中营养表的比例")
+    parser.add_argument("--image-kb", type=int, default=64, help="上传图片大小（KB）")
+    parser.add_argument("--backend", choices=["chroma", "numpy"], default=chroma_config.get('backend', 'chroma'))
+    parser.add_argument("--result-cache", action="store_true", help="开启结果缓存（默认关闭，避免测到缓存命中）")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="把结果写入 JSON 文件，可作为之后的 --baseline")
+    parser.add_argument("--baseline", help="与之前的 --json 结果对比")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的退化比例")
+    parser.add_argument("--verbose", action="store_true", help="保留服务的 INFO 日志")
+    args = parser.parse_args()
+    unknown_scenarios = set(args.scenarios) - set(SCENARIOS)
+    if unknown_scenarios:
+        parser.error(f"未知的场景: {','.join(sorted(unknown_scenarios))}")
+
+    workdir = tempfile.mkdtemp(prefix="bench_service_")
+    try:
+        results = asyncio.run(run(args, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    columns = list(results[0])
+    print(" | ".join(f"{column:>18}" for column in columns))
+    for row in results:
+        print(" | ".join(f"{str(row[column]):>18}" for column in columns))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": {key: value for key, value in vars(args).items() if key not in ("json", "baseline")},
+                       "results": results}, f, ensure_ascii=False, indent=1)
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rag.numpy_store import NumpyVectorStore
+
+
+"""
+向量库后端对比：Chroma vs NumpyVectorStore(float32 / int8)
+使用随机生成的向量，不需要网络和真实的向量化模型，统计：
+建库耗时、重新打开耗时、单条查询 p50/p95、批量查询耗时、recall@k（以精确暴力检索为基准）
+
+用法: python benchmarks/bench_vector_backend.py --records 20000 --dim 1024 --queries 200 --k 2
+"""
+class PrecomputedEmbeddings(Embeddings):
+    """文本 -> 预先生成的向量，查询时按 query 文本查表"""
+
+    def __init__(self, vectors: dict[str, list[float]]):
+        self.vectors = vectors
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.vectors[text] for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.vectors[text]
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def build_dataset(records: int, dim: int, queries: int, seed: int = 42):
+    rng = np.random.default_rng(seed)
+    # 以若干簇中心生成数据，模拟同类菜品向量聚集的情况
+    centers = rng.normal(size=(max(1, records // 50), dim)).astype(np.float32)
+    data = centers[rng.integers(0, len(centers), records)] + 0.5 * rng.normal(size=(records, dim)).astype(np.float32)
+    data /= np.linalg.norm(data, axis=1, keepdims=True)
+    picked = rng.integers(0, records, queries)
+    query_vectors = data[picked] + 0.2 * rng.normal(size=(queries, dim)).astype(np.float32)
+    query_vectors /= np.linalg.norm(query_vectors, axis=1, keepdims=True)
+    return data, query_vectors
+
+
+def exact_top_k(data: np.ndarray, queries: np.ndarray, k: int) -> list[set[str]]:
+    scores = queries @ data.T
+    top = np.argsort(-scores, axis=1)[:, :k]
+    return [{f"doc-{index}" for index in row} for row in top]
+
+
+def recall(results: list[list[str]], truth: list[set[str]]) -> float:
+    hit = sum(len(set(found) & expected) for found, expected in zip(results, truth))
+    return hit / sum(len(expected) for expected in truth)
+
+
+def bench_store(name: str, open_store, add_batch: int, texts: list[str], query_texts: list[str],
+                query_vectors: np.ndarray, truth: list[set[str]], k: int) -> dict:
+    store = open_store()
+    start = time.perf_counter()
+    for offset in range(0, len(texts), add_batch):
+        part = texts[offset:offset + add_batch]
+        store.add_texts(part, ids=part)
+    build_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    store = open_store()
+    open_seconds = time.perf_counter() - start
+
+    latencies = []
+    found = []
+    for text in query_texts:
+        start = time.perf_counter()
+        docs = store.similarity_search(text, k=k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        found.append([doc.page_content for doc in docs])
+
+    start = time.perf_counter()
+    if isinstance(store, NumpyVectorStore):
+        store.similarity_search_by_vectors(query_vectors.tolist(), k=k)
+    else:
+        for vector in query_vectors.tolist():
+            store.similarity_search_by_vector(vector, k=k)
+    batch_ms = (time.perf_counter() - start) * 1000
+
+    return {
+        "backend": name,
+        "build_s": round(build_seconds, 2),
+        "open_ms": round(open_seconds * 1000, 1),
+        "p50_ms": round(statistics.median(latencies), 3),
+        "p95_ms": round(percentile(latencies, 0.95), 3),
+        "batch_ms": round(batch_ms, 1),
+        f"recall@{k}": round(recall(found, truth), 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chroma 与 NumpyVectorStore 的召回率和延迟对比")
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=2)
+    parser.add_argument("--skip-chroma", action="store_true", help="未安装 chromadb 时只测试 numpy 后端")
+    args = parser.parse_args()
+
+    data, query_vectors = build_dataset(args.records, args.dim, args.queries)
+    texts = [f"doc-{index}" for index in range(args.records)]
+    query_texts = [f"query-{index}" for index in range(args.queries)]
+    vectors = {text: vector for text, vector in zip(texts, data.tolist())}
+    vectors.update({text: vector for text, vector in zip(query_texts, query_vectors.tolist())})
+    embeddings = PrecomputedEmbeddings(vectors)
+    truth = exact_top_k(data, query_vectors, args.k)
+
+    workdir = tempfile.mkdtemp(prefix="bench_vector_")
+    results = []
+    try:
+        for quantize in (False, True):
+            path = os.path.join(workdir, f"numpy_{'int8' if quantize else 'f32'}")
+            results.append(bench_store(
+                f"numpy-{'int8' if quantize else 'float32'}",
+                lambda path=path, quantize=quantize: NumpyVectorStore(path, embeddings, quantize=quantize),
+                5000, texts, query_texts, query_vectors, truth, args.k,
+            ))
+        if not args.skip_chroma:
+            from langchain_chroma import Chroma
+
+            path = os.path.join(workdir, "chroma")
+            results.append(bench_store(
+                "chroma",
+                lambda: Chroma(
+                    collection_name="bench",
+                    embedding_function=embeddings,
+                    persist_directory=path,
+                    collection_metadata={"hnsw:space": "cosine"},
+                ),
+                5000, texts, query_texts, query_vectors, truth, args.k,
+            ))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"records={args.records} dim={args.dim} queries={args.queries} k={args.k}")
+    columns = list(results[0])
+    print(" | ".join(f"{column:>14}" for column in columns))
+    for row in results:
+        print(" | ".join(f"{str(row[column]):>14}" for column in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+import asyncio
+import hashlib
+import json
+import random
+import time
+from typing import Any, AsyncIterator, Iterator, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+"""
+离线基准测试用的本地模型：延迟可配置，输出为固定格式的 JSON，不访问网络
+通过 model.factory.override_models 替换 ChatTongyi / DashScopeEmbeddings
+"""
+def _message_text(messages: list[BaseMessage]) -> str:
+    parts = []
+    for message in messages:
+        if isinstance(message.content, str):
+            parts.append(message.content)
+            continue
+        for part in message.content:
+            if isinstance(part, dict) and part.get("type") == "text":
+                parts.append(part["text"])
+    return "\n".join(parts)
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    按 prompt 中的输出格式返回固定结构的 JSON：
+    - kcal 计算（格式说明中含 total_calories）: AnalysisResult
+    - 菜品识别（文本 / 图片）: DishList，菜品从输入文本中按 dish_names 匹配，匹配不到时使用 default_dishes
+    - 其余（本地计算路径的建议）: 一段固定的建议文本
+    latency 为单次调用的基础延迟（秒），jitter 为额外的均匀随机延迟上限
+    """
+    latency: float = 0.3
+    jitter: float = 0.0
+    stream_chunk_chars: int = 8
+    dish_names: list[str] = []
+    default_dishes: list[str] = ["宫保鸡丁", "米饭"]
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _delay(self) -> float:
+        return self.latency + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+
+    def _find_dishes(self, text: str) -> list[str]:
+        found = [name for name in self.dish_names if name in text]
+        return found or list(self.default_dishes)
+
+    def _reply(self, messages: list[BaseMessage]) -> str:
+        text = _message_text(messages)
+        if '"total_calories"' in text:
+            items = [
+                {"name": name, "weight_g": 150, "is_estimated": True}
+                for name in self._find_dishes(text)
+            ]
+            return json.dumps({
+                "items": items,
+                "total_calories": 200 * len(items),
+                "advice": "本餐热量适中，注意搭配蔬菜，减少油脂摄入。",
+            }, ensure_ascii=False)
+        if '"items"' in text:
+            return json.dumps({"items": [
+                {"name": name, "weight_g": 150, "is_estimated": True}
+                for name in self._find_dishes(text)
+            ]}, ensure_ascii=False)
+        return "本餐热量适中，注意搭配蔬菜，减少油脂摄入。"
+
+    def _result(self, messages: list[BaseMessage]) -> ChatResult:
+        self.calls += 1
+        content = self._reply(messages)
+        usage = {
+            "input_tokens": len(_message_text(messages)) // 2,
+            "output_tokens": len(content) // 2,
+            "total_tokens": len(_message_text(messages)) // 2 + len(content) // 2,
+        }
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content, usage_metadata=usage))])
+
+    def _generate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                  run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        time.sleep(self._delay())
+        return self._result(messages)
+
+    async def _agenerate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                         run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(self._delay())
+        return self._result(messages)
+
+    def _chunks(self, content: str) -> list[str]:
+        size = max(1, self.stream_chunk_chars)
+        return [content[start:start + size] for start in range(0, len(content), size)] or [""]
+
+    def _stream(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                run_manager: Any = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        result = self._result(messages)
+        chunks = self._chunks(result.generations[0].message.content)
+        for chunk in chunks:
+            time.sleep(self._delay() / len(chunks))
+            yield ChatGenerationChunk(message=AIMessageChunk(content=chunk))
+        yield ChatGenerationChunk(message=AIMessageChunk(
+            content="", usage_metadata=result.generations[0].message.usage_metadata))
+
+    async def _astream(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                       run_manager: Any = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        # 延迟平均分摊到每个分片上，模拟逐 token 输出
+        result = self._result(messages)
+        chunks = self._chunks(result.generations[0].message.content)
+        for chunk in chunks:
+            await asyncio.sleep(self._delay() / len(chunks))
+            yield ChatGenerationChunk(message=AIMessageChunk(content=chunk))
+        yield ChatGenerationChunk(message=AIMessageChunk(
+            content="", usage_metadata=result.generations[0].message.usage_metadata))
+
+
+class FakeEmbeddings(Embeddings):
+    """按文本哈希生成确定性的单位向量，每次调用（无论批量大小）耗时 latency 秒"""
+
+    def __init__(self, size: int = 256, latency: float = 0.02):
+        self.size = size
+        self.latency = latency
+        self.calls = 0
+        self.texts = 0
+
+    def _vector(self, text: str) -> list[float]:
+        seed = int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).normal(size=self.size).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def _embed(self, texts: list[str]) -> list[list[float]]:
+        self.calls += 1
+        self.texts += len(texts)
+        return [self._vector(text) for text in texts]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        time.sleep(self.latency)
+        return self._embed(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        await asyncio.sleep(self.latency)
+        return self._embed(texts)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return (await self.aembed_documents([text]))[0]
+
+    # 与 DashScopeQueryEmbeddings 一样支持批量向量化检索查询
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        return self.embed_documents(texts)
+
+    async def aembed_queries(self, texts: list[str]) -> list[list[float]]:
+        return await self.aembed_documents(texts)
@@ -0,0 +1,394 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+
+from langchain_core.exceptions import OutputParserException
+
+from utils.logger_handler import logger
+from utils.metrics_handler import MODEL_GUARD_EVENTS
+
+
+"""
+模型调用保护：每个模型一个 ModelGuard，负责
+- 准入：并发上限之外只允许 max_queue 个请求排队，排满直接拒绝（ModelOverloadedError，对应 429）
+- 超时：每个阶段单独的截止时间，包含排队时间（ModelTimeoutError，对应 504）
+- 重试：只对 JsonOutputParser 解析失败重试，带随机抖动的指数退避；上游报错、超时不重试
+- 对冲：调用耗时超过该阶段近期 p95 后再发一个相同请求，取先返回的结果
+- 熔断：连续失败达到阈值后一段时间内直接拒绝（ModelUnavailableError），由调用方走本地估算
+"""
+_STREAM_END = object()
+
+
+class ModelCallError(Exception):
+    def __init__(self, model: str, stage: str, message: str):
+        super().__init__(f"{model}/{stage}: {message}")
+        self.model = model
+        self.stage = stage
+
+
+class ModelOverloadedError(ModelCallError):
+    pass
+
+
+class ModelTimeoutError(ModelCallError):
+    pass
+
+
+class ModelUnavailableError(ModelCallError):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    连续失败 failure_threshold 次后打开 open_seconds 秒；到期后放行一个探测请求，
+    成功则关闭，失败则重新打开。解析失败说明上游可用，按成功处理；
+    探测请求被取消、排队被拒等没有结论时由调用方 release_probe()，下一个请求重新探测
+    """
+
+    def __init__(self, failure_threshold: int = 5, open_seconds: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = 0.0
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._failures < self.failure_threshold:
+                return "closed"
+            return "open" if time.monotonic() < self._open_until else "half_open"
+
+    def acquire(self) -> Optional[str]:
+        """放行时返回 "closed" 或 "probe"（半开状态下的探测请求），拒绝时返回 None"""
+        with self._lock:
+            if self._failures < self.failure_threshold:
+                return "closed"
+            if time.monotonic() < self._open_until or self._probing:
+                return None
+            # 半开：本次请求作为探测，探测结果出来之前其余请求继续被拒绝
+            self._probing = True
+            return "probe"
+
+    def release_probe(self):
+        """探测请求结束时调用；已经记录了成功或失败时无影响，否则放弃本次探测"""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self) -> bool:
+        """记录一次失败，返回本次是否触发了熔断"""
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._open_until = time.monotonic() + self.open_seconds
+                self._probing = False
+                return self._failures == self.failure_threshold
+            return False
+
+
+class LatencyTracker(object):
+    """最近 window 次成功调用的耗时，用于计算对冲阈值"""
+
+    def __init__(self, window: int = 200):
+        self._samples: deque[float] = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, q: float) -> Optional[float]:
+        samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class ModelGuard(object):
+    def __init__(self, model: str, max_concurrency: int, config: Optional[dict] = None):
+        config = config or {}
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.max_queue = config.get('max_queue', 256)
+        self.deadlines: dict[str, float] = config.get('deadlines') or {}
+        self.default_deadline = config.get('default_deadline', 60)
+        self.parse_retries = config.get('parse_retries', 1)
+        self.retry_backoff = config.get('retry_backoff', 0.2)
+        hedge_config = config.get('hedge') or {}
+        self.hedge_enabled = hedge_config.get('enabled', False)
+        self.hedge_min_samples = hedge_config.get('min_samples', 50)
+        self.hedge_min_delay = hedge_config.get('min_delay', 1.0)
+        breaker_config = config.get('circuit_breaker') or {}
+        self.breaker = CircuitBreaker(
+            failure_threshold=breaker_config.get('failure_threshold', 5),
+            open_seconds=breaker_config.get('open_seconds', 30),
+        )
+        self._latency: dict[str, LatencyTracker] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._waiting = 0
+        self._in_flight = 0
+
+    def deadline(self, stage: str) -> float:
+        return self.deadlines.get(stage, self.default_deadline)
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def _event(self, event: str):
+        MODEL_GUARD_EVENTS.inc(model=self.model, event=event)
+
+    def _tracker(self, stage: str) -> LatencyTracker:
+        tracker = self._latency.get(stage)
+        if tracker is None:
+            tracker = self._latency[stage] = LatencyTracker()
+        return tracker
+
+    def hedge_delay(self, stage: str) -> Optional[float]:
+        """近期样本足够时返回 max(p95, min_delay)，否则不对冲"""
+        if not self.hedge_enabled:
+            return None
+        tracker = self._tracker(stage)
+        if len(tracker) < self.hedge_min_samples:
+            return None
+        return max(tracker.percentile(0.95), self.hedge_min_delay)
+
+    def _admit(self, stage: str) -> bool:
+        """熔断检查，返回本次调用是否为半开状态下的探测请求（调用结束时必须 release_probe）"""
+        permit = self.breaker.acquire()
+        if permit is None:
+            self._event("short_circuit")
+            raise ModelUnavailableError(self.model, stage, "熔断中，上游暂不可用")
+        return permit == "probe"
+
+    def _record_failure(self, stage: str, error: BaseException):
+        if self.breaker.record_failure():
+            self._event("circuit_open")
+            logger.warning("[模型保护]%s 连续失败，熔断 %ss（最近一次：%s/%s）",
+                           self.model, self.breaker.open_seconds, stage, type(error).__name__)
+
+    async def _acquire(self, stage: str):
+        """占用一个并发名额；所有名额都在使用且排队已满时直接拒绝"""
+        if self.semaphore.locked() and self._waiting >= self.max_queue:
+            self._event("rejected")
+            raise ModelOverloadedError(self.model, stage, "排队请求过多")
+        self._waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self._waiting -= 1
+        self._in_flight += 1
+
+    def _release(self):
+        self._in_flight -= 1
+        self.semaphore.release()
+
+    @asynccontextmanager
+    async def _slot(self, stage: str):
+        await self._acquire(stage)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _timed(self, stage: str, factory: Callable[[], Awaitable[Any]]):
+        async with self._slot(stage):
+            start = time.perf_counter()
+            result = await factory()
+        self._tracker(stage).observe(time.perf_counter() - start)
+        return result
+
+    async def _hedged(self, stage: str, factory: Callable[[], Awaitable[Any]]):
+        delay = self.hedge_delay(stage)
+        if delay is None:
+            return await self._timed(stage, factory)
+        tasks = {asyncio.ensure_future(self._timed(stage, factory))}
+        try:
+            done, tasks = await asyncio.wait(tasks, timeout=delay)
+            if done:
+                return done.pop().result()
+            # 对冲请求不排队：没有空闲名额时继续等第一个请求
+            if self.semaphore.locked():
+                return await tasks.pop()
+            self._event("hedge")
+            hedge = asyncio.ensure_future(self._timed(stage, factory))
+            tasks.add(hedge)
+            while True:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    # 先完成的失败了而另一个仍在进行时，继续等另一个
+                    if task.exception() is None or not tasks:
+                        if task is hedge and task.exception() is None:
+                            self._event("hedge_won")
+                        return task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def call(self, stage: str, factory: Callable[[], Awaitable[Any]], hedge: bool = True):
+        """
+        factory 每次调用返回一个新的 awaitable（重试、对冲时会调用多次）
+        有副作用或流式消费的调用传 hedge=False
+        """
+        probe = self._admit(stage)
+        deadline = self.deadline(stage)
+        try:
+            async with asyncio.timeout(deadline):
+                for attempt in range(self.parse_retries + 1):
+                    try:
+                        result = await (self._hedged(stage, factory) if hedge else self._timed(stage, factory))
+                        break
+                    except OutputParserException:
+                        if attempt >= self.parse_retries:
+                            raise
+                        self._event("retry")
+                        await asyncio.sleep(random.uniform(0, self.retry_backoff * 2 ** attempt))
+        except TimeoutError as e:
+            self._event("timeout")
+            self._record_failure(stage, e)
+            raise ModelTimeoutError(self.model, stage, f"超过 {deadline}s 未完成") from None
+        except OutputParserException:
+            self.breaker.record_success()
+            raise
+        except (ModelOverloadedError, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            self._record_failure(stage, e)
+            raise
+        else:
+            self.breaker.record_success()
+            return result
+        finally:
+            if probe:
+                self.breaker.release_probe()
+
+    async def _pump(self, stage: str, factory: Callable[[], AsyncIterator[Any]], expires_at: float,
+                    chunks: asyncio.Queue, release: Callable[[], None]):
+        """
+        在单独的任务中读取上游流放入队列，上游输出结束（或出错）时立即释放并发名额，
+        下游（如 SSE 客户端）消费得慢不会一直占着名额
+        """
+        iterator = None
+        try:
+            iterator = factory().__aiter__()
+            async with asyncio.timeout_at(expires_at):
+                while True:
+                    try:
+                        chunk = await iterator.__anext__()
+                    except StopAsyncIteration:
+                        break
+                    chunks.put_nowait(chunk)
+        except TimeoutError as e:
+            self._event("timeout")
+            self._record_failure(stage, e)
+            raise ModelTimeoutError(self.model, stage, f"超过 {self.deadline(stage)}s 未完成") from None
+        except OutputParserException:
+            self.breaker.record_success()
+            raise
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._record_failure(stage, e)
+            raise
+        else:
+            self.breaker.record_success()
+        finally:
+            try:
+                if iterator is not None and hasattr(iterator, "aclose"):
+                    await iterator.aclose()
+            finally:
+                release()
+                chunks.put_nowait(_STREAM_END)
+
+    async def stream(self, stage: str, factory: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """
+        流式调用：准入、熔断与 call 相同，截止时间覆盖排队和上游的整个输出过程；
+        已经产出的内容无法撤回，因此不重试、不对冲
+        """
+        probe = self._admit(stage)
+        pump = None
+        try:
+            deadline = self.deadline(stage)
+            expires_at = asyncio.get_running_loop().time() + deadline
+            try:
+                async with asyncio.timeout_at(expires_at):
+                    await self._acquire(stage)
+            except TimeoutError as e:
+                self._event("timeout")
+                self._record_failure(stage, e)
+                raise ModelTimeoutError(self.model, stage, f"超过 {deadline}s 未完成") from None
+            held = [True]
+
+            def release():
+                # 任务在开始执行前被取消时不会进入 _pump 的 finally，由这里兜底，保证只释放一次
+                if held[0]:
+                    held[0] = False
+                    self._release()
+
+            chunks: asyncio.Queue = asyncio.Queue()
+            pump = asyncio.ensure_future(self._pump(stage, factory, expires_at, chunks, release))
+            while True:
+                chunk = await chunks.get()
+                if chunk is _STREAM_END:
+                    break
+                yield chunk
+            # 上游的异常在已读到的内容全部产出之后抛出
+            await pump
+        finally:
+            if pump is not None and not pump.done():
+                # 下游提前结束（客户端断开、调用方 break）时停止读取上游
+                pump.cancel()
+                await asyncio.wait([pump])
+            if pump is not None:
+                release()
+                if not pump.cancelled():
+                    pump.exception()
+            if probe:
+                self.breaker.release_probe()
+
+    def call_sync(self, stage: str, fn: Callable[[], Any]):
+        """同步路径（analyze）：只做熔断和解析失败重试，超时由模型客户端自身控制"""
+        probe = self._admit(stage)
+        try:
+            for attempt in range(self.parse_retries + 1):
+                try:
+                    result = fn()
+                    break
+                except OutputParserException:
+                    if attempt >= self.parse_retries:
+                        self.breaker.record_success()
+                        raise
+                    self._event("retry")
+                    time.sleep(random.uniform(0, self.retry_backoff * 2 ** attempt))
+                except Exception as e:
+                    self._record_failure(stage, e)
+                    raise
+            self.breaker.record_success()
+            return result
+        finally:
+            if probe:
+                self.breaker.release_probe()
+
+    def stats(self) -> dict:
+        return {
+            "state": self.breaker.state,
+            "in_flight": self._in_flight,
+            "waiting": self._waiting,
+            "p95_seconds": {
+                stage: round(tracker.percentile(0.95), 4)
+                for stage, tracker in self._latency.items() if len(tracker)
+            },
+        }
@@ -0,0 +1,21 @@
+import asyncio
+
+from langchain_community.embeddings import DashScopeEmbeddings
+from langchain_community.embeddings.dashscope import embed_with_retry
+
+
+class DashScopeQueryEmbeddings(DashScopeEmbeddings):
+    """
+    DashScopeEmbeddings 只有逐条的 embed_query；检索时一次请求向量化多个菜品名，
+    按 text_type=query 批量调用，与 embed_query 得到的向量一致（embed_documents 使用 text_type=document）
+    """
+
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        embeddings = embed_with_retry(self, input=texts, text_type="query", model=self.model)
+        return [item["embedding"] for item in embeddings]
+
+    async def aembed_queries(self, texts: list[str]) -> list[list[float]]:
+        # DashScope SDK 只有同步接口，放到线程池中执行，一批查询仍只发一次请求
+        return await asyncio.get_running_loop().run_in_executor(None, self.embed_queries, texts)
@@ -0,0 +1,172 @@
+import asyncio
+import threading
+from array import array
+from typing import Optional
+
+from langchain_core.embeddings import Embeddings
+
+from utils.cache_handler import LRUCache, SQLiteStore
+from utils.metrics_handler import CACHE_LOOKUPS
+from utils.text_handler import normalize_text
+
+
+def _pack(vector: list[float]) -> bytes:
+    return array("f", vector).tobytes()
+
+
+def _unpack(data: bytes) -> list[float]:
+    vector = array("f")
+    vector.frombytes(data)
+    return vector.tolist()
+
+
+def embed_queries(embeddings: Embeddings, texts: list[str]) -> list[list[float]]:
+    """
+    批量向量化检索查询（text_type=query）：模型客户端支持批量查询时一次调用，否则逐个 embed_query
+    注意不能用 embed_documents 代替，DashScope 对查询和文档使用不同的 text_type
+    """
+    batch = getattr(embeddings, 'embed_queries', None)
+    if callable(batch):
+        return batch(texts)
+    return [embeddings.embed_query(text) for text in texts]
+
+
+async def aembed_queries(embeddings: Embeddings, texts: list[str]) -> list[list[float]]:
+    batch = getattr(embeddings, 'aembed_queries', None)
+    if callable(batch):
+        return await batch(texts)
+    return list(await asyncio.gather(*(embeddings.aembed_query(text) for text in texts)))
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    带缓存的 Embeddings 包装器：内存 LRU -> SQLite 磁盘 -> 实际模型
+    只缓存检索查询（embed_query / embed_queries），缓存键由模型名、text_type 和归一化后的文本组成，
+    磁盘层在进程重启后仍然有效；文档向量化（知识库导入）直接调用模型，不占用缓存容量
+    """
+    TEXT_TYPE = "query"
+
+    def __init__(
+            self,
+            embeddings: Embeddings,
+            model_name: str,
+            memory_max_entries: int = 10000,
+            disk_path: Optional[str] = None,
+            disk_max_entries: int = 200000,
+    ):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.memory = LRUCache(max_entries=memory_max_entries)
+        self.disk = SQLiteStore(disk_path, max_entries=disk_max_entries) if disk_path else None
+        self._lock = threading.Lock()
+        self.model_calls = 0
+        self.model_texts = 0
+
+    def _key(self, text: str) -> str:
+        return f"{self.model_name}:{self.TEXT_TYPE}:{normalize_text(text)}"
+
+    def _lookup_memory(self, texts: list[str]) -> tuple[dict[str, list[float]], list[str]]:
+        """返回 (已命中的 key->向量, 未命中的去重 key 列表)"""
+        found = {}
+        missing = []
+        for key in dict.fromkeys(self._key(text) for text in texts):
+            vector = self.memory.get(key)
+            if vector is None:
+                missing.append(key)
+            else:
+                found[key] = vector
+        return found, missing
+
+    def _lookup_disk(self, missing: list[str], found: dict) -> list[str]:
+        """查询磁盘层并回填内存层，返回仍未命中的 key 列表"""
+        for key, data in self.disk.get_many(missing).items():
+            vector = _unpack(data)
+            self.memory.set(key, vector)
+            found[key] = vector
+        return [key for key in missing if key not in found]
+
+    @staticmethod
+    def _count_lookups(found: dict, missing: list[str]):
+        if found:
+            CACHE_LOOKUPS.inc(len(found), cache="embedding", result="hit")
+        if missing:
+            CACHE_LOOKUPS.inc(len(missing), cache="embedding", result="miss")
+
+    def _lookup(self, texts: list[str]) -> tuple[dict[str, list[float]], list[str]]:
+        found, missing = self._lookup_memory(texts)
+        if missing and self.disk is not None:
+            missing = self._lookup_disk(missing, found)
+        self._count_lookups(found, missing)
+        return found, missing
+
+    async def _alookup(self, texts: list[str]) -> tuple[dict[str, list[float]], list[str]]:
+        found, missing = self._lookup_memory(texts)
+        if missing and self.disk is not None:
+            # SQLite 读取放到线程池执行，不阻塞事件循环
+            missing = await asyncio.get_running_loop().run_in_executor(None, self._lookup_disk, missing, found)
+        self._count_lookups(found, missing)
+        return found, missing
+
+    def _store_memory(self, keys: list[str], vectors: list[list[float]], found: dict) -> dict[str, bytes]:
+        # 统一按 float32 存储，保证内存层与磁盘层返回的向量完全一致
+        packed = {key: _pack(vector) for key, vector in zip(keys, vectors)}
+        for key, data in packed.items():
+            vector = _unpack(data)
+            self.memory.set(key, vector)
+            found[key] = vector
+        with self._lock:
+            self.model_calls += 1
+            self.model_texts += len(keys)
+        return packed
+
+    def _store(self, keys: list[str], vectors: list[list[float]], found: dict):
+        packed = self._store_memory(keys, vectors, found)
+        if self.disk is not None:
+            self.disk.set_many(packed)
+
+    async def _astore(self, keys: list[str], vectors: list[list[float]], found: dict):
+        packed = self._store_memory(keys, vectors, found)
+        if self.disk is not None:
+            # SQLite 写入与提交同样放到线程池执行
+            await asyncio.get_running_loop().run_in_executor(None, self.disk.set_many, packed)
+
+    def _texts_for(self, keys: list[str], texts: list[str]) -> list[str]:
+        # 同一个 key 取第一次出现的原始文本送给模型
+        first_text = {}
+        for text in texts:
+            first_text.setdefault(self._key(text), text)
+        return [first_text[key] for key in keys]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await self.embeddings.aembed_documents(texts)
+
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        found, missing = self._lookup(texts)
+        if missing:
+            vectors = embed_queries(self.embeddings, self._texts_for(missing, texts))
+            self._store(missing, vectors, found)
+        return [found[self._key(text)] for text in texts]
+
+    async def aembed_queries(self, texts: list[str]) -> list[list[float]]:
+        found, missing = await self._alookup(texts)
+        if missing:
+            vectors = await aembed_queries(self.embeddings, self._texts_for(missing, texts))
+            await self._astore(missing, vectors, found)
+        return [found[self._key(text)] for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_queries([text])[0]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return (await self.aembed_queries([text]))[0]
+
+    def stats(self) -> dict:
+        return {
+            "memory": self.memory.stats(),
+            "disk": self.disk.stats() if self.disk is not None else None,
+            "model_calls": self.model_calls,
+            "model_texts": self.model_texts,
+        }
@@ -1,10 +1,10 @@
+import threading
 from abc import ABC, abstractmethod
-from typing import Optional
-
-from langchain_community.embeddings import DashScopeEmbeddings
+from typing import Callable, Optional
 
+from model.embedding_cache import CachedEmbeddings
 from utils.config_handler import rag_config
-from langchain_community.chat_models import ChatTongyi
+from utils.timing_handler import startup_timer
 from langchain_core.embeddings import Embeddings
 from langchain_core.language_models import BaseChatModel
 
@@ -16,20 +16,67 @@ class BaseModelFactory(ABC):
 
 class ChatModelFactory(BaseModelFactory):
     def generator(self,chat_model_name)->Optional[Embeddings|BaseChatModel]:
+        #DashScope 客户端依赖较重，用到时才导入
+        from langchain_community.chat_models import ChatTongyi
         return ChatTongyi(model=chat_model_name)
 
 class VersionModelFactory(BaseModelFactory):
     def generator(self,version_model_name)->Optional[Embeddings|BaseChatModel]:
+        from langchain_community.chat_models import ChatTongyi
         return ChatTongyi(model=version_model_name)
 
 class EmbeddingsFactory(BaseModelFactory):
     def generator(self,embedding_model_name)->Optional[Embeddings|BaseChatModel]:
-        return DashScopeEmbeddings(model=embedding_model_name)
+        from model.dashscope_embeddings import DashScopeQueryEmbeddings
+        embeddings=DashScopeQueryEmbeddings(model=embedding_model_name)
+        cache_config=rag_config.get('embedding_cache') or {}
+        if not cache_config.get('enabled',False):
+            return embeddings
+        #同一菜品名反复向量化，加一层内存+磁盘缓存（只缓存检索查询，知识库文档直接调用模型）
+        return CachedEmbeddings(
+            embeddings,
+            model_name=embedding_model_name,
+            memory_max_entries=cache_config.get('memory_max_entries',10000),
+            disk_path=cache_config.get('disk_path'),
+            disk_max_entries=cache_config.get('disk_max_entries',200000),
+        )
+
+
+#模型客户端在第一次使用时创建，进程内共享同一个实例
+_models:dict[str,Embeddings|BaseChatModel]={}
+_models_lock=threading.Lock()
+
+
+def _get_or_create(key:str,create:Callable[[],Embeddings|BaseChatModel]):
+    model=_models.get(key)
+    if model is None:
+        with _models_lock:
+            model=_models.get(key)
+            if model is None:
+                with startup_timer.span(f"model:{key}"):
+                    model=_models[key]=create()
+    return model
+
+
+def override_models(version:Optional[BaseChatModel]=None,kcal:Optional[BaseChatModel]=None,
+                    embeddings:Optional[Embeddings]=None):
+    """
+    替换模型客户端（离线基准测试、调试用），未传入的保持不变
+    需要在创建 NutritionRAGService / VectorStoreService 之前调用
+    """
+    with _models_lock:
+        for key,model in (("version",version),("kcal",kcal),("embeddings",embeddings)):
+            if model is not None:
+                _models[key]=model
+
 
+def get_version_model()->BaseChatModel:
+    return _get_or_create("version",lambda:VersionModelFactory().generator(rag_config['chat_model_factory_version']))
 
 
-chat_model_factory_version =VersionModelFactory().generator(rag_config['chat_model_factory_version'])
+def get_kcal_model()->BaseChatModel:
+    return _get_or_create("kcal",lambda:ChatModelFactory().generator(rag_config['chat_model_factory_kcal']))
 
-chat_model_factory_kcal=ChatModelFactory().generator(rag_config['chat_model_factory_kcal'])
 
-embeddings_factory = EmbeddingsFactory().generator(rag_config['embedding_model_name'])
\ No newline at end of file
+def get_embeddings()->Embeddings:
+    return _get_or_create("embeddings",lambda:EmbeddingsFactory().generator(rag_config['embedding_model_name']))
@@ -0,0 +1,48 @@
+from typing import Any, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+from utils.metrics_handler import MODEL_TOKENS
+
+
+class TokenUsageCallback(BaseCallbackHandler):
+    """
+    从模型响应中读取 token 用量并计入 nutrition_model_tokens_total
+    优先使用消息上的 usage_metadata（流式调用时由最后一个分片带回），没有时读取 llm_output['token_usage']
+    """
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+
+    @staticmethod
+    def _usage_from_generations(response: LLMResult) -> Optional[tuple[int, int]]:
+        input_tokens = output_tokens = 0
+        found = False
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, 'message', None), 'usage_metadata', None)
+                if usage:
+                    found = True
+                    input_tokens += usage.get('input_tokens', 0) or 0
+                    output_tokens += usage.get('output_tokens', 0) or 0
+        return (input_tokens, output_tokens) if found else None
+
+    @staticmethod
+    def _usage_from_llm_output(response: LLMResult) -> Optional[tuple[int, int]]:
+        usage = (response.llm_output or {}).get('token_usage') or {}
+        if not usage:
+            return None
+        input_tokens = usage.get('input_tokens', usage.get('prompt_tokens', 0)) or 0
+        output_tokens = usage.get('output_tokens', usage.get('completion_tokens', 0)) or 0
+        return input_tokens, output_tokens
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        usage = self._usage_from_generations(response) or self._usage_from_llm_output(response)
+        if usage is None:
+            return
+        input_tokens, output_tokens = usage
+        if input_tokens:
+            MODEL_TOKENS.inc(input_tokens, model=self.model_name, kind="input")
+        if output_tokens:
+            MODEL_TOKENS.inc(output_tokens, model=self.model_name, kind="output")
@@ -0,0 +1,301 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from typing import Iterator, Optional
+
+from langchain_core.documents import Document
+
+from rag.index_generation import publish_generation
+from rag.ingest import chunk_hash, chunk_id
+from utils.config_handler import chroma_config
+from utils.file_handler import get_file_md5_hex
+from utils.logger_handler import logger
+from utils.path_tool import get_abs_path, get_project_root
+
+
+"""
+大规模营养成分表的流式导入（JSON 数组 / JSONL / CSV）：
+记录逐条解析，按批向量化写入，有界队列做背压，内存占用与文件大小无关；
+已写入的行数记录在检查点中，崩溃后重新执行会从断点继续；
+导入完成的文件由 NutritionIndex 在下次加载时读入营养表（多进程部署在索引代数变化后自动重新加载，
+单进程部署需重启服务）
+"""
+READ_CHUNK_SIZE = 64 * 1024
+#单条记录的最大字符数：格式错误（如缺少右括号）时解析器会一直读到文件末尾，超过上限即报错
+DEFAULT_MAX_RECORD_CHARS = 1024 * 1024
+
+
+def _iter_json_array(filepath: str, max_record_chars: int = DEFAULT_MAX_RECORD_CHARS) -> Iterator[dict]:
+    """增量解析顶层为数组的 JSON 文件，不把整个文件读入内存"""
+    decoder = json.JSONDecoder()
+    with open(filepath, 'r', encoding="utf-8") as f:
+        buffer = ""
+        pos = 0
+        eof = False
+        started = False
+        count = 0
+
+        def fill():
+            nonlocal buffer, pos, eof
+            data = f.read(READ_CHUNK_SIZE)
+            if not data:
+                eof = True
+            buffer = buffer[pos:] + data
+            pos = 0
+
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buffer):
+                if eof:
+                    raise ValueError(f"{filepath} JSON 数组没有正常结束")
+                fill()
+                continue
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError(f"{filepath} 顶层不是 JSON 数组")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                return
+            try:
+                record, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                if len(buffer) - pos > max_record_chars:
+                    raise ValueError(
+                        f"{filepath} 第{count + 1}条记录超过 {max_record_chars} 个字符仍无法解析，记录格式错误或过大"
+                    )
+                fill()
+                continue
+            pos = end
+            count += 1
+            yield record
+
+
+def _iter_jsonl(filepath: str, max_record_chars: int = DEFAULT_MAX_RECORD_CHARS) -> Iterator[dict]:
+    with open(filepath, 'r', encoding="utf-8") as f:
+        #按上限读取一行，超长的行不会被整行读入内存
+        for number, line in enumerate(iter(lambda: f.readline(max_record_chars + 1), ""), 1):
+            if len(line) > max_record_chars:
+                raise ValueError(f"{filepath} 第{number}行超过 {max_record_chars} 个字符")
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def _convert_number(value: str):
+    #CSV 中的数值字段转成数字，与 JSON 数据保持一致，便于营养表本地计算
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def _iter_csv(filepath: str) -> Iterator[dict]:
+    with open(filepath, 'r', encoding="utf-8-sig", newline="") as f:
+        for row in csv.DictReader(f):
+            yield {key: _convert_number(value) for key, value in row.items() if key}
+
+
+def iter_records(filepath: str, max_record_chars: int = DEFAULT_MAX_RECORD_CHARS) -> Iterator[dict]:
+    if filepath.endswith('.jsonl'):
+        return _iter_jsonl(filepath, max_record_chars)
+    if filepath.endswith('.csv'):
+        return _iter_csv(filepath)
+    if filepath.endswith('.json'):
+        return _iter_json_array(filepath, max_record_chars)
+    raise ValueError(f"不支持的文件类型: {filepath}")
+
+
+def imported_files(checkpoint_dir: Optional[str] = None) -> list[str]:
+    """已完整导入的文件路径（来自导入检查点），营养表（NutritionIndex）加载时一并读取其中的记录"""
+    if checkpoint_dir is None:
+        checkpoint_dir = (chroma_config.get('bulk_import') or {}).get('checkpoint_dir', 'cache/import_checkpoints')
+    directory = get_abs_path(checkpoint_dir)
+    if not os.path.isdir(directory):
+        return []
+    paths = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, name), 'r', encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.error(f"[批量导入]检查点{name}读取失败：{str(e)}")
+            continue
+        if data.get('finished') and data.get('file'):
+            paths.append(os.path.normpath(os.path.join(get_project_root(), data['file'])))
+    return paths
+
+
+#导入检查点：记录文件 md5 和已连续写入的行数
+class ImportCheckpoint(object):
+    def __init__(self, checkpoint_dir: str, file_key: str):
+        name = hashlib.md5(file_key.encode("utf-8")).hexdigest()
+        self.path = os.path.join(get_abs_path(checkpoint_dir), f"{name}.json")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file_key = file_key
+
+    def load(self, md5_hex: str) -> tuple[int, bool]:
+        """返回 (已写入行数, 是否已全部完成)"""
+        if not os.path.exists(self.path):
+            return 0, False
+        try:
+            with open(self.path, 'r', encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.error(f"[批量导入]检查点{self.path}读取失败，从头开始：{str(e)}")
+            return 0, False
+        #文件内容变化后检查点失效
+        if data.get('md5') != md5_hex:
+            return 0, False
+        return int(data.get('rows_done', 0)), bool(data.get('finished', False))
+
+    def save(self, md5_hex: str, rows_done: int, finished: bool = False):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding="utf-8") as f:
+            json.dump({"file": self.file_key, "md5": md5_hex, "rows_done": rows_done, "finished": finished}, f)
+        os.replace(tmp_path, self.path)
+
+
+class BulkImporter(object):
+    def __init__(self, vectors_store, batch_size: Optional[int] = None, workers: Optional[int] = None):
+        import_config = chroma_config.get('bulk_import') or {}
+        self.vectors_store = vectors_store
+        self.batch_size = batch_size or import_config.get('batch_size', 256)
+        self.workers = workers or import_config.get('workers', 2)
+        self.queue_batches = import_config.get('queue_batches', 4)
+        self.checkpoint_dir = import_config.get('checkpoint_dir', 'cache/import_checkpoints')
+        self.report_interval = import_config.get('report_interval', 5)
+        self.max_record_chars = import_config.get('max_record_chars', DEFAULT_MAX_RECORD_CHARS)
+
+    def run(self, filepath: str) -> dict:
+        filepath = os.path.abspath(filepath)
+        md5_hex = get_file_md5_hex(filepath)
+        if not md5_hex:
+            raise ValueError(f"{filepath} 计算 MD5 失败")
+        file_key = os.path.relpath(filepath, get_project_root())
+        checkpoint = ImportCheckpoint(self.checkpoint_dir, file_key)
+        skip_rows, finished = checkpoint.load(md5_hex)
+        if finished:
+            logger.info(f"[批量导入]{filepath}内容未变化且已导入完成，跳过")
+            return {"file": file_key, "rows_total": skip_rows, "rows_imported": 0, "rows_skipped": skip_rows,
+                    "seconds": 0.0, "rows_per_second": 0.0}
+        if skip_rows:
+            logger.info(f"[批量导入]{filepath}从第{skip_rows}行继续")
+
+        #有界队列：写入跟不上时解析线程阻塞，内存中最多 queue_batches 批数据
+        batches: queue.Queue = queue.Queue(maxsize=self.queue_batches)
+        lock = threading.Lock()
+        finished_ranges: dict[int, int] = {}
+        state = {"watermark": skip_rows, "rows": 0, "error": None}
+        start = time.time()
+        last_report = start
+
+        def consume():
+            nonlocal last_report
+            while True:
+                item = batches.get()
+                if item is None:
+                    return
+                first_row, documents = item
+                try:
+                    if state["error"] is None:
+                        self.vectors_store.add_documents(documents, ids=[doc.id for doc in documents])
+                except Exception as e:
+                    state["error"] = e
+                    logger.error(f"[批量导入]第{first_row}行起的批次写入失败：{str(e)}", exc_info=True)
+                    continue
+                with lock:
+                    if state["error"] is not None:
+                        continue
+                    finished_ranges[first_row] = first_row + len(documents)
+                    #只有连续完成的部分才推进检查点，保证恢复时不丢数据
+                    while state["watermark"] in finished_ranges:
+                        state["watermark"] = finished_ranges.pop(state["watermark"])
+                    state["rows"] += len(documents)
+                    checkpoint.save(md5_hex, state["watermark"])
+                    now = time.time()
+                    if now - last_report >= self.report_interval:
+                        last_report = now
+                        logger.info(
+                            f"[批量导入]{file_key}已写入{state['watermark']}行，"
+                            f"{state['rows'] / (now - start):.1f} 行/秒"
+                        )
+
+        consumers = [threading.Thread(target=consume, daemon=True) for _ in range(self.workers)]
+        for consumer in consumers:
+            consumer.start()
+
+        total_rows = 0
+        try:
+            batch: list[Document] = []
+            batch_first_row = skip_rows
+            for row, record in enumerate(iter_records(filepath, self.max_record_chars)):
+                total_rows = row + 1
+                if row < skip_rows:
+                    continue
+                if state["error"] is not None:
+                    break
+                page_content = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+                batch.append(Document(
+                    page_content=page_content,
+                    metadata={"source": filepath, "seq_num": row + 1},
+                    id=chunk_id(file_key, chunk_hash(page_content)),
+                ))
+                if len(batch) >= self.batch_size:
+                    batches.put((batch_first_row, batch))
+                    batch = []
+                    batch_first_row = row + 1
+            if batch and state["error"] is None:
+                batches.put((batch_first_row, batch))
+        finally:
+            for _ in consumers:
+                batches.put(None)
+            for consumer in consumers:
+                consumer.join()
+
+        if state["error"] is not None:
+            raise state["error"]
+
+        checkpoint.save(md5_hex, state["watermark"], finished=True)
+        seconds = time.time() - start
+        stats = {
+            "file": file_key,
+            "rows_total": total_rows,
+            "rows_imported": state["rows"],
+            "rows_skipped": skip_rows,
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(state["rows"] / seconds, 1) if seconds > 0 else 0.0,
+        }
+        logger.info(f"[批量导入]完成：{stats}")
+        if state["rows"]:
+            stats["generation"] = publish_generation(stats)
+        return stats
+
+
+if __name__ == '__main__':
+    from rag.vector_store import VectorStoreService
+
+    parser = argparse.ArgumentParser(description="流式导入大规模营养成分表（JSON 数组 / JSONL / CSV）")
+    parser.add_argument("paths", nargs="+", help="要导入的文件路径")
+    parser.add_argument("--batch-size", type=int, default=None, help="每批向量化的记录数")
+    parser.add_argument("--workers", type=int, default=None, help="并行写入向量库的线程数")
+    args = parser.parse_args()
+
+    importer = BulkImporter(VectorStoreService().vectors_store, batch_size=args.batch_size, workers=args.workers)
+    for path in args.paths:
+        print(importer.run(path))
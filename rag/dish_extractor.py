@@ -0,0 +1,51 @@
+from typing import Iterable
+
+from utils.text_handler import normalize_text
+
+
+def _compact(text: str) -> str:
+    # 与词面索引一致：归一化后去掉所有空白
+    return "".join(normalize_text(text).split())
+
+
+class DishExtractor(object):
+    """
+    按知识库词表（营养表菜品名、别名和知识库文档名）从文本中提取候选菜品名
+    正向最长匹配：每个位置优先取最长的词，匹配到的片段不再参与后续匹配，
+    "宫保鸡丁盖饭" 在词表中时不会再拆出 "宫保鸡丁"
+    """
+
+    def __init__(self, min_length: int = 2):
+        self.min_length = min_length
+        self._terms: dict[str, str] = {}
+        self._lengths: list[int] = []
+
+    def build(self, vocabularies: Iterable[dict[str, str]]):
+        """vocabularies: 若干 {词: 标准菜品名}，同一个词以先出现的为准"""
+        terms = {}
+        for vocabulary in vocabularies:
+            for term, name in vocabulary.items():
+                term = _compact(term)
+                if len(term) >= self.min_length:
+                    terms.setdefault(term, name)
+        self._terms = terms
+        self._lengths = sorted({len(term) for term in terms}, reverse=True)
+
+    def __len__(self) -> int:
+        return len(self._terms)
+
+    def extract(self, text: str) -> list[str]:
+        """按出现顺序返回去重后的标准菜品名"""
+        text = _compact(text)
+        names = []
+        position = 0
+        while position < len(text):
+            for length in self._lengths:
+                name = self._terms.get(text[position:position + length])
+                if name is not None:
+                    names.append(name)
+                    position += length
+                    break
+            else:
+                position += 1
+        return list(dict.fromkeys(names))
@@ -0,0 +1,52 @@
+import fcntl
+import json
+import os
+import time
+from typing import Optional
+
+from utils.config_handler import chroma_config
+from utils.logger_handler import logger
+from utils.path_tool import get_abs_path
+
+
+"""
+知识库索引代数：导入进程（rag.ingest / rag.bulk_import）写完向量库后递增代数，
+多进程部署的主进程（serve.py）轮询代数，变化后重新加载只读数据并滚动替换 worker；
+代数同时参与分析结果缓存的指纹，知识库更新后旧的缓存结果不再命中
+"""
+def generation_path(path: Optional[str] = None) -> str:
+    return get_abs_path(path or chroma_config.get('generation_file', 'cache/index_generation.json'))
+
+
+def read_generation(path: Optional[str] = None) -> dict:
+    """返回 {"generation": 代数, "published_at": 时间戳, "stats": 导入统计}，文件不存在时代数为 0"""
+    try:
+        with open(generation_path(path), 'r', encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {"generation": 0}
+    except (OSError, ValueError) as e:
+        logger.error("[索引代数]读取失败，按 0 处理：%s", e)
+        return {"generation": 0}
+    return data if isinstance(data, dict) else {"generation": 0}
+
+
+def current_generation(path: Optional[str] = None) -> int:
+    return int(read_generation(path).get('generation', 0))
+
+
+def publish_generation(stats: Optional[dict] = None, path: Optional[str] = None) -> int:
+    """递增并写入新的代数，返回新代数；多个导入进程同时发布时由文件锁保证代数不重复"""
+    target = generation_path(path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(f"{target}.lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        generation = current_generation(target) + 1
+        # 先写临时文件再替换，读取方不会读到半个文件
+        tmp_path = f"{target}.tmp"
+        with open(tmp_path, 'w', encoding="utf-8") as f:
+            json.dump({"generation": generation, "published_at": time.time(), "stats": stats or {}},
+                      f, ensure_ascii=False, default=str)
+        os.replace(tmp_path, target)
+    logger.info("[索引代数]发布第%d代索引", generation)
+    return generation
@@ -0,0 +1,254 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING
+
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from utils.config_handler import chroma_config
+from utils.file_handler import txt_loader, pdf_loader, json_loader, list_dir_with_allowed_type, get_file_md5_hex
+from utils.logger_handler import logger
+from utils.path_tool import get_abs_path, get_project_root
+
+if TYPE_CHECKING:
+    from rag.vector_store import VectorStoreService
+
+
+def get_file_document(read_path:str)->list[Document]:
+    if read_path.endswith('txt'):
+        return txt_loader(read_path)
+    if read_path.endswith('pdf'):
+        return pdf_loader(read_path)
+    if read_path.endswith('json'):
+        return json_loader(read_path)
+
+    return []
+
+
+def load_and_split(read_path:str)->list[tuple[str,dict]]:
+    """
+    解析并分片单个文件，在子进程中执行
+    返回 (page_content, metadata) 列表，避免跨进程传递 Document 对象
+    """
+    documents=get_file_document(read_path)
+    if not documents:
+        return []
+    spliter=RecursiveCharacterTextSplitter(
+        chunk_size=chroma_config['chunk_size'],
+        chunk_overlap=chroma_config['chunk_overlap'],
+        separators=chroma_config['separators'],
+        length_function=len,
+    )
+    return [(doc.page_content,doc.metadata) for doc in spliter.split_documents(documents)]
+
+
+def chunk_hash(page_content:str)->str:
+    return hashlib.sha1(page_content.encode("utf-8")).hexdigest()
+
+
+def chunk_id(file_key:str,content_hash:str)->str:
+    #同一文件内相同内容的分片得到相同的 ID，文件间互不影响
+    return hashlib.sha1(f"{file_key}:{content_hash}".encode("utf-8")).hexdigest()
+
+
+#知识库清单：记录每个文件的 md5 以及其分片哈希 -> 分片 ID
+class IngestManifest(object):
+    def __init__(self,path:str,backend:str="chroma"):
+        self.path=get_abs_path(path)
+        self.backend=backend
+        self.files:dict[str,dict]={}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path,'r',encoding="utf-8") as f:
+                    data=json.load(f)
+            except Exception as e:
+                logger.error(f"[知识库清单]{self.path}读取失败，将重新构建：{str(e)}")
+                data={}
+            #切换向量库后端后，旧清单记录的分片并不在新后端中，需要全部重新导入
+            if data.get('backend','chroma')==backend:
+                self.files=data.get('files',{})
+
+    def get(self,file_key:str)->dict:
+        return self.files.get(file_key) or {"md5": None,"chunks": {}}
+
+    def set(self,file_key:str,md5_hex:str,chunks:dict[str,str]):
+        self.files[file_key]={"md5": md5_hex,"chunks": chunks}
+
+    def remove(self,file_key:str):
+        self.files.pop(file_key,None)
+
+    def save(self):
+        #先写临时文件再替换，避免中途崩溃留下半个清单
+        tmp_path=f"{self.path}.tmp"
+        with open(tmp_path,'w',encoding="utf-8") as f:
+            json.dump({"backend": self.backend,"files": self.files},f,ensure_ascii=False,indent=1)
+        os.replace(tmp_path,self.path)
+
+
+class KnowledgeIngestor(object):
+    """
+    增量导入知识库：
+    1. 按 md5 跳过未变化的文件
+    2. 变化的文件在进程池中并行解析、分片
+    3. 与清单中的分片做差异对比，只向量化新增的分片，新分片写入成功后再删除已不存在的分片
+    4. 新增分片按 ingest_batch_size 分批写入向量库
+    """
+
+    def __init__(self,vector_store_service:"VectorStoreService"):
+        self.vectors_store=vector_store_service.vectors_store
+        self.manifest=IngestManifest(
+            chroma_config.get('manifest_store','manifest.json'),
+            backend=vector_store_service.backend,
+        )
+        self.batch_size=chroma_config.get('ingest_batch_size',64)
+        self.workers=chroma_config.get('ingest_workers',4)
+
+    @staticmethod
+    def _file_key(path:str)->str:
+        #清单中使用相对项目根目录的路径，目录整体移动后仍然有效
+        return os.path.relpath(path,get_project_root())
+
+    def run(self)->dict:
+        start=time.time()
+        stats={"files_skipped": 0,"files_changed": 0,"files_removed": 0,"chunks_added": 0,"chunks_deleted": 0}
+        allowed_files_path=list_dir_with_allowed_type(
+            get_abs_path(chroma_config['data_path']),
+            tuple(chroma_config['allow_knowledge_file_type']),
+        )
+
+        changed={}
+        for path in allowed_files_path:
+            md5_hex=get_file_md5_hex(path)
+            if not md5_hex:
+                logger.error(f"[加载知识库]{path} 计算 MD5 失败，跳过该文件")
+                continue
+            entry=self.manifest.get(self._file_key(path))
+            if entry['md5']==md5_hex:
+                #清单与向量库不一致（如向量库目录被清空、切换了存储位置）时重新导入缺失的分片
+                chunk_ids=list(entry['chunks'].values())
+                if len(self._existing_ids(chunk_ids))==len(chunk_ids):
+                    stats["files_skipped"]+=1
+                    logger.info(f"[加载知识库]{path}内容已存在于知识库内，跳过")
+                    continue
+                logger.warning(f"[加载知识库]{path}清单中的分片在向量库中缺失，重新导入")
+            changed[path]=md5_hex
+
+        for path,chunks in self._split_files(list(changed)):
+            if chunks is None:
+                continue
+            try:
+                added,deleted=self._sync_file(path,changed[path],chunks)
+                stats["files_changed"]+=1
+                stats["chunks_added"]+=added
+                stats["chunks_deleted"]+=deleted
+                logger.info(f"[加载知识库]{path}内容加载成功，新增{added}个分片，删除{deleted}个分片")
+            except Exception as e:
+                logger.error(f"[加载知识库]{path}内容加载失败：{str(e)}",exc_info=True)
+
+        #数据目录中已删除的文件，同步删除其分片
+        current_keys={self._file_key(path) for path in allowed_files_path}
+        for file_key in [key for key in self.manifest.files if key not in current_keys]:
+            chunk_ids=list(self.manifest.get(file_key)['chunks'].values())
+            if chunk_ids:
+                self.vectors_store.delete(ids=chunk_ids)
+            self.manifest.remove(file_key)
+            self.manifest.save()
+            stats["files_removed"]+=1
+            stats["chunks_deleted"]+=len(chunk_ids)
+            logger.info(f"[加载知识库]{file_key}已从数据目录删除，移除{len(chunk_ids)}个分片")
+
+        stats["seconds"]=round(time.time()-start,3)
+        logger.info(f"[加载知识库]完成：{stats}")
+        return stats
+
+    def _split_files(self,paths:list[str]):
+        """并行解析分片，逐个产出 (path, 分片列表)，失败的文件分片列表为 None"""
+        if not paths:
+            return
+        if self.workers<=1 or len(paths)==1:
+            for path in paths:
+                yield path,self._safe_split(path)
+            return
+        with ProcessPoolExecutor(max_workers=min(self.workers,len(paths))) as pool:
+            futures={path:pool.submit(load_and_split,path) for path in paths}
+            for path,future in futures.items():
+                try:
+                    yield path,future.result()
+                except Exception as e:
+                    logger.error(f"[加载知识库]{path}解析失败：{str(e)}",exc_info=True)
+                    yield path,None
+
+    @staticmethod
+    def _safe_split(path:str):
+        try:
+            return load_and_split(path)
+        except Exception as e:
+            logger.error(f"[加载知识库]{path}解析失败：{str(e)}",exc_info=True)
+            return None
+
+    def _sync_file(self,path:str,md5_hex:str,chunks:list[tuple[str,dict]])->tuple[int,int]:
+        file_key=self._file_key(path)
+        entry=self.manifest.get(file_key)
+        #只有向量库中确实存在的分片才算已导入
+        existing=self._existing_ids(list(entry['chunks'].values()))
+        old_chunks:dict[str,str]={
+            content_hash:doc_id for content_hash,doc_id in entry['chunks'].items() if doc_id in existing
+        }
+        #清单中没有记录的文件，需要清理旧版本按随机 ID 写入的同源分片；先记下 ID，新分片写入后再删除
+        legacy_ids=self._legacy_ids(path) if entry['md5'] is None else []
+
+        new_chunks:dict[str,str]={}
+        to_add:list[Document]=[]
+        for page_content,metadata in chunks:
+            content_hash=chunk_hash(page_content)
+            if content_hash in new_chunks:
+                continue
+            new_chunks[content_hash]=chunk_id(file_key,content_hash)
+            if content_hash not in old_chunks:
+                to_add.append(Document(page_content=page_content,metadata=metadata,id=new_chunks[content_hash]))
+
+        #先写入新分片，全部成功后再删除旧分片：写入中途失败时向量库中仍是完整的旧版本
+        for start in range(0,len(to_add),self.batch_size):
+            batch=to_add[start:start+self.batch_size]
+            self.vectors_store.add_documents(batch,ids=[doc.id for doc in batch])
+
+        to_delete=[old_chunks[content_hash] for content_hash in old_chunks if content_hash not in new_chunks]
+        if to_delete:
+            self.vectors_store.delete(ids=to_delete)
+        #旧分片与新分片 ID 相同时已被覆盖写入，不能再删除
+        new_ids=set(new_chunks.values())
+        legacy_ids=[doc_id for doc_id in legacy_ids if doc_id not in new_ids]
+        if legacy_ids:
+            self.vectors_store.delete(ids=legacy_ids)
+            logger.info(f"[加载知识库]{path}清理{len(legacy_ids)}个旧分片")
+
+        self.manifest.set(file_key,md5_hex,new_chunks)
+        self.manifest.save()
+        return len(to_add),len(to_delete)
+
+    def _existing_ids(self,chunk_ids:list[str])->set[str]:
+        """向量库中实际存在的分片 ID"""
+        if not chunk_ids:
+            return set()
+        found=set()
+        #分段查询，避免单次查询的 ID 过多
+        for start in range(0,len(chunk_ids),500):
+            found.update(self.vectors_store.get(ids=chunk_ids[start:start+500]).get('ids') or [])
+        return found
+
+    def _legacy_ids(self,path:str)->list[str]:
+        try:
+            legacy=self.vectors_store.get(where={"source": path})
+        except Exception as e:
+            logger.error(f"[加载知识库]{path}查询旧分片失败：{str(e)}")
+            return []
+        return list(legacy.get('ids') or []) if legacy else []
+
+
+if __name__ == '__main__':
+    from rag.vector_store import VectorStoreService
+
+    print(VectorStoreService().load_document())
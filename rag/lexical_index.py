@@ -0,0 +1,157 @@
+import json
+import math
+import threading
+from collections import Counter, defaultdict
+from typing import Optional
+
+from langchain_core.documents import Document
+
+from utils.text_handler import normalize_text
+
+
+def compact_text(text: str) -> str:
+    return "".join(normalize_text(text).split())
+
+
+def char_ngrams(text: str, sizes: tuple[int, ...] = (1, 2)) -> list[str]:
+    """中文按字切分 n-gram，忽略空白"""
+    text = compact_text(text)
+    grams = []
+    for size in sizes:
+        grams.extend(text[i:i + size] for i in range(len(text) - size + 1))
+    return grams
+
+
+def record_name(page_content: str) -> Optional[str]:
+    """JSON 记录文档的 name 字段，其他文档返回 None"""
+    try:
+        record = json.loads(page_content)
+    except (TypeError, ValueError):
+        return None
+    if isinstance(record, dict) and isinstance(record.get('name'), str):
+        return record['name']
+    return None
+
+
+def index_text(page_content: str) -> str:
+    """JSON 记录只索引 name 字段，其余文本整体索引，避免描述文字干扰菜品名匹配"""
+    name = record_name(page_content)
+    return page_content if name is None else name
+
+
+class LexicalIndex(object):
+    """
+    知识库文档的字 n-gram 倒排索引，BM25 打分
+    search 同时返回词面置信度：文档名的 n-gram 被查询覆盖的比例与查询被文档覆盖的比例的加权，
+    置信度足够高时可以直接使用词面结果，不再调用向量化模型
+    短于 min_name_length 的文档名（如单字的 "面"）只在与查询完全一致时才有置信度，
+    避免 "面包" 这类只是包含该字的查询直接采用错误的参考数据
+    """
+
+    def __init__(self, ngram_sizes: tuple[int, ...] = (1, 2), k1: float = 1.2, b: float = 0.75,
+                 min_name_length: int = 2):
+        self.ngram_sizes = tuple(ngram_sizes)
+        self.k1 = k1
+        self.b = b
+        self.min_name_length = min_name_length
+        self._lock = threading.Lock()
+        self._documents: list[Document] = []
+        self._texts: list[str] = []
+        self._gram_sets: list[set[str]] = []
+        self._postings: dict[str, list[tuple[int, int]]] = {}
+        self._doc_lengths: list[int] = []
+        self._avg_length = 0.0
+
+    def build(self, documents: list[Document]):
+        postings = defaultdict(list)
+        texts = []
+        gram_sets = []
+        doc_lengths = []
+        for doc_index, doc in enumerate(documents):
+            text = compact_text(index_text(doc.page_content))
+            grams = char_ngrams(text, self.ngram_sizes)
+            for gram, tf in Counter(grams).items():
+                postings[gram].append((doc_index, tf))
+            texts.append(text)
+            gram_sets.append(set(grams))
+            doc_lengths.append(len(grams))
+        with self._lock:
+            self._documents = list(documents)
+            self._texts = texts
+            self._gram_sets = gram_sets
+            self._postings = dict(postings)
+            self._doc_lengths = doc_lengths
+            self._avg_length = sum(doc_lengths) / len(doc_lengths) if doc_lengths else 0.0
+
+    def __len__(self):
+        return len(self._documents)
+
+    def names(self) -> list[str]:
+        """JSON 记录文档的菜品名（其余文档没有明确的名称，不返回）"""
+        with self._lock:
+            documents = self._documents
+        return [name for name in (record_name(doc.page_content) for doc in documents) if name]
+
+    def search(self, query: str, k: int = 10) -> tuple[list[Document], float]:
+        """返回 (按 BM25 排序的文档, 第一名的词面置信度)"""
+        with self._lock:
+            documents, texts, gram_sets = self._documents, self._texts, self._gram_sets
+            postings, doc_lengths, avg_length = self._postings, self._doc_lengths, self._avg_length
+        if not documents:
+            return [], 0.0
+
+        query_grams = set(char_ngrams(query, self.ngram_sizes))
+        scores: dict[int, float] = defaultdict(float)
+        total = len(documents)
+        for gram in query_grams:
+            posting = postings.get(gram)
+            if not posting:
+                continue
+            idf = math.log(1 + (total - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_index, tf in posting:
+                norm = self.k1 * (1 - self.b + self.b * doc_lengths[doc_index] / (avg_length or 1))
+                scores[doc_index] += idf * tf * (self.k1 + 1) / (tf + norm)
+        if not scores:
+            return [], 0.0
+
+        ranked = sorted(scores, key=scores.get, reverse=True)[:k]
+        top = ranked[0]
+        confidence = self._confidence(compact_text(query), texts[top], query_grams, gram_sets[top])
+        return [documents[index] for index in ranked], confidence
+
+    def _confidence(self, query_text: str, doc_text: str, query_grams: set[str], doc_grams: set[str]) -> float:
+        if not query_grams or not doc_grams:
+            return 0.0
+        if query_text == doc_text:
+            return 1.0
+        # 过短的文档名几乎出现在任何包含该字的查询中，子串命中不可信，交给向量检索
+        if len(doc_text) < self.min_name_length:
+            return 0.0
+        shared = len(query_grams & doc_grams)
+        # 主要看文档名是否完整出现在查询中（"宫保鸡丁盖饭" -> "宫保鸡丁"），再兼顾查询被覆盖的比例
+        return 0.7 * shared / len(doc_grams) + 0.3 * shared / len(query_grams)
+
+
+def reciprocal_rank_fusion(rankings: list[list[Document]], k: int, rrf_k: int = 60) -> list[Document]:
+    """RRF 融合多路检索结果，按文档 ID（没有 ID 时按内容）去重"""
+    scores: dict[str, float] = defaultdict(float)
+    first_seen: dict[str, Document] = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            key = doc.id or doc.page_content
+            scores[key] += 1.0 / (rrf_k + rank + 1)
+            first_seen.setdefault(key, doc)
+    ordered = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [first_seen[key] for key in ordered]
+
+
+def documents_from_store(vectors_store) -> Optional[list[Document]]:
+    """从向量库中取出全部文档用于构建词面索引，后端不支持时返回 None"""
+    get = getattr(vectors_store, 'get', None)
+    if get is None:
+        return None
+    data = get()
+    return [
+        Document(id=doc_id, page_content=text, metadata=metadata or {})
+        for doc_id, text, metadata in zip(data['ids'], data['documents'], data['metadatas'])
+    ]
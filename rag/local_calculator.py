@@ -0,0 +1,92 @@
+import re
+from typing import Optional
+
+from utils.config_handler import rag_config
+
+
+"""
+本地确定性热量计算：所有菜品都命中营养表时，直接按 克重/单位克重*热量 累加，
+不再调用第二次大模型
+"""
+_GRAM_PATTERN=re.compile(r"(\d+(?:\.\d+)?)\s*(?:g|克)",re.IGNORECASE)
+
+
+def _parse_grams(value)->Optional[float]:
+    """从 "100g"、"15克" 这类字段中取出克数，无法解析返回 None"""
+    if isinstance(value,(int,float)):
+        return float(value)
+    if not isinstance(value,str):
+        return None
+    match=_GRAM_PATTERN.search(value)
+    return float(match.group(1)) if match else None
+
+
+def calories_per_gram(record:Optional[dict])->Optional[float]:
+    if not record:
+        return None
+    calories=record.get('calories')
+    unit_grams=_parse_grams(record.get('unit','100g'))
+    if not isinstance(calories,(int,float)) or isinstance(calories,bool) or not unit_grams:
+        return None
+    return calories/unit_grams
+
+
+def can_compute_locally(items:list[dict],records:dict[str,Optional[dict]])->bool:
+    for item in items:
+        weight=item.get('weight_g')
+        if not isinstance(weight,(int,float)) or weight<0:
+            return False
+        if calories_per_gram(records.get(item.get('name'))) is None:
+            return False
+    return True
+
+
+def compute_total_calories(items:list[dict],records:dict[str,Optional[dict]])->int:
+    total=0.0
+    for item in items:
+        total+=item['weight_g']*calories_per_gram(records[item['name']])
+    return int(round(total))
+
+
+def estimate_total_calories(items:list[dict],records:dict[str,Optional[dict]],default_kcal_per_gram:float)->int:
+    """模型不可用时的兜底估算：营养表中有的菜品按表计算，没有的按默认热量密度计算"""
+    total=0.0
+    for item in items:
+        weight=item.get('weight_g')
+        if not isinstance(weight,(int,float)) or weight<0:
+            continue
+        per_gram=calories_per_gram(records.get(item.get('name')))
+        total+=weight*(per_gram if per_gram is not None else default_kcal_per_gram)
+    return int(round(total))
+
+
+def template_advice(items:list[dict],records:dict[str,Optional[dict]],total_calories:int)->str:
+    """按 kcal prompt 中的规则生成模板化建议：单顿超量提示减量，并粗看蛋白质占比"""
+    threshold=rag_config.get('local_calc',{}).get('overeat_threshold',800)
+    parts=[]
+    if total_calories>threshold:
+        parts.append(f"本餐约{total_calories}千卡，超过单顿{threshold}千卡的参考值，建议减少主食或油脂较多菜品的分量。")
+    else:
+        parts.append(f"本餐约{total_calories}千卡，热量在单顿合理范围内。")
+
+    protein_grams=0.0
+    for item in items:
+        record=records.get(item['name'])
+        if not record:
+            return "".join(parts)
+        protein_per_unit=_parse_grams(record.get('protein'))
+        unit_grams=_parse_grams(record.get('unit','100g'))
+        if protein_per_unit is None or not unit_grams:
+            # 蛋白质数据不全时不做比例判断
+            return "".join(parts)
+        protein_grams+=item['weight_g']*protein_per_unit/unit_grams
+
+    if total_calories>0:
+        protein_ratio=protein_grams*4/total_calories
+        if protein_ratio<0.1:
+            parts.append("蛋白质供能比例偏低，可搭配鸡蛋、豆制品或瘦肉。")
+        elif protein_ratio>0.35:
+            parts.append("蛋白质供能比例偏高，建议搭配适量主食和蔬菜。")
+        else:
+            parts.append("蛋白质供能比例较为均衡，注意搭配足量蔬菜。")
+    return "".join(parts)
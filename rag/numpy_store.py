@@ -0,0 +1,408 @@
+import json
+import os
+import shutil
+import threading
+import uuid
+from typing import Any, Callable, Iterable, NamedTuple, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from utils.path_tool import get_abs_path
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _quantize(matrix: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """按行对称量化为 int8，返回 (int8 矩阵, 每行缩放系数)"""
+    scales = np.abs(matrix).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.round(matrix / scales[:, None]).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+class _Segment(NamedTuple):
+    """写入后不再修改的一段向量；被删除的行只记录在代数清单中，合并时才真正去掉"""
+    name: str
+    ids: list[str]
+    texts: list[str]
+    metadatas: list[dict]
+    matrix: Optional[np.ndarray]
+    scales: Optional[np.ndarray]
+    deleted: frozenset = frozenset()
+
+    @property
+    def live_rows(self) -> int:
+        return len(self.ids) - len(self.deleted)
+
+    def live(self) -> Iterable[int]:
+        return (row for row in range(len(self.ids)) if row not in self.deleted)
+
+
+class _Index(NamedTuple):
+    generation: int
+    segments: tuple
+    # 文档 ID -> [(段序号, 行号)]，只包含未删除的行
+    locations: dict
+
+
+EMPTY_INDEX = _Index(0, (), {})
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    进程内的向量索引：归一化后的 float32（可选 int8 量化）向量保存为 .npy 并以 mmap 方式打开，
+    文本和元数据保存在 meta.json 中；检索时对每个段做一次矩阵乘法再合并 top-k
+    适合几万条短文本的菜品库，启动只需映射文件，不需要额外的服务或客户端
+
+    目录结构：
+    - segments/<段名>/：一次写入的向量、缩放系数和元数据，写完后整体改名生效，之后不再修改
+    - generations/gen-<代数>.json：代数清单，列出该代数包含的段以及每段已删除的行
+    - CURRENT：当前代数的清单名，写完新清单后原子替换
+    写入只追加新段、写新清单再替换 CURRENT，读取方要么看到旧代数、要么看到完整的新代数；
+    末尾的段不小于前一段时二者合并（类似二进制进位），段数保持在 O(log N)，总写入量为 O(N log N)
+    只允许一个进程写入（导入进程），服务进程只读
+    """
+    VECTORS_FILE = "vectors.npy"
+    SCALES_FILE = "scales.npy"
+    META_FILE = "meta.json"
+    CURRENT_FILE = "CURRENT"
+    SEGMENTS_DIR = "segments"
+    GENERATIONS_DIR = "generations"
+    # 旧版本把整个索引直接写在根目录下，作为名为 "." 的段读取，合并掉之后清理
+    LEGACY_SEGMENT = "."
+    QUANTIZED_BLOCK_ROWS = 8192
+    MERGE_BLOCK_ROWS = 8192
+    # 保留最近几代的清单及其引用的段，刚读到旧指针的读取方仍能打开对应文件
+    KEEP_GENERATIONS = 3
+
+    def __init__(self, persist_directory: str, embedding_function: Embeddings, quantize: bool = False):
+        self.persist_directory = get_abs_path(persist_directory)
+        self.embedding_function = embedding_function
+        self.quantize = quantize
+        self._write_lock = threading.Lock()
+        os.makedirs(self._path(self.SEGMENTS_DIR), exist_ok=True)
+        os.makedirs(self._path(self.GENERATIONS_DIR), exist_ok=True)
+
+        # 已打开的段按段名缓存，切换代数时未变化的段不重新读取
+        self._segments: dict[str, _Segment] = {}
+        # 整个索引作为一个不可变快照整体替换，读请求无需加锁
+        self._index: _Index = EMPTY_INDEX
+        self._load()
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self.embedding_function
+
+    def _path(self, *names: str) -> str:
+        return os.path.join(self.persist_directory, *names)
+
+    def _segment_path(self, name: str, file: str) -> str:
+        if name == self.LEGACY_SEGMENT:
+            return self._path(file)
+        return self._path(self.SEGMENTS_DIR, name, file)
+
+    def _open_segment(self, name: str) -> _Segment:
+        segment = self._segments.get(name)
+        if segment is None:
+            with open(self._segment_path(name, self.META_FILE), 'r', encoding="utf-8") as f:
+                meta = json.load(f)
+            matrix = np.load(self._segment_path(name, self.VECTORS_FILE), mmap_mode='r') if meta['ids'] else None
+            scales = (np.load(self._segment_path(name, self.SCALES_FILE), mmap_mode='r')
+                      if matrix is not None and matrix.dtype == np.int8 else None)
+            segment = _Segment(name, meta['ids'], meta['texts'], meta['metadatas'], matrix, scales)
+            self._segments[name] = segment
+        return segment
+
+    def _build_index(self, generation: int, parts: list[tuple[str, Iterable[int]]]) -> _Index:
+        segments = tuple(self._open_segment(name)._replace(deleted=frozenset(deleted)) for name, deleted in parts)
+        locations = {}
+        for position, segment in enumerate(segments):
+            for row in segment.live():
+                locations.setdefault(segment.ids[row], []).append((position, row))
+        self._segments = {segment.name: self._segments[segment.name] for segment in segments}
+        return _Index(generation, segments, locations)
+
+    def _read_manifest(self) -> Optional[dict]:
+        try:
+            with open(self._path(self.CURRENT_FILE), 'r', encoding="utf-8") as f:
+                name = f.read().strip()
+        except FileNotFoundError:
+            return None
+        with open(self._path(self.GENERATIONS_DIR, f"{name}.json"), 'r', encoding="utf-8") as f:
+            return json.load(f)
+
+    def _load(self):
+        for attempt in range(3):
+            try:
+                manifest = self._read_manifest()
+                if manifest is None:
+                    if os.path.exists(self._path(self.META_FILE)):
+                        self._index = self._build_index(0, [(self.LEGACY_SEGMENT, ())])
+                    else:
+                        self._index = EMPTY_INDEX
+                elif manifest['generation'] != self._index.generation:
+                    self._index = self._build_index(
+                        manifest['generation'], [(part['name'], part['deleted']) for part in manifest['segments']]
+                    )
+                return
+            except FileNotFoundError:
+                # 读到指针后写入方恰好清理了对应的旧代数，重新读取指针
+                if attempt == 2:
+                    raise
+
+    def reload(self):
+        """其他进程写入了新代数后切换过去"""
+        with self._write_lock:
+            self._load()
+
+    @staticmethod
+    def _write_file(path: str, content: str):
+        with open(f"{path}.tmp", 'w', encoding="utf-8") as f:
+            f.write(content)
+        os.replace(f"{path}.tmp", path)
+
+    def _write_segment(self, ids: list[str], texts: list[str], metadatas: list[dict],
+                       blocks: Iterable[np.ndarray], dim: int) -> str:
+        """把向量逐块写入临时目录，写完后整体改名为新段"""
+        name = f"seg-{uuid.uuid4().hex}"
+        tmp_dir = self._path(self.SEGMENTS_DIR, f"{name}.tmp")
+        os.makedirs(tmp_dir)
+        matrix = np.lib.format.open_memmap(
+            os.path.join(tmp_dir, self.VECTORS_FILE), mode='w+',
+            dtype=np.int8 if self.quantize else np.float32, shape=(len(ids), dim),
+        )
+        scales = np.lib.format.open_memmap(
+            os.path.join(tmp_dir, self.SCALES_FILE), mode='w+', dtype=np.float32, shape=(len(ids),),
+        ) if self.quantize else None
+        start = 0
+        for block in blocks:
+            end = start + len(block)
+            if scales is None:
+                matrix[start:end] = block
+            else:
+                matrix[start:end], scales[start:end] = _quantize(block)
+            start = end
+        matrix.flush()
+        if scales is not None:
+            scales.flush()
+        del matrix, scales
+        with open(os.path.join(tmp_dir, self.META_FILE), 'w', encoding="utf-8") as f:
+            json.dump({"ids": ids, "texts": texts, "metadatas": metadatas}, f, ensure_ascii=False)
+        os.replace(tmp_dir, self._path(self.SEGMENTS_DIR, name))
+        return name
+
+    def _dense_blocks(self, segment: _Segment) -> Iterable[np.ndarray]:
+        """按块取出段中未删除的行并还原为 float32，合并大段时内存占用只与块大小有关"""
+        rows = np.fromiter(segment.live(), dtype=np.int64)
+        for start in range(0, len(rows), self.MERGE_BLOCK_ROWS):
+            selected = rows[start:start + self.MERGE_BLOCK_ROWS]
+            block = np.asarray(segment.matrix[selected], dtype=np.float32)
+            if segment.scales is not None:
+                block = block * np.asarray(segment.scales[selected])[:, None]
+            yield block
+
+    def _merge(self, segments: list[_Segment]) -> list[_Segment]:
+        """把若干段中未删除的行写成一个新段；全部已删除时返回空列表"""
+        segments = [segment for segment in segments if segment.live_rows]
+        if not segments:
+            return []
+        ids, texts, metadatas = [], [], []
+        for segment in segments:
+            for row in segment.live():
+                ids.append(segment.ids[row])
+                texts.append(segment.texts[row])
+                metadatas.append(segment.metadatas[row])
+        blocks = (block for segment in segments for block in self._dense_blocks(segment))
+        return [self._open_segment(self._write_segment(ids, texts, metadatas, blocks, segments[0].matrix.shape[1]))]
+
+    def _merge_tail(self, segments: list[_Segment]) -> list[_Segment]:
+        while len(segments) >= 2 and segments[-2].live_rows <= segments[-1].live_rows:
+            segments[-2:] = self._merge(segments[-2:])
+        return segments
+
+    def _commit(self, segments: list[_Segment]):
+        """先写新代数的清单，再原子替换 CURRENT 指向它"""
+        segments = [segment for segment in segments if segment.live_rows]
+        generation = self._index.generation + 1
+        name = f"gen-{generation:08d}"
+        manifest = {
+            "generation": generation,
+            "segments": [{"name": segment.name, "deleted": sorted(segment.deleted)} for segment in segments],
+        }
+        self._write_file(self._path(self.GENERATIONS_DIR, f"{name}.json"), json.dumps(manifest))
+        self._write_file(self._path(self.CURRENT_FILE), name)
+        self._index = self._build_index(generation, [(segment.name, segment.deleted) for segment in segments])
+        self._collect_garbage()
+
+    def _collect_garbage(self):
+        """删除不再被最近几代引用的清单和段；已经 mmap 旧段的读取方不受影响"""
+        manifests = sorted(name for name in os.listdir(self._path(self.GENERATIONS_DIR)) if name.endswith(".json"))
+        referenced = set()
+        for name in manifests[-self.KEEP_GENERATIONS:]:
+            with open(self._path(self.GENERATIONS_DIR, name), 'r', encoding="utf-8") as f:
+                referenced.update(part['name'] for part in json.load(f)['segments'])
+        for name in manifests[:-self.KEEP_GENERATIONS]:
+            os.remove(self._path(self.GENERATIONS_DIR, name))
+        for name in os.listdir(self._path(self.SEGMENTS_DIR)):
+            if name not in referenced:
+                shutil.rmtree(self._path(self.SEGMENTS_DIR, name), ignore_errors=True)
+        if self.LEGACY_SEGMENT not in referenced:
+            for file in (self.VECTORS_FILE, self.SCALES_FILE, self.META_FILE):
+                if os.path.exists(self._path(file)):
+                    os.remove(self._path(file))
+
+    def _mark_deleted(self, ids: Iterable[str]) -> tuple[list[_Segment], bool]:
+        """在当前代数的基础上把这些 ID 的所有行标记为删除，返回 (新的段列表, 是否有行被删除)"""
+        current = self._index
+        deleted = [set(segment.deleted) for segment in current.segments]
+        changed = False
+        for doc_id in set(ids):
+            for position, row in current.locations.get(doc_id, ()):
+                deleted[position].add(row)
+                changed = True
+        segments = [segment._replace(deleted=frozenset(rows)) for segment, rows in zip(current.segments, deleted)]
+        return segments, changed
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[list[dict]] = None,
+                  ids: Optional[list[str]] = None, **kwargs: Any) -> list[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        metadatas = metadatas or [{} for _ in texts]
+        ids = [doc_id or str(uuid.uuid4()) for doc_id in (ids or [None] * len(texts))]
+        vectors = _normalize(self.embedding_function.embed_documents(texts))
+
+        with self._write_lock:
+            # 先切换到最新代数，再在其基础上追加
+            self._load()
+            # 相同 ID 视为更新：旧记录标记为删除，新记录写入新段
+            segments, _ = self._mark_deleted(ids)
+            name = self._write_segment(ids, texts, list(metadatas), [vectors], vectors.shape[1])
+            segments.append(self._open_segment(name))
+            self._commit(self._merge_tail(segments))
+        return ids
+
+    def delete(self, ids: Optional[list[str]] = None, **kwargs: Any) -> Optional[bool]:
+        if not ids:
+            return False
+        with self._write_lock:
+            self._load()
+            segments, changed = self._mark_deleted(ids)
+            if not changed:
+                return False
+            # 已删除的行多于保留的行时整体合并，回收空间
+            if sum(len(segment.deleted) for segment in segments) > sum(segment.live_rows for segment in segments):
+                segments = self._merge(segments)
+            self._commit(segments)
+        return True
+
+    def compact(self):
+        """把所有段合并为一个并去掉已删除的行"""
+        with self._write_lock:
+            self._load()
+            segments = list(self._index.segments)
+            if len(segments) > 1 or any(segment.deleted for segment in segments):
+                self._commit(self._merge(segments))
+
+    def get(self, ids: Optional[list[str]] = None, where: Optional[dict] = None, **kwargs: Any) -> dict:
+        """与 Chroma.get 返回结构一致，where 只支持元数据字段的相等匹配"""
+        wanted = set(ids) if ids else None
+        result = {"ids": [], "documents": [], "metadatas": []}
+        for segment in self._index.segments:
+            for row in segment.live():
+                doc_id, metadata = segment.ids[row], segment.metadatas[row]
+                if wanted is not None and doc_id not in wanted:
+                    continue
+                if where and any(metadata.get(key) != value for key, value in where.items()):
+                    continue
+                result["ids"].append(doc_id)
+                result["documents"].append(segment.texts[row])
+                result["metadatas"].append(metadata)
+        return result
+
+    def get_by_ids(self, ids, /) -> list[Document]:
+        found = self.get(ids=list(ids))
+        return [
+            Document(id=doc_id, page_content=text, metadata=metadata)
+            for doc_id, text, metadata in zip(found["ids"], found["documents"], found["metadatas"])
+        ]
+
+    def _scores(self, segment: _Segment, queries: np.ndarray) -> np.ndarray:
+        matrix, scales = segment.matrix, segment.scales
+        if scales is None:
+            # float32 的 mmap 可以直接参与运算，不产生拷贝
+            return queries @ np.asarray(matrix).T
+        # int8 分块转为 float32 计算，避免一次性反量化整个矩阵
+        scores = np.empty((len(queries), len(matrix)), dtype=np.float32)
+        for start in range(0, len(matrix), self.QUANTIZED_BLOCK_ROWS):
+            end = start + self.QUANTIZED_BLOCK_ROWS
+            block = np.asarray(matrix[start:end], dtype=np.float32)
+            scores[:, start:end] = (queries @ block.T) * np.asarray(scales[start:end])[None, :]
+        return scores
+
+    def _search(self, queries: np.ndarray, k: int) -> list[list[tuple[Document, float]]]:
+        """批量 top-k：每个段一次矩阵乘法得到所有查询的余弦相似度，各段的 top-k 再合并"""
+        current = self._index
+        queries = _normalize(queries)
+        candidates = [[] for _ in range(len(queries))]
+        for position, segment in enumerate(current.segments):
+            if segment.matrix is None or not segment.live_rows:
+                continue
+            scores = self._scores(segment, queries)
+            if segment.deleted:
+                scores[:, list(segment.deleted)] = -np.inf
+            count = min(k, segment.live_rows)
+            top = np.argpartition(-scores, count - 1, axis=1)[:, :count]
+            for query, rows in enumerate(top):
+                candidates[query].extend((float(scores[query, row]), position, int(row)) for row in rows)
+        results = []
+        for hits in candidates:
+            hits.sort(key=lambda hit: hit[0], reverse=True)
+            ranked = []
+            for score, position, row in hits[:k]:
+                segment = current.segments[position]
+                ranked.append((
+                    Document(id=segment.ids[row], page_content=segment.texts[row], metadata=segment.metadatas[row]),
+                    score,
+                ))
+            results.append(ranked)
+        return results
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> list[tuple[Document, float]]:
+        vector = self.embedding_function.embed_query(query)
+        return self._search(np.asarray([vector]), k)[0]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> list[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    def similarity_search_by_vector(self, embedding: list[float], k: int = 4, **kwargs: Any) -> list[Document]:
+        return self.similarity_search_by_vectors([embedding], k)[0]
+
+    def similarity_search_by_vectors(self, embeddings: list[list[float]], k: int = 4) -> list[list[Document]]:
+        """批量查询，多个菜品名只做一次矩阵运算"""
+        if not embeddings:
+            return []
+        return [[doc for doc, _ in hits] for hits in self._search(np.asarray(embeddings), k)]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # 余弦相似度 [-1, 1] 映射到 [0, 1]
+        return lambda score: (score + 1.0) / 2.0
+
+    @classmethod
+    def from_texts(cls, texts: list[str], embedding: Embeddings, metadatas: Optional[list[dict]] = None,
+                   *, ids: Optional[list[str]] = None, persist_directory: str = "numpy_db",
+                   quantize: bool = False, **kwargs: Any) -> "NumpyVectorStore":
+        store = cls(persist_directory, embedding, quantize=quantize)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
+
+    def __len__(self):
+        return sum(segment.live_rows for segment in self._index.segments)
@@ -0,0 +1,91 @@
+import json
+from typing import Iterable, Optional
+
+from utils.config_handler import chroma_config, nutrition_config
+from utils.file_handler import list_dir_with_allowed_type
+from utils.logger_handler import logger
+from utils.path_tool import get_abs_path
+from utils.text_handler import normalize_text
+
+
+#结构化营养表：菜品名(含别名) -> 原始记录，命中时只需一次字典查找
+class NutritionIndex(object):
+    def __init__(self):
+        self.records:dict[str,dict]={}
+        self.aliases:dict[str,str]={}
+
+    def load(self):
+        records={}
+        files_path=list_dir_with_allowed_type(
+            get_abs_path(chroma_config['data_path']),
+            tuple(nutrition_config.get('allow_file_type',["json"])),
+        )
+        for path in files_path:
+            try:
+                with open(path,'r',encoding="utf-8") as f:
+                    data=json.load(f)
+            except Exception as e:
+                logger.error(f"[营养表]{path}读取失败：{str(e)}")
+                continue
+            if not isinstance(data,list):
+                logger.info(f"[营养表]{path}不是记录数组，跳过")
+                continue
+            self._add_records(records,data)
+        if nutrition_config.get('include_bulk_import',True):
+            self._load_bulk_imported(records)
+
+        aliases={}
+        for name,alias_list in (nutrition_config.get('aliases') or {}).items():
+            for alias in alias_list or []:
+                aliases[normalize_text(alias)]=normalize_text(name)
+
+        self.records=records
+        self.aliases=aliases
+        logger.info(f"[营养表]共加载{len(records)}条记录，{len(aliases)}个别名")
+
+    @staticmethod
+    def _add_records(records:dict[str,dict],data:Iterable)->int:
+        count=0
+        for record in data:
+            if isinstance(record,dict) and record.get('name'):
+                records[normalize_text(str(record['name']))]=record
+                count+=1
+        return count
+
+    def _load_bulk_imported(self,records:dict[str,dict]):
+        """rag.bulk_import 导入完成的大表（可能不在 data_path 下）逐条流式读入"""
+        from rag.bulk_import import imported_files,iter_records
+        for path in imported_files():
+            try:
+                count=self._add_records(records,iter_records(path))
+            except Exception as e:
+                logger.error(f"[营养表]批量导入文件{path}读取失败：{str(e)}")
+                continue
+            logger.info(f"[营养表]从批量导入文件{path}加载{count}条记录")
+
+    def lookup(self,name:str)->Optional[dict]:
+        key=normalize_text(name)
+        record=self.records.get(key)
+        if record is None and key in self.aliases:
+            record=self.records.get(self.aliases[key])
+        return record
+
+    def names(self)->list[str]:
+        """全部菜品的原始名称（不含别名）"""
+        return [str(record['name']) for record in self.records.values()]
+
+    def vocabulary(self)->dict[str,str]:
+        """归一化后的菜品名及别名 -> 原始菜品名，用于从文本中提取候选菜品"""
+        vocabulary={key:str(record['name']) for key,record in self.records.items()}
+        for alias,key in self.aliases.items():
+            if key in self.records:
+                vocabulary.setdefault(alias,str(self.records[key]['name']))
+        return vocabulary
+
+    @staticmethod
+    def to_context(record:dict)->str:
+        #与 json_loader 中 jq tostring 的格式保持一致
+        return json.dumps(record,ensure_ascii=False,separators=(",",":"))
+
+    def __len__(self):
+        return len(self.records)
@@ -1,13 +1,35 @@
-from typing import List, final
+import asyncio
+import copy
+import json
+import time
+from typing import AsyncIterator, List, Optional, final
 
+from langchain_core.exceptions import OutputParserException
 from langchain_core.messages import SystemMessage, HumanMessage
-from langchain_core.output_parsers import JsonOutputParser
-from langchain_core.runnables import RunnableLambda
-from pydantic import BaseModel, Field
-from model.factory import chat_model_factory_kcal,chat_model_factory_version, embeddings_factory
+from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
+from langchain_core.outputs import ChatGenerationChunk
+from langchain_core.runnables import RunnableLambda, RunnableSequence
+from langchain_core.utils.json import parse_json_markdown
+from pydantic import BaseModel, Field, ValidationError
+from model.call_guard import ModelCallError, ModelGuard, ModelTimeoutError, ModelUnavailableError
+from model.embedding_cache import embed_queries
+from model.factory import get_kcal_model, get_version_model
+from model.usage_callback import TokenUsageCallback
 from langchain_core.prompts import PromptTemplate
+from rag import local_calculator
+from rag.dish_extractor import DishExtractor
+from rag.index_generation import current_generation
+from rag.nutrition_index import NutritionIndex
+from rag.result_cache import build_fingerprint, create_result_cache, image_content_hash, request_key
 from rag.vector_store import VectorStoreService
-from utils.load_prompts import load_kcal_prompts, load_version_prompts, load_estimation_prompts
+from utils.config_handler import rag_config, chroma_config, nutrition_config
+from utils.cache_handler import LRUCache
+from utils.logger_handler import logger
+from utils.metrics_handler import ANALYZE_SECONDS, CACHE_LOOKUPS, ERRORS, MODEL_GUARD_EVENTS, RETRIEVAL_QUERIES, stage
+from utils.singleflight import SingleFlight, AsyncSingleFlight
+from utils.timing_handler import startup_timer
+from utils.load_prompts import (load_kcal_prompts, load_version_prompts, load_estimation_prompts, load_advice_prompts,
+                                load_fused_prompts)
 
 
 class DishItem(BaseModel):
@@ -22,22 +44,42 @@ class AnalysisResult(BaseModel):
     advice: str= Field(description="健康饮食建议")
 
 
-import logging
-logger = logging.getLogger(__name__)
+#上游超时或熔断时热量改用本地估算；排队已满（429）和上游的其他错误直接返回给调用方
+_FALLBACK_ERRORS=(ModelTimeoutError,ModelUnavailableError)
+
 
 class NutritionRAGService:
     def __init__(self):
+        #向量库在第一次检索或 warmup() 时才打开
         self.vector_store = VectorStoreService()
-        self.retriever = self.vector_store.get_retriever()
+        self._retriever = None
+        #batch: 去重 + 一次批量向量化 + 并行查询；single: 逐个菜品调用 retriever
+        self.retrieval_mode = chroma_config.get('retrieval_mode','batch')
+        #结构化营养表：精确/别名命中时不再走向量检索
+        self.nutrition_index = None
+        if nutrition_config.get('enabled',True):
+            self.nutrition_index = NutritionIndex()
+            with startup_timer.span("nutrition_index"):
+                self.nutrition_index.load()
+
 
+        #每个模型单独的并发上限、排队上限、超时与熔断，避免上游变慢时请求无限堆积
+        self.version_model_name=rag_config['chat_model_factory_version']
+        self.kcal_model_name=rag_config['chat_model_factory_kcal']
+        self._guards:dict[str,ModelGuard]={}
 
-        self.version_model=chat_model_factory_version
-        self.kcal_model=chat_model_factory_kcal
+        #模型响应中的 token 用量计入 /metrics
+        self.version_model=get_version_model().with_config(
+            callbacks=[TokenUsageCallback(self.version_model_name)])
+        self.kcal_model=get_kcal_model().with_config(
+            callbacks=[TokenUsageCallback(self.kcal_model_name)])
 
         #加载prompt,以能加入链的格式
         self.prompt_version_text=load_version_prompts()
         self.prompt_estimation_text=load_estimation_prompts()
         self.prompt_kcal_text = load_kcal_prompts()
+        self.prompt_advice_text = load_advice_prompts()
+        self.prompt_fused_text = load_fused_prompts()
 
 
         #初始化解析器
@@ -46,6 +88,35 @@ class NutritionRAGService:
 
         self.__init_chains()
 
+        #分析结果缓存：模型名、prompt 内容、本地计算配置和知识库索引代数都参与缓存键
+        self.index_generation=current_generation()
+        self.fingerprint=build_fingerprint(
+            [self.version_model_name,self.kcal_model_name,rag_config['embedding_model_name']],
+            [self.prompt_version_text,self.prompt_estimation_text,self.prompt_kcal_text,self.prompt_advice_text,
+             self.prompt_fused_text],
+            extra={"local_calc":rag_config.get('local_calc'),"fused_text":rag_config.get('fused_text'),
+                   "index_generation":self.index_generation},
+        )
+        self.result_cache=create_result_cache(rag_config.get('result_cache'))
+
+        #图片识别结果按图片内容哈希去重：同一张图片只调用一次视觉模型，与分析结果缓存相互独立
+        recognition_config=(rag_config.get('image') or {}).get('recognition_cache') or {}
+        self.recognition_cache=None
+        if recognition_config.get('enabled',False):
+            self.recognition_cache=LRUCache(
+                max_entries=recognition_config.get('max_entries',4096),ttl=recognition_config.get('ttl'))
+        self.recognition_fingerprint=build_fingerprint([self.version_model_name],[self.prompt_version_text])
+
+        #文本融合模式的候选菜品提取，词表在第一次使用时构建，知识库重建词面索引后自动更新
+        self._dish_extractor:Optional[DishExtractor]=None
+        self._dish_extractor_source=None
+
+        #相同输入的并发请求、相同菜品的并发检索只执行一次
+        self._analyze_flight=SingleFlight()
+        self._analyze_async_flight=AsyncSingleFlight()
+        self._retrieve_flight=SingleFlight()
+        self._retrieve_async_flight=AsyncSingleFlight()
+
 
     def __init_chains(self):
         def build_vision_input(input_dict):
@@ -88,54 +159,1010 @@ class NutritionRAGService:
         kcal_prompt_template = PromptTemplate.from_template(self.prompt_kcal_text)
         self.chain_kcal=(kcal_prompt_template|self.kcal_model|self.calculation_parser)
 
+        #本地计算路径下单独生成建议文本的链
+        advice_prompt_template = PromptTemplate.from_template(self.prompt_advice_text)
+        self.chain_advice=(advice_prompt_template|self.kcal_model|StrOutputParser())
+
+        #文本融合模式：识别 + 热量计算一次完成，输出与卡路里估算链相同
+        fused_prompt_template = PromptTemplate.from_template(self.prompt_fused_text)
+        self.chain_fused=(fused_prompt_template|self.kcal_model|self.calculation_parser)
+
+
+    @property
+    def retriever(self):
+        if self._retriever is None:
+            self._retriever=self.vector_store.get_retriever()
+        return self._retriever
+
+    def warmup(self)->dict:
+        """
+        预热：打开向量库和词面索引，创建向量化客户端，并用 config/rag.yml 中 warmup.queries
+        （未配置时取营养表中前 warmup.max_queries 个菜品名）预先检索一遍，填充向量化缓存、
+        让 mmap/HNSW 索引页进入内存。可重复调用，返回本次预热的耗时
+        """
+        warmup_config=rag_config.get('warmup') or {}
+        timings={}
+        start=time.perf_counter()
+        self.vector_store.open()
+        timings["vector_store"]=round(time.perf_counter()-start,4)
+
+        queries=list(warmup_config.get('queries') or [])
+        if not queries and self.nutrition_index is not None:
+            queries=self.nutrition_index.names()[:warmup_config.get('max_queries',32)]
+        if queries:
+            #词面索引命中的查询不会调用向量化模型，这里单独向量化一次以建立连接、填充向量化缓存
+            start=time.perf_counter()
+            with startup_timer.span("warmup:embeddings"):
+                embed_queries(self.vector_store.embeddings,queries)
+            timings["embeddings"]=round(time.perf_counter()-start,4)
+            start=time.perf_counter()
+            with startup_timer.span("warmup:retrieval"):
+                self._search_references(queries)
+            timings["retrieval"]=round(time.perf_counter()-start,4)
+        if self._fused_config().get('enabled',False):
+            self._get_dish_extractor()
+        logger.info("[预热]完成，检索%d个菜品名：%s",len(queries),timings)
+        return {"queries": len(queries),"timings": timings}
+
+    def preload(self)->dict:
+        """
+        多进程部署时主进程在 fork worker 之前调用：加载可以在进程间共享的只读数据（numpy 向量索引、词面索引、
+        候选菜品词表），不调用模型、不启动线程。chroma 客户端持有数据库连接和后台线程，不能跨 fork 使用，
+        由各 worker 自己打开
+        """
+        timings={}
+        if self.vector_store.backend=="numpy":
+            start=time.perf_counter()
+            self.vector_store.open()
+            timings["vector_store"]=round(time.perf_counter()-start,4)
+        if self._fused_config().get('enabled',False):
+            start=time.perf_counter()
+            self._get_dish_extractor()
+            timings["dish_extractor"]=round(time.perf_counter()-start,4)
+        return {"generation": self.index_generation,"timings": timings}
+
+    def _guard(self,model_name:str)->ModelGuard:
+        #首次使用时按配置创建，未配置并发上限的模型使用默认上限
+        guard=self._guards.get(model_name)
+        if guard is None:
+            limits=rag_config.get('model_concurrency') or {}
+            limit=limits.get(model_name,rag_config.get('default_model_concurrency',64))
+            guard=self._guards[model_name]=ModelGuard(model_name,limit,rag_config.get('model_guard'))
+        return guard
+
+    async def _ainvoke_guarded(self,chain,inputs:dict,model_name:str,stage_name:str):
+        """经过准入、超时、解析重试、对冲和熔断保护的异步调用"""
+        return await self._guard(model_name).call(stage_name,lambda:chain.ainvoke(inputs))
+
+    async def _abatch_guarded(self,chain,inputs_list:list[dict],model_name:str,stage_name:str,
+                              max_concurrency:int)->list:
+        """批量调用：每条单独经过模型保护，返回与输入顺序一致的结果（失败的为异常对象）"""
+        semaphore=asyncio.Semaphore(max_concurrency)
+        async def run(inputs):
+            async with semaphore:
+                return await self._ainvoke_guarded(chain,inputs,model_name,stage_name)
+        return await asyncio.gather(*(run(inputs) for inputs in inputs_list),return_exceptions=True)
+
+    def guard_stats(self)->dict:
+        return {model_name:guard.stats() for model_name,guard in self._guards.items()}
+
+    @staticmethod
+    def _fallback_enabled()->bool:
+        return ((rag_config.get('model_guard') or {}).get('fallback') or {}).get('enabled',False)
+
+    def _fallback_result(self,items:list[dict],error:ModelCallError)->dict:
+        """kcal 模型超时或熔断时按营养表 + 默认热量密度本地估算；calc_path 为 fallback，不写入缓存"""
+        fallback_config=(rag_config.get('model_guard') or {}).get('fallback') or {}
+        records={
+            item['name']:self.nutrition_index.lookup(item['name']) if self.nutrition_index is not None else None
+            for item in items
+        }
+        total_calories=local_calculator.estimate_total_calories(
+            items,records,fallback_config.get('default_kcal_per_100g',150)/100)
+        MODEL_GUARD_EVENTS.inc(model=error.model,event="fallback")
+        logger.warning("[模型保护]%s，热量改用本地估算",error)
+        result=self._local_result(items,total_calories,local_calculator.template_advice(items,records,total_calories))
+        result["calc_path"]="fallback"
+        return result
+
+    @staticmethod
+    def _fused_config()->dict:
+        return rag_config.get('fused_text') or {}
+
+    def _get_dish_extractor(self)->DishExtractor:
+        lexical_index=self.vector_store.lexical_index
+        if self._dish_extractor is None or self._dish_extractor_source is not lexical_index:
+            extractor=DishExtractor(min_length=self._fused_config().get('min_name_length',2))
+            vocabularies=[]
+            if self.nutrition_index is not None:
+                vocabularies.append(self.nutrition_index.vocabulary())
+            if lexical_index is not None:
+                vocabularies.append({name:name for name in lexical_index.names()})
+            extractor.build(vocabularies)
+            self._dish_extractor,self._dish_extractor_source=extractor,lexical_index
+        return self._dish_extractor
+
+    def _fused_candidates(self,user_input,image_data)->Optional[list[str]]:
+        """
+        文本融合模式的候选菜品；未开启、有图片、本地提取不到菜品，
+        或候选菜品全部命中营养表（两段式可以本地计算热量）时返回 None，走两段式
+        """
+        if image_data or not user_input or not self._fused_config().get('enabled',False):
+            return None
+        #向量库未打开时只用营养表词表，打开（预热或第一次检索）后自动加入知识库文档名
+        names=self._get_dish_extractor().extract(user_input)
+        if not names:
+            return None
+        local_config=rag_config.get('local_calc') or {}
+        if (local_config.get('enabled',False) and self.nutrition_index is not None
+                and all(self.nutrition_index.lookup(name) is not None for name in names)):
+            return None
+        return names
+
+    def _fused_inputs(self,user_input:str,names:list[str],rag_context:str)->dict:
+        return {
+            "input": user_input,
+            "candidates": "、".join(names),
+            "context": rag_context if rag_context else "未找到参考数据，请基于常识估算。",
+            "format_instructions": self.calculation_parser.get_format_instructions()
+        }
+
+    def _default_items(self,names:list[str])->list[dict]:
+        #融合模式没有模型给出的克重，本地估算时按默认份量
+        weight=self._fused_config().get('default_weight_g',150)
+        return [{"name": name,"weight_g": weight,"is_estimated": True} for name in names]
+
+    @staticmethod
+    def _fused_items_ready(result)->bool:
+        return isinstance(result,dict) and bool(result.get('items')) and 'total_calories' in result
+
+    def _local_override(self,items:list[dict])->Optional[tuple[int,Optional[str]]]:
+        """
+        融合模式识别出的菜品全部命中营养表时，与两段式一样以本地计算的热量为准，
+        返回 (热量, 模板建议)；local_calc.llm_advice 开启时模板建议为 None，保留模型生成的建议
+        """
+        records=self._resolve_local(items)
+        if records is None:
+            return None
+        total_calories=local_calculator.compute_total_calories(items,records)
+        if (rag_config.get('local_calc') or {}).get('llm_advice',False):
+            return total_calories,None
+        return total_calories,local_calculator.template_advice(items,records,total_calories)
+
+    def _finish_fused(self,result)->Optional[dict]:
+        """补全融合模式的结果；输出中没有菜品时返回 None，由调用方回到两段式"""
+        if not self._fused_items_ready(result):
+            return None
+        override=self._local_override(result['items'])
+        if override is not None:
+            total_calories,advice=override
+            return self._local_result(result['items'],total_calories,advice or result.get('advice',''))
+        result["calc_path"]="fused"
+        return result
+
+    def _analyze_fused(self,user_input:str,names:list[str])->Optional[dict]:
+        candidates=[{"name": name} for name in names]
+        rag_context=self.retrieve_context(candidates)
+        try:
+            with stage("fused_text"):
+                result=self._guard(self.kcal_model_name).call_sync(
+                    "fused_text",lambda:self.chain_fused.invoke(self._fused_inputs(user_input,names,rag_context)))
+        except OutputParserException:
+            return None
+        except _FALLBACK_ERRORS as e:
+            if not self._fallback_enabled():
+                raise
+            return self._fallback_result(self._default_items(names),e)
+        return self._finish_fused(result)
+
+    async def _analyze_fused_async(self,user_input:str,names:list[str])->Optional[dict]:
+        """先检索候选菜品，再一次调用完成识别和热量计算；返回 None 时由调用方回到两段式"""
+        candidates=[{"name": name} for name in names]
+        rag_context=self._format_context(candidates,await self.aretrieve_references(candidates))
+        try:
+            with stage("fused_text"):
+                result=await self._ainvoke_guarded(
+                    self.chain_fused,self._fused_inputs(user_input,names,rag_context),self.kcal_model_name,"fused_text")
+        except OutputParserException:
+            return None
+        except _FALLBACK_ERRORS as e:
+            if not self._fallback_enabled():
+                raise
+            return self._fallback_result(self._default_items(names),e)
+        return self._finish_fused(result)
+
+    def _estimation_inputs(self,user_input:str)->dict:
+        return {
+            "input": user_input,
+            "format_instructions": self.estimation_parser.get_format_instructions()
+        }
+
+    def _kcal_inputs(self,estimated_data:dict,rag_context:str)->dict:
+        # 传参时确保 user_data 的结构是完整的 JSON 字符串或符合 Prompt 预期
+        return {
+            "user_data": estimated_data,  # 确保这里是一个包含 items 的字典
+            "context": rag_context if rag_context else "未找到参考数据，请基于常识估算。",
+            "format_instructions": self.calculation_parser.get_format_instructions()
+        }
+
+    @staticmethod
+    def _mark_llm(final_result):
+        #标记结果由 kcal 模型计算
+        if isinstance(final_result,dict):
+            final_result["calc_path"]="llm"
+        return final_result
+
+    @staticmethod
+    def _check_estimated(estimated_data):
+        """校验 Step 1 的输出，返回 (items_list, error)"""
+        if not estimated_data or not isinstance(estimated_data, dict):
+            # 增加日志打印，方便排查模型到底返回了什么
+            logger.error("Step 1 返回格式异常: %.500s",estimated_data)
+            return None,{"error": "食物识别失败，请尝试更清晰的描述"}
+
+        items_list = estimated_data.get('items', [])
+        if not items_list:
+            return None,{"error": "未能识别出任何菜品，请重新输入"}
+        return items_list,None
+
+    def _resolve_local(self,items:list[dict])->Optional[dict]:
+        """所有菜品都命中营养表且数据完整时返回 {菜品名: 记录}，否则返回 None"""
+        local_config=rag_config.get('local_calc') or {}
+        if not local_config.get('enabled',False) or self.nutrition_index is None:
+            return None
+        records={item['name']:self.nutrition_index.lookup(item['name']) for item in items}
+        if not local_calculator.can_compute_locally(items,records):
+            return None
+        return records
+
+    def _advice_inputs(self,items:list[dict],records:dict,total_calories:int)->dict:
+        return {
+            "user_data": {"items": items},
+            "total_calories": total_calories,
+            "context": "\n".join(
+                f"[{name}]参考数据: {NutritionIndex.to_context(record)}" for name,record in records.items()
+            ),
+        }
+
+    @staticmethod
+    def _local_result(items:list[dict],total_calories:int,advice:str)->dict:
+        return {
+            "items": items,
+            "total_calories": total_calories,
+            "advice": advice,
+            "calc_path": "local",
+        }
+
+    def analyze_local(self,items:list[dict],records:dict)->dict:
+        total_calories=local_calculator.compute_total_calories(items,records)
+        advice=None
+        if (rag_config.get('local_calc') or {}).get('llm_advice',False):
+            try:
+                with stage("advice"):
+                    advice=self._guard(self.kcal_model_name).call_sync(
+                        "advice",lambda:self.chain_advice.invoke(self._advice_inputs(items,records,total_calories)))
+            except _FALLBACK_ERRORS:
+                advice=None
+        if advice is None:
+            advice=local_calculator.template_advice(items,records,total_calories)
+        return self._local_result(items,total_calories,advice)
+
+    async def aanalyze_local(self,items:list[dict],records:dict)->dict:
+        total_calories=local_calculator.compute_total_calories(items,records)
+        advice=None
+        if (rag_config.get('local_calc') or {}).get('llm_advice',False):
+            #建议文本生成失败不影响热量结果，改用模板建议
+            try:
+                with stage("advice"):
+                    advice=await self._ainvoke_guarded(
+                        self.chain_advice,self._advice_inputs(items,records,total_calories),
+                        self.kcal_model_name,"advice")
+            except _FALLBACK_ERRORS:
+                advice=None
+        if advice is None:
+            advice=local_calculator.template_advice(items,records,total_calories)
+        return self._local_result(items,total_calories,advice)
+
+    def _lookup_structured(self,items:list[dict])->tuple[dict[str,str],list[str]]:
+        """先查结构化营养表，返回 (菜品名->参考数据, 未命中的菜品名)"""
+        references={}
+        missing=[]
+        for name in dict.fromkeys(item['name'] for item in items):
+            record=self.nutrition_index.lookup(name) if self.nutrition_index is not None else None
+            if record is None:
+                missing.append(name)
+            else:
+                references[name]=NutritionIndex.to_context(record)
+        if references:
+            RETRIEVAL_QUERIES.inc(len(references),source="nutrition_table")
+        return references,missing
 
     #将用户提问根据json格式划分解析rag，只解析name字段,list[dict]由后端传回
     def retrieve_context(self,items:list[dict]):
+        references,missing=self._lookup_structured(items)
+        if missing:
+            #并发请求中相同菜品的检索只执行一次
+            with stage("retrieval"):
+                references.update(self._retrieve_flight.do_many(missing,self._search_references))
+        return self._format_context(items,references)
+
+    async def aretrieve_context(self,items:list[dict]):
+        """retrieve_context 的异步版本，输出顺序不变"""
+        return self._format_context(items,await self.aretrieve_references(items))
+
+    async def aretrieve_references(self,items:list[dict])->dict[str,str]:
+        """返回 {菜品名: 参考数据}，批量分析时对整批菜品只检索一次"""
+        references,missing=self._lookup_structured(items)
+        if missing:
+            with stage("retrieval"):
+                references.update(await self._retrieve_async_flight.do_many(missing,self._asearch_references))
+        return references
+
+    def _search_references(self,names:list[str])->dict[str,str]:
+        if self.retrieval_mode=="batch":
+            docs_map=self.vector_store.search_batch(names)
+        else:
+            RETRIEVAL_QUERIES.inc(len(names),source="vector")
+            docs_map={name:self.retriever.invoke(name) for name in names}
+        return self._docs_to_references(docs_map)
+
+    async def _asearch_references(self,names:list[str])->dict[str,str]:
+        if self.retrieval_mode=="batch":
+            docs_map=await self.vector_store.asearch_batch(names)
+        else:
+            RETRIEVAL_QUERIES.inc(len(names),source="vector")
+            results=await asyncio.gather(*(self.retriever.ainvoke(name) for name in names))
+            docs_map=dict(zip(names,results))
+        return self._docs_to_references(docs_map)
+
+    @staticmethod
+    def _docs_to_references(docs_map:dict)->dict[str,str]:
+        return {name:docs[0].page_content for name,docs in docs_map.items() if docs}
+
+    @staticmethod
+    def _format_context(items:list[dict],references:dict[str,str]):
         context_parts=[]
         for item in items:
-            docs=self.retriever.invoke(item['name'])
-            if docs:
-                context_parts.append(f"[{item['name']}]参考数据: {docs[0].page_content}")
+            reference=references.get(item['name'])
+            if reference:
+                context_parts.append(f"[{item['name']}]参考数据: {reference}")
 
         return "\n".join(context_parts)
 
 
-    def analyze(self,user_input=None,image_data=None):
-        logger.info("=== analyze 函数被调用了 ===")
+    def analyze(self,user_input=None,image_data=None,image_hash=None):
+        start=time.perf_counter()
+        key=self._request_key(user_input,image_data,image_hash)
+        if key is None:
+            result,cache_status=self._analyze(user_input,image_data,image_hash),"bypass"
+        else:
+            cached=self._cache_get(key)
+            if cached is not None:
+                result,cache_status=cached,"hit"
+            else:
+                def compute():
+                    result=self._analyze(user_input,image_data,image_hash)
+                    self._cache_set(key,result)
+                    return result
+                result,cache_status=self._analyze_flight.do(key,compute),"miss"
+        self._observe_analyze(start,image_data,cache_status,result)
+        return result
+
+    async def analyze_async(self,user_input=None,image_data=None,image_hash=None):
+        """
+        analyze 的异步版本，全程使用 ainvoke，不阻塞事件循环
+        image_hash 为上传时已计算好的图片内容哈希，不传时从 image_data 计算
+        """
+        start=time.perf_counter()
+        key=self._request_key(user_input,image_data,image_hash)
+        if key is None:
+            result,cache_status=await self._analyze_async(user_input,image_data,image_hash),"bypass"
+        else:
+            cached=await self._acache_get(key)
+            if cached is not None:
+                result,cache_status=cached,"hit"
+            else:
+                async def compute():
+                    result=await self._analyze_async(user_input,image_data,image_hash)
+                    await self._acache_set(key,result)
+                    return result
+                result,cache_status=await self._analyze_async_flight.do(key,compute),"miss"
+        self._observe_analyze(start,image_data,cache_status,result)
+        return result
+
+    @staticmethod
+    def _observe_analyze(start:float,image_data,cache_status:str,result):
+        """端到端耗时按 输入类型/缓存命中/计算路径 分别统计，业务错误单独计数"""
+        if isinstance(result,dict) and "error" in result:
+            ERRORS.inc(stage="analyze",error_type="rejected")
+            calc_path="none"
+        else:
+            calc_path=result.get('calc_path','llm') if isinstance(result,dict) else "llm"
+        ANALYZE_SECONDS.observe(
+            time.perf_counter()-start,
+            mode="image" if image_data else "text",cache=cache_status,calc_path=calc_path,
+        )
+
+    def _request_key(self,user_input,image_data,image_hash=None):
+        return request_key(self.fingerprint,user_input=user_input,image_data=image_data,image_hash=image_hash)
+
+    def _recognition_key(self,image_data,image_hash=None)->Optional[str]:
+        if self.recognition_cache is None:
+            return None
+        return f"{self.recognition_fingerprint}:{image_hash or image_content_hash(image_data)}"
+
+    def _recognition_get(self,key:Optional[str])->Optional[dict]:
+        if key is None:
+            return None
+        cached=self.recognition_cache.get(key)
+        CACHE_LOOKUPS.inc(cache="recognition",result="hit" if cached is not None else "miss")
+        #返回副本，后续流程修改 items 不影响缓存
+        return copy.deepcopy(cached) if cached is not None else None
+
+    def _recognition_set(self,key:Optional[str],estimated_data):
+        #只缓存有效的识别结果，识别失败的图片下次仍然重新识别
+        if key is not None and isinstance(estimated_data,dict) and estimated_data.get('items'):
+            self.recognition_cache.set(key,copy.deepcopy(estimated_data))
+
+    def _cache_get(self,key):
+        if self.result_cache is None:
+            return None
+        cached=self.result_cache.get(key)
+        CACHE_LOOKUPS.inc(cache="result",result="hit" if cached is not None else "miss")
+        return cached
+
+    def _cache_set(self,key,result):
+        #本地兜底估算的结果不缓存，上游恢复后重新计算
+        if isinstance(result,dict) and result.get('calc_path')=="fallback":
+            return
+        if self.result_cache is not None:
+            self.result_cache.set(key,result)
+
+    def _cache_get_many(self,keys)->dict:
+        return {key:self._cache_get(key) for key in keys}
 
+    def _cache_set_many(self,results:dict):
+        for key,result in results.items():
+            self._cache_set(key,result)
+
+    async def _acache_get_many(self,keys)->dict:
+        #开启磁盘层（多 worker 共享缓存）时 SQLite 读写放到线程池，纯内存缓存直接访问
+        if self.result_cache is None or not self.result_cache.blocking:
+            return self._cache_get_many(keys)
+        return await asyncio.get_running_loop().run_in_executor(None,self._cache_get_many,list(keys))
+
+    async def _acache_set_many(self,results:dict):
+        if self.result_cache is None or not self.result_cache.blocking:
+            return self._cache_set_many(results)
+        await asyncio.get_running_loop().run_in_executor(None,self._cache_set_many,results)
+
+    async def _acache_get(self,key):
+        return (await self._acache_get_many([key]))[key]
+
+    async def _acache_set(self,key,result):
+        await self._acache_set_many({key:result})
+
+    def cache_stats(self)->dict:
+        embedding_stats=getattr(self.vector_store.embeddings,'stats',None)
+        return {
+            "result_cache": self.result_cache.stats() if self.result_cache is not None else None,
+            "embedding_cache": embedding_stats() if callable(embedding_stats) else None,
+            "recognition_cache": self.recognition_cache.stats() if self.recognition_cache is not None else None,
+            "coalesced": {
+                "analyze": self._analyze_flight.shared+self._analyze_async_flight.shared,
+                "retrieve": self._retrieve_flight.shared+self._retrieve_async_flight.shared,
+            },
+        }
+
+    def _analyze(self,user_input=None,image_data=None,image_hash=None):
+        names=self._fused_candidates(user_input,image_data)
+        if names:
+            result=self._analyze_fused(user_input,names)
+            if result is not None:
+                return result
         if  image_data:
-            print(">> 检测到图片，启用视觉估算模式...")
-            estimated_data = self.chain_version.invoke({
-                "image": image_data
-            })
+            logger.debug(">> 检测到图片，启用视觉估算模式...")
+            recognition_key=self._recognition_key(image_data,image_hash)
+            estimated_data=self._recognition_get(recognition_key)
+            if estimated_data is None:
+                with stage("step1_vision"):
+                    estimated_data = self._guard(self.version_model_name).call_sync(
+                        "step1_vision",lambda:self.chain_version.invoke({"image": image_data}))
+                self._recognition_set(recognition_key,estimated_data)
         elif user_input:
-            print(f">> [Step 1] 启用文本估算模式: {user_input}")
+            logger.debug(">> [Step 1] 启用文本估算模式: %s",user_input)
 
-            estimated_data = self.chain_estimation.invoke({
-                "input": user_input,
-                "format_instructions": self.estimation_parser.get_format_instructions()
-            })
+            with stage("step1_text"):
+                estimated_data = self._guard(self.kcal_model_name).call_sync(
+                    "step1_text",lambda:self.chain_estimation.invoke(self._estimation_inputs(user_input)))
         else:
             return {"error": "未提供图片或文本输入"}
-        if not estimated_data or not isinstance(estimated_data, dict):
-            # 增加日志打印，方便排查模型到底返回了什么
-            logger.error(f"Step 1 返回格式异常: {estimated_data}")
-            return {"error": "食物识别失败，请尝试更清晰的描述"}
+        items_list,error=self._check_estimated(estimated_data)
+        if error:
+            return error
 
-        items_list = estimated_data.get('items', [])
-        if not items_list:
-            return {"error": "未能识别出任何菜品，请重新输入"}
+        # 快速路径：全部命中营养表时本地计算，跳过 kcal 模型
+        records=self._resolve_local(items_list)
+        if records is not None:
+            return self.analyze_local(items_list,records)
 
         # Step 2: RAG 检索
         rag_context = self.retrieve_context(items_list)
 
-        # Step 3: 传参时确保 user_data 的结构是完整的 JSON 字符串或符合 Prompt 预期
-        final_result = self.chain_kcal.invoke({
-            "user_data": estimated_data,  # 确保这里是一个包含 items 的字典
-            "context": rag_context if rag_context else "未找到参考数据，请基于常识估算。",
-            "format_instructions": self.calculation_parser.get_format_instructions()
-        })
-        return final_result
+        # Step 3: 卡路里计算
+        try:
+            with stage("step3_kcal"):
+                final_result = self._guard(self.kcal_model_name).call_sync(
+                    "step3_kcal",lambda:self.chain_kcal.invoke(self._kcal_inputs(estimated_data,rag_context)))
+        except _FALLBACK_ERRORS as e:
+            if not self._fallback_enabled():
+                raise
+            return self._fallback_result(items_list,e)
+        return self._mark_llm(final_result)
+
+    async def _aestimate(self,user_input=None,image_data=None,image_hash=None)->tuple[Optional[dict],dict[str,asyncio.Task]]:
+        """Step 1，返回 (识别结果, 已提前发起的检索任务 {菜品名: Task})"""
+        if image_data:
+            logger.debug(">> 检测到图片，启用视觉估算模式...")
+            recognition_key=self._recognition_key(image_data,image_hash)
+            cached=self._recognition_get(recognition_key)
+            if cached is not None:
+                return cached,{}
+            with stage("step1_vision"):
+                estimated_data,prefetch=await self._aestimate_with(
+                    self.chain_version,{"image": image_data},self.version_model_name,"step1_vision")
+            self._recognition_set(recognition_key,estimated_data)
+            return estimated_data,prefetch
+
+        logger.debug(">> [Step 1] 启用文本估算模式: %s",user_input)
+        with stage("step1_text"):
+            return await self._aestimate_with(
+                self.chain_estimation,self._estimation_inputs(user_input),self.kcal_model_name,"step1_text")
+
+    async def _aestimate_with(self,chain,inputs:dict,model_name:str,
+                              stage_name:str)->tuple[Optional[dict],dict[str,asyncio.Task]]:
+        if not (rag_config.get('pipeline') or {}).get('enabled',False):
+            try:
+                return await self._ainvoke_guarded(chain,inputs,model_name,stage_name),{}
+            except OutputParserException:
+                #重试后仍无法解析，按识别失败处理
+                return None,{}
+
+        #流水线模式：流式解析模型输出，每个菜品名一完整就立即发起检索，与后续生成重叠
+        #不完整的中间结果只用于提前检索，识别结果以完整输出的严格解析为准
+        prefetch:dict[str,asyncio.Task]={}
+        upstream,parser=self._split_parser(chain)
+
+        async def consume():
+            generation=None
+            parsed_any=False
+            async for chunk in upstream.astream(inputs):
+                chunk=ChatGenerationChunk(message=chunk)
+                generation=chunk if generation is None else generation+chunk
+                partial=parser.parse_result([generation],partial=True)
+                if not isinstance(partial,dict):
+                    continue
+                parsed_any=True
+                for name in self._completed_names(partial.get('items')):
+                    if name not in prefetch:
+                        prefetch[name]=asyncio.ensure_future(self.aretrieve_references([{"name": name}]))
+            if not parsed_any:
+                #整段输出都不是 JSON 时主动抛出，交给模型保护重试
+                raise OutputParserException("模型输出无法解析为 JSON")
+            #JsonOutputParser 会把截断的输出补全成对象，这里按完整 JSON 严格解析，失败时返回 None 改走非流水线调用
+            try:
+                return parse_json_markdown(generation.text,parser=json.loads)
+            except json.JSONDecodeError:
+                return None
+
+        try:
+            #边生成边发起检索有副作用，不对冲
+            estimated_data=await self._guard(model_name).call(stage_name,consume,hedge=False)
+            if not isinstance(estimated_data,dict):
+                logger.warning("[流水线]%s 的流式输出不完整，改用非流水线调用",stage_name)
+                #已提前发起的检索仍然有效，保留给后续步骤使用
+                estimated_data=await self._ainvoke_guarded(chain,inputs,model_name,stage_name)
+        except OutputParserException:
+            self._cancel_prefetch(prefetch)
+            return None,{}
+        except BaseException:
+            self._cancel_prefetch(prefetch)
+            raise
+        return estimated_data,prefetch
+
+    @staticmethod
+    def _split_parser(chain:RunnableSequence)->tuple:
+        """把 prompt|model|parser 拆成 (输出模型消息的上游, 输出解析器)"""
+        steps=chain.steps
+        return (steps[0] if len(steps)==2 else RunnableSequence(*steps[:-1])),steps[-1]
+
+    @staticmethod
+    def _completed_names(items)->list[str]:
+        """
+        从不完整的 items 中取出名称已经完整的菜品：
+        后面已经出现了新的菜品，或者本菜品在 name 之后已经出现了其他字段
+        """
+        if not isinstance(items,list):
+            return []
+        names=[]
+        for index,item in enumerate(items):
+            if not isinstance(item,dict) or not isinstance(item.get('name'),str) or not item['name']:
+                continue
+            keys=list(item)
+            if index<len(items)-1 or keys.index('name')<len(keys)-1:
+                names.append(item['name'])
+        return names
+
+    async def _acollect_references(self,items_list:list[dict],prefetch:dict[str,asyncio.Task])->dict[str,str]:
+        """汇总提前发起的检索结果，剩余的菜品批量检索"""
+        remaining=[item for item in items_list if item['name'] not in prefetch]
+        references=await self.aretrieve_references(remaining) if remaining else {}
+        names=[item['name'] for item in items_list if item['name'] in prefetch]
+        for result in await asyncio.gather(*(prefetch[name] for name in dict.fromkeys(names))):
+            references.update(result)
+        return references
+
+    @staticmethod
+    def _cancel_prefetch(prefetch:dict[str,asyncio.Task]):
+        for task in prefetch.values():
+            if not task.done():
+                task.cancel()
+
+    async def _analyze_async(self,user_input=None,image_data=None,image_hash=None):
+        if not image_data and not user_input:
+            return {"error": "未提供图片或文本输入"}
+        names=self._fused_candidates(user_input,image_data)
+        if names:
+            result=await self._analyze_fused_async(user_input,names)
+            if result is not None:
+                return result
+        estimated_data,prefetch=await self._aestimate(user_input,image_data,image_hash)
+        try:
+            items_list,error=self._check_estimated(estimated_data)
+            if error:
+                return error
+
+            # 快速路径：全部命中营养表时本地计算，跳过 kcal 模型
+            records=self._resolve_local(items_list)
+            if records is not None:
+                return await self.aanalyze_local(items_list,records)
+
+            # Step 2: RAG 检索（流水线模式下大部分已在 Step 1 生成过程中完成）
+            references=await self._acollect_references(items_list,prefetch)
+            rag_context=self._format_context(items_list,references)
+        finally:
+            self._cancel_prefetch(prefetch)
+
+        # Step 3: 卡路里计算
+        try:
+            with stage("step3_kcal"):
+                final_result = await self._ainvoke_guarded(
+                    self.chain_kcal,self._kcal_inputs(estimated_data,rag_context),self.kcal_model_name,"step3_kcal")
+        except _FALLBACK_ERRORS as e:
+            if not self._fallback_enabled():
+                raise
+            return self._fallback_result(items_list,e)
+        return self._mark_llm(final_result)
+    async def analyze_batch_async(self,requests:list[dict],max_concurrency:Optional[int]=None)->list[dict]:
+        """
+        批量分析：Step 1 和 kcal 计算分别用 abatch 并发执行，整批菜品只检索一次
+        返回与输入顺序一致的 [{"result": ...} 或 {"error": ...}]，单条失败不影响其他条目
+        """
+        batch_config=rag_config.get('batch') or {}
+        max_concurrency=max(1,max_concurrency or batch_config.get('max_concurrency',8))
+        outcomes:list[Optional[dict]]=[None]*len(requests)
+
+        #按请求键去重，同一批内相同的输入只分析一次
+        groups:dict[str,list[int]]={}
+        keys=[self._request_key(request.get('text'),request.get('image_url'),request.get('image_hash')) for request in requests]
+        cached_results=await self._acache_get_many({key for key in keys if key is not None})
+        for index,key in enumerate(keys):
+            if key is None:
+                outcomes[index]={"error": "未提供图片或文本输入"}
+                continue
+            cached=cached_results[key]
+            if cached is not None:
+                outcomes[index]=self._validate_outcome(key,{"result": cached})
+                continue
+            groups.setdefault(key,[]).append(index)
+
+        #成功的结果在整批结束后一次性写入缓存
+        to_cache:dict[str,dict]={}
+        def finish(key:str,outcome:dict):
+            outcome=self._validate_outcome(key,outcome)
+            if "result" in outcome:
+                to_cache[key]=outcome["result"]
+            for index in groups[key]:
+                outcomes[index]=outcome
+
+        # Step 1: 图片与文本分别批量调用
+        image_keys=[key for key,indexes in groups.items() if requests[indexes[0]].get('image_url')]
+        text_keys=[key for key in groups if key not in image_keys]
+        with stage("batch_step1"):
+            image_results,text_results=await asyncio.gather(
+                self._abatch_guarded(
+                    self.chain_version,
+                    [{"image": requests[groups[key][0]]['image_url']} for key in image_keys],
+                    self.version_model_name,"step1_vision",max_concurrency,
+                ) if image_keys else asyncio.sleep(0,result=[]),
+                self._abatch_guarded(
+                    self.chain_estimation,
+                    [self._estimation_inputs(requests[groups[key][0]]['text']) for key in text_keys],
+                    self.kcal_model_name,"step1_text",max_concurrency,
+                ) if text_keys else asyncio.sleep(0,result=[]),
+            )
+
+        estimated:dict[str,dict]={}
+        local_keys:dict[str,dict]={}
+        for key,estimated_data in zip(image_keys+text_keys,list(image_results)+list(text_results)):
+            if isinstance(estimated_data,Exception):
+                logger.error("[批量分析]Step 1 失败: %.500s",estimated_data)
+                ERRORS.inc(stage="batch_step1",error_type=type(estimated_data).__name__)
+                finish(key,self._batch_error(estimated_data))
+                continue
+            items_list,error=self._check_estimated(estimated_data)
+            if error:
+                finish(key,error)
+                continue
+            records=self._resolve_local(items_list)
+            if records is not None:
+                local_keys[key]=records
+            estimated[key]=estimated_data
+
+        # 本地计算路径
+        llm_keys=[key for key in estimated if key not in local_keys]
+        local_results=await asyncio.gather(
+            *(self.aanalyze_local(estimated[key]['items'],records) for key,records in local_keys.items()),
+            return_exceptions=True,
+        )
+        for key,result in zip(local_keys,local_results):
+            finish(key,self._batch_error(result) if isinstance(result,Exception) else {"result": result})
+
+        if llm_keys:
+            # Step 2: 整批菜品去重后统一检索
+            all_items=[item for key in llm_keys for item in estimated[key]['items']]
+            references=await self.aretrieve_references(all_items)
+
+            # Step 3: 批量卡路里计算
+            with stage("batch_step3_kcal"):
+                kcal_results=await self._abatch_guarded(
+                    self.chain_kcal,
+                    [
+                        self._kcal_inputs(estimated[key],self._format_context(estimated[key]['items'],references))
+                        for key in llm_keys
+                    ],
+                    self.kcal_model_name,"step3_kcal",max_concurrency,
+                )
+            for key,result in zip(llm_keys,kcal_results):
+                if isinstance(result,_FALLBACK_ERRORS) and self._fallback_enabled():
+                    finish(key,{"result": self._fallback_result(estimated[key]['items'],result)})
+                elif isinstance(result,Exception):
+                    logger.error("[批量分析]卡路里计算失败: %s",result)
+                    ERRORS.inc(stage="batch_step3_kcal",error_type=type(result).__name__)
+                    finish(key,self._batch_error(result))
+                else:
+                    finish(key,{"result": self._mark_llm(result)})
+
+        await self._acache_set_many(to_cache)
+        return outcomes
+    async def analyze_stream(self,user_input=None,image_data=None,image_hash=None)->AsyncIterator[tuple[str,dict]]:
+        """
+        流式分析，按阶段依次产出 (事件名, 数据)：
+        items -> retrieval -> total_calories -> advice(逐段增量) -> done，出错时产出 error
+        """
+        key=self._request_key(user_input,image_data,image_hash)
+        if key is None:
+            yield "error",{"error": "未提供图片或文本输入"}
+            return
+        cached=await self._acache_get(key)
+        if cached is not None:
+            for event in self._result_events(cached):
+                yield event
+            return
+
+        # 文本融合模式：输出无法解析时不产出任何事件，继续走两段式
+        names=self._fused_candidates(user_input,image_data)
+        if names:
+            emitted=False
+            async for event in self._astream_fused(key,user_input,names):
+                emitted=True
+                yield event
+            if emitted:
+                return
+
+        # Step 1: 识别菜品
+        estimated_data,prefetch=await self._aestimate(user_input,image_data,image_hash)
+        try:
+            async for event in self._astream_after_estimate(key,estimated_data,prefetch):
+                yield event
+        finally:
+            self._cancel_prefetch(prefetch)
+
+    @staticmethod
+    def _result_events(result:dict)->list[tuple[str,dict]]:
+        #已有完整结果（缓存命中、本地兜底估算）时一次性产出各阶段事件
+        return [
+            ("items",{"items": result.get('items',[])}),
+            ("total_calories",{"total_calories": result.get('total_calories')}),
+            ("advice",{"delta": result.get('advice','')}),
+            ("done",result),
+        ]
+
+    @staticmethod
+    def _retrieval_matches(structured:dict,references:dict[str,str])->list[dict]:
+        return [
+            {
+                "name": name,
+                "source": ("nutrition_table" if name in structured else "vector") if reference else None,
+                "reference": reference,
+            }
+            for name,reference in references.items()
+        ]
+
+    async def _astream_fused(self,key,user_input:str,names:list[str])->AsyncIterator[tuple[str,dict]]:
+        """
+        文本融合模式的流式输出，事件顺序与两段式一致：advice 开始输出时 items 和 total_calories 已经完整，
+        此时依次产出 items、retrieval、total_calories，之后逐段产出 advice
+        """
+        candidates=[{"name": name} for name in names]
+        structured,_=self._lookup_structured(candidates)
+        references=await self.aretrieve_references(candidates)
+        inputs=self._fused_inputs(user_input,names,self._format_context(candidates,references))
+        final_result=None
+        started=False
+        override=None
+        advice_sent=0
+        stream=self._guard(self.kcal_model_name).stream("fused_text",lambda:self.chain_fused.astream(inputs))
+        try:
+            with stage("fused_text"):
+                async for partial in stream:
+                    if not isinstance(partial,dict):
+                        continue
+                    final_result=partial
+                    if not started and 'advice' in partial and self._fused_items_ready(partial):
+                        started=True
+                        override=self._local_override(partial['items'])
+                        yield "items",{"items": partial['items']}
+                        yield "retrieval",{"matches": self._retrieval_matches(structured,references)}
+                        yield "total_calories",{
+                            "total_calories": override[0] if override else partial['total_calories']}
+                        #热量本地计算且使用模板建议时，不再等待模型输出建议
+                        if override and override[1] is not None:
+                            break
+                    advice=partial.get('advice')
+                    if started and isinstance(advice,str) and len(advice)>advice_sent:
+                        yield "advice",{"delta": advice[advice_sent:]}
+                        advice_sent=len(advice)
+        except OutputParserException:
+            if started:
+                raise
+            return
+        except _FALLBACK_ERRORS as e:
+            if started or not self._fallback_enabled():
+                raise
+            for event in self._result_events(self._fallback_result(self._default_items(names),e)):
+                yield event
+            return
+        finally:
+            await stream.aclose()
+
+        if override and override[1] is not None:
+            result=self._local_result(final_result['items'],override[0],override[1])
+            yield "advice",{"delta": result['advice']}
+        else:
+            result=self._finish_fused(final_result)
+            if result is None:
+                if started:
+                    yield "error",{"error": "热量计算失败，请稍后重试"}
+                return
+            if not started:
+                yield "items",{"items": result['items']}
+                yield "retrieval",{"matches": self._retrieval_matches(structured,references)}
+                yield "total_calories",{"total_calories": result['total_calories']}
+                yield "advice",{"delta": result.get('advice','')}
+        await self._acache_set(key,result)
+        yield "done",result
+
+    async def _astream_after_estimate(self,key,estimated_data,prefetch)->AsyncIterator[tuple[str,dict]]:
+        items_list,error=self._check_estimated(estimated_data)
+        if error:
+            yield "error",error
+            return
+        yield "items",{"items": items_list}
+
+        # 快速路径：本地计算热量，建议可选由模型流式生成
+        records=self._resolve_local(items_list)
+        if records is not None:
+            yield "retrieval",{"matches": [
+                {"name": name,"source": "nutrition_table","reference": NutritionIndex.to_context(record)}
+                for name,record in records.items()
+            ]}
+            total_calories=local_calculator.compute_total_calories(items_list,records)
+            yield "total_calories",{"total_calories": total_calories}
+            advice_parts=[]
+            if (rag_config.get('local_calc') or {}).get('llm_advice',False):
+                advice_inputs=self._advice_inputs(items_list,records,total_calories)
+                try:
+                    with stage("advice"):
+                        async for chunk in self._guard(self.kcal_model_name).stream(
+                                "advice",lambda:self.chain_advice.astream(advice_inputs)):
+                            advice_parts.append(chunk)
+                            yield "advice",{"delta": chunk}
+                except _FALLBACK_ERRORS:
+                    #已经输出了部分建议时无法改用模板，直接结束
+                    if advice_parts:
+                        raise
+            if advice_parts:
+                advice="".join(advice_parts)
+            else:
+                advice=local_calculator.template_advice(items_list,records,total_calories)
+                yield "advice",{"delta": advice}
+            result=self._local_result(items_list,total_calories,advice)
+            await self._acache_set(key,result)
+            yield "done",result
+            return
+
+        # Step 2: RAG 检索
+        structured,_=self._lookup_structured(items_list)
+        references=await self._acollect_references(items_list,prefetch)
+        yield "retrieval",{"matches": self._retrieval_matches(structured,references)}
+
+        # Step 3: 流式卡路里计算，JsonOutputParser 逐步产出不完整的 JSON 对象
+        kcal_inputs=self._kcal_inputs(estimated_data,self._format_context(items_list,references))
+        final_result=None
+        total_sent=False
+        advice_sent=0
+        try:
+            with stage("step3_kcal"):
+                async for partial in self._guard(self.kcal_model_name).stream(
+                        "step3_kcal",lambda:self.chain_kcal.astream(kcal_inputs)):
+                    if not isinstance(partial,dict):
+                        continue
+                    final_result=partial
+                    # advice 出现说明 total_calories 已经完整
+                    if not total_sent and 'advice' in partial and 'total_calories' in partial:
+                        total_sent=True
+                        yield "total_calories",{"total_calories": partial['total_calories']}
+                    advice=partial.get('advice')
+                    if isinstance(advice,str) and len(advice)>advice_sent:
+                        yield "advice",{"delta": advice[advice_sent:]}
+                        advice_sent=len(advice)
+        except _FALLBACK_ERRORS as e:
+            #还没有输出任何热量数据时改用本地估算，否则只能报错
+            if total_sent or advice_sent or not self._fallback_enabled():
+                raise
+            result=self._fallback_result(items_list,e)
+            yield "total_calories",{"total_calories": result['total_calories']}
+            yield "advice",{"delta": result['advice']}
+            yield "done",result
+            return
+
+        if not final_result:
+            yield "error",{"error": "热量计算失败，请稍后重试"}
+            return
+        if not total_sent:
+            yield "total_calories",{"total_calories": final_result.get('total_calories')}
+        result=self._mark_llm(final_result)
+        await self._acache_set(key,result)
+        yield "done",result
+
+    @staticmethod
+    def _validate_outcome(key:str,outcome:dict)->dict:
+        """模型输出未经 schema 校验，缺字段或类型不符的结果作为该条的错误返回，不影响整批响应"""
+        if "result" not in outcome:
+            return outcome
+        try:
+            AnalysisResult.model_validate(outcome["result"])
+        except ValidationError as e:
+            logger.error("[批量分析]%s 结果格式不正确: %.500s",key,e)
+            ERRORS.inc(stage="batch_validate",error_type="ValidationError")
+            return {"error": "分析结果格式不正确，请稍后重试"}
+        return outcome
+
+    @staticmethod
+    def _batch_error(error:Exception)->dict:
+        #不把上游异常详情返回给调用方，只保留异常类型便于排查
+        return {"error": f"分析失败({type(error).__name__})，请稍后重试"}
 
 if __name__ == '__main__':
     service = NutritionRAGService()
@@ -0,0 +1,164 @@
+import base64
+import binascii
+import copy
+import hashlib
+import json
+from abc import ABC, abstractmethod
+from typing import Optional
+
+from utils.cache_handler import LRUCache, SQLiteStore
+from utils.logger_handler import logger
+from utils.text_handler import normalize_text
+
+
+class ResultCacheBackend(ABC):
+    # 存取是否涉及磁盘等阻塞 IO，异步调用方据此决定是否放到线程池执行
+    blocking = False
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    def set(self, key: str, value: dict):
+        pass
+
+    @abstractmethod
+    def stats(self) -> dict:
+        pass
+
+
+class MemoryResultCache(ResultCacheBackend):
+    """进程内 LRU + TTL"""
+
+    def __init__(self, max_entries: int = 2048, ttl: Optional[float] = None):
+        self.cache = LRUCache(max_entries=max_entries, ttl=ttl)
+
+    # 存取都做深拷贝，避免调用方修改结果后污染缓存
+    def get(self, key: str) -> Optional[dict]:
+        value = self.cache.get(key)
+        return copy.deepcopy(value) if value is not None else None
+
+    def set(self, key: str, value: dict):
+        self.cache.set(key, copy.deepcopy(value))
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+
+class DiskResultCache(ResultCacheBackend):
+    """SQLite 磁盘存储，多个 worker 进程可共享同一个文件"""
+    blocking = True
+
+    def __init__(self, path: str, max_entries: int = 100000, ttl: Optional[float] = None):
+        self.store = SQLiteStore(path, max_entries=max_entries, ttl=ttl)
+
+    def get(self, key: str) -> Optional[dict]:
+        data = self.store.get(key)
+        return json.loads(data) if data is not None else None
+
+    def set(self, key: str, value: dict):
+        self.store.set(key, json.dumps(value, ensure_ascii=False).encode("utf-8"))
+
+    def stats(self) -> dict:
+        return self.store.stats()
+
+
+def image_content_hash(image_data: str) -> str:
+    """data URL 按解码后的图片字节计算哈希，普通 URL 按地址计算"""
+    if image_data.startswith("data:") and ";base64," in image_data:
+        try:
+            payload = base64.b64decode(image_data.split(";base64,", 1)[1], validate=False)
+            return hashlib.sha256(payload).hexdigest()
+        except (binascii.Error, ValueError):
+            pass
+    return hashlib.sha256(image_data.strip().encode("utf-8")).hexdigest()
+
+
+def request_key(fingerprint: str, user_input: Optional[str] = None, image_data: Optional[str] = None,
+                image_hash: Optional[str] = None) -> Optional[str]:
+    """分析请求的唯一键，结果缓存和在途请求合并共用"""
+    # 与 analyze 保持一致：有图片时只按图片分析，忽略文本
+    if image_hash or image_data:
+        source = f"image:{image_hash or image_content_hash(image_data)}"
+    elif user_input:
+        source = f"text:{normalize_text(user_input)}"
+    else:
+        return None
+    return hashlib.sha256(f"{fingerprint}|{source}".encode("utf-8")).hexdigest()
+
+
+class ResultCache(object):
+    """
+    分析结果缓存：按顺序查询各级后端，命中后回填前面的层
+    键由 request_key 生成，其中的 fingerprint 包含模型名和 prompt 内容哈希，任一变化都会让旧缓存失效
+    """
+
+    def __init__(self, backends: list[ResultCacheBackend]):
+        self.backends = backends
+        self.blocking = any(backend.blocking for backend in backends)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Optional[str]) -> Optional[dict]:
+        if key is None:
+            return None
+        for index, backend in enumerate(self.backends):
+            try:
+                value = backend.get(key)
+            except Exception as e:
+                logger.error("[结果缓存]读取失败：%s", e)
+                continue
+            if value is not None:
+                for upper in self.backends[:index]:
+                    upper.set(key, value)
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def set(self, key: Optional[str], value):
+        # 只缓存成功的结果，业务错误（如识别失败）不缓存
+        if key is None or not isinstance(value, dict) or "error" in value:
+            return
+        for backend in self.backends:
+            try:
+                backend.set(key, value)
+            except Exception as e:
+                logger.error("[结果缓存]写入失败：%s", e)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "backends": {type(backend).__name__: backend.stats() for backend in self.backends},
+        }
+
+
+def build_fingerprint(model_names: list[str], prompt_texts: list[str], extra: Optional[dict] = None) -> str:
+    digest = hashlib.sha256()
+    for name in model_names:
+        digest.update(f"model:{name}\n".encode("utf-8"))
+    for text in prompt_texts:
+        digest.update(hashlib.md5(text.encode("utf-8")).hexdigest().encode("utf-8"))
+    if extra:
+        digest.update(json.dumps(extra, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def create_result_cache(cache_config: dict) -> Optional[ResultCache]:
+    if not cache_config or not cache_config.get('enabled', False):
+        return None
+    ttl = cache_config.get('ttl')
+    backends: list[ResultCacheBackend] = [
+        MemoryResultCache(max_entries=cache_config.get('memory_max_entries', 2048), ttl=ttl)
+    ]
+    if cache_config.get('disk_enabled', False):
+        backends.append(DiskResultCache(
+            cache_config.get('disk_path', 'cache/results.sqlite'),
+            max_entries=cache_config.get('disk_max_entries', 100000),
+            ttl=ttl,
+        ))
+    return ResultCache(backends)
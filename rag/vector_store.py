@@ -1,95 +1,212 @@
-import os.path
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
 import jq
-from langchain_chroma import Chroma
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
-from model.factory import embeddings_factory
+from model.embedding_cache import aembed_queries, embed_queries
+from model.factory import get_embeddings
+from rag.index_generation import publish_generation
+from rag.ingest import KnowledgeIngestor
+from rag.lexical_index import LexicalIndex, documents_from_store, reciprocal_rank_fusion
+from rag.numpy_store import NumpyVectorStore
 from utils.config_handler import chroma_config
-from utils.file_handler import txt_loader, pdf_loader, json_loader, list_dir_with_allowed_type, get_file_md5_hex
 from utils.logger_handler import logger
-from utils.path_tool import get_abs_path
+from utils.metrics_handler import RETRIEVAL_QUERIES, stage
+from utils.timing_handler import startup_timer
 
 
 
 #新增以json格式加载rag文档
 #向量存储、匹配服务
 class VectorStoreService(object):
+    """
+    向量库在第一次检索或导入时才打开（连同词面索引），创建本对象本身不访问磁盘和模型；
+    需要提前打开时调用 open()
+    """
     def __init__(self):
-
-        self.vectors_store=Chroma(
-            collection_name=chroma_config['collection_name'],
-            embedding_function=embeddings_factory,
-            persist_directory=chroma_config['persist_directory'],
-        )
+        self.backend=chroma_config.get('backend','chroma')
         self.spliter=RecursiveCharacterTextSplitter(
             chunk_size=chroma_config['chunk_size'],
             chunk_overlap=chroma_config['chunk_overlap'],
             separators=chroma_config['separators'],
             length_function=len,
         )
+        self._vectors_store:Optional[VectorStore]=None
+        self._open_lock=threading.Lock()
+        #词面 + 向量混合检索
+        self.hybrid_config=chroma_config.get('hybrid') or {}
+        self.lexical_index:Optional[LexicalIndex]=None
+        #批量检索时并行查询向量库的线程池
+        self._search_executor=ThreadPoolExecutor(
+            max_workers=chroma_config.get('retrieval_workers',8),
+            thread_name_prefix="vector-search",
+        )
+
+    @property
+    def embeddings(self)->Embeddings:
+        return get_embeddings()
+
+    @property
+    def vectors_store(self)->VectorStore:
+        if self._vectors_store is None:
+            self.open()
+        return self._vectors_store
+
+    def open(self):
+        """打开向量库并构建词面索引，重复调用无副作用"""
+        if self._vectors_store is not None:
+            return
+        with self._open_lock:
+            if self._vectors_store is not None:
+                return
+            with startup_timer.span(f"vector_store:{self.backend}"):
+                vectors_store=self._create_vectors_store()
+            self._vectors_store=vectors_store
+            with startup_timer.span("lexical_index"):
+                self.rebuild_lexical_index()
+
+    def _create_vectors_store(self)->VectorStore:
+        if self.backend=="numpy":
+            numpy_config=chroma_config.get('numpy_store') or {}
+            return NumpyVectorStore(
+                persist_directory=numpy_config.get('persist_directory','numpy_db'),
+                embedding_function=self.embeddings,
+                quantize=numpy_config.get('quantize',False),
+            )
+        from langchain_chroma import Chroma
+        return Chroma(
+            collection_name=chroma_config['collection_name'],
+            embedding_function=self.embeddings,
+            persist_directory=chroma_config['persist_directory'],
+        )
+
+    def _search_vectors(self,vectors:list[list[float]])->list[list[Document]]:
+        #numpy 后端支持一次矩阵运算完成批量查询，其余后端并行逐个查询
+        if isinstance(self.vectors_store,NumpyVectorStore):
+            return self.vectors_store.similarity_search_by_vectors(vectors,k=chroma_config['k'])
+        return list(self._search_executor.map(
+            lambda vector:self.vectors_store.similarity_search_by_vector(vector,k=chroma_config['k']),
+            vectors,
+        ))
 
     def get_retriever(self):
         return self.vectors_store.as_retriever(search_kwargs={"k": chroma_config['k']})
 
-
-    def load_document(self):
-
-        def check_md5_hex(md5_for_check:str):
-            #无论文件是否存在都会生成一个空文件
-            if not os.path.exists(get_abs_path(chroma_config['md5_hex_store'])):
-                open(get_abs_path(chroma_config['md5_hex_store']), 'w', encoding="utf-8").close()
-                return False
-            with open(get_abs_path(chroma_config['md5_hex_store']), 'r', encoding="utf-8") as f:
-                for line in f.readlines():
-                    line=line.strip()
-                    if line==md5_for_check:
-                        return True
-
-                return False
-        def save_md5_hex(md5_for_save:str):
-            with open(get_abs_path(chroma_config['md5_hex_store']), 'w', encoding="utf-8") as f:
-                f.write(md5_for_save)
-
-        def get_file_document(read_path:str):
-            if read_path.endswith('txt'):
-                return txt_loader(read_path)
-            if read_path.endswith('pdf'):
-                return pdf_loader(read_path)
-            if read_path.endswith('json'):
-                return json_loader(read_path)
-
-            return []
-
-        allowed_files_path = list_dir_with_allowed_type(
-            get_abs_path(chroma_config['data_path']),
-            tuple(chroma_config['allow_knowledge_file_type']),
+    def search_batch(self,queries:list[str])->dict[str,list[Document]]:
+        """
+        批量检索：去重后先查词面索引，置信度足够高的直接返回；
+        其余查询批量向量化（text_type=query），并行查询向量库后与词面结果做 RRF 融合
+        返回 {query: 文档列表}
+        """
+        unique_queries=list(dict.fromkeys(queries))
+        if not unique_queries:
+            return {}
+        self.open()
+        results,lexical,pending=self._lexical_search(unique_queries)
+        if pending:
+            with stage("embedding"):
+                vectors=embed_queries(self.embeddings,pending)
+            with stage("vector_search"):
+                vector_results=self._search_vectors(vectors)
+            results.update(self._fuse(pending,vector_results,lexical))
+        return results
+
+    async def asearch_batch(self,queries:list[str])->dict[str,list[Document]]:
+        """search_batch 的异步版本"""
+        unique_queries=list(dict.fromkeys(queries))
+        if not unique_queries:
+            return {}
+        if self._vectors_store is None:
+            #首次打开向量库可能较慢，放到线程池里执行，不阻塞事件循环
+            await asyncio.get_running_loop().run_in_executor(None,self.open)
+        results,lexical,pending=self._lexical_search(unique_queries)
+        if pending:
+            with stage("embedding"):
+                vectors=await aembed_queries(self.embeddings,pending)
+            with stage("vector_search"):
+                vector_results=await self._asearch_vectors(vectors)
+            results.update(self._fuse(pending,vector_results,lexical))
+        return results
+
+    async def _asearch_vectors(self,vectors:list[list[float]])->list[list[Document]]:
+        loop=asyncio.get_running_loop()
+        if isinstance(self.vectors_store,NumpyVectorStore):
+            return await loop.run_in_executor(self._search_executor,self._search_vectors,vectors)
+        return list(await asyncio.gather(*(
+            loop.run_in_executor(
+                self._search_executor,
+                lambda vector=vector:self.vectors_store.similarity_search_by_vector(vector,k=chroma_config['k']),
+            )
+            for vector in vectors
+        )))
+
+    def _lexical_search(self,queries:list[str]):
+        """返回 (词面高置信度的结果, {query: 词面候选}, 仍需向量检索的 query 列表)"""
+        if self.lexical_index is None or not len(self.lexical_index):
+            RETRIEVAL_QUERIES.inc(len(queries),source="vector")
+            return {},{},list(queries)
+        results={}
+        lexical={}
+        pending=[]
+        with stage("lexical_search"):
+            for query in queries:
+                docs,confidence=self.lexical_index.search(query,k=self.hybrid_config.get('lexical_top_n',10))
+                lexical[query]=docs
+                if docs and confidence>=self.hybrid_config.get('confidence_threshold',0.8):
+                    results[query]=docs[:chroma_config['k']]
+                else:
+                    pending.append(query)
+        if results:
+            RETRIEVAL_QUERIES.inc(len(results),source="lexical")
+        if pending:
+            RETRIEVAL_QUERIES.inc(len(pending),source="vector")
+        return results,lexical,pending
+
+    def _fuse(self,queries:list[str],vector_results:list[list[Document]],lexical:dict)->dict[str,list[Document]]:
+        fused={}
+        for query,docs in zip(queries,vector_results):
+            lexical_docs=lexical.get(query)
+            if lexical_docs:
+                fused[query]=reciprocal_rank_fusion(
+                    [lexical_docs,docs],k=chroma_config['k'],rrf_k=self.hybrid_config.get('rrf_k',60))
+            else:
+                fused[query]=docs
+        return fused
+
+    def rebuild_lexical_index(self):
+        """从向量库中读取全部文档重建词面索引"""
+        if not self.hybrid_config.get('enabled',False):
+            self.lexical_index=None
+            return
+        documents=documents_from_store(self.vectors_store)
+        if documents is None:
+            logger.info("[词面索引]当前向量库后端不支持读取全部文档，跳过")
+            self.lexical_index=None
+            return
+        lexical_index=LexicalIndex(
+            ngram_sizes=tuple(self.hybrid_config.get('ngram_sizes',[1,2])),
+            min_name_length=self.hybrid_config.get('min_name_length',2),
         )
-
-        for path in allowed_files_path:
-            md5_hex = get_file_md5_hex(path)
-            if not md5_hex:
-                logger.error(f"[加载知识库]{path} 计算 MD5 失败，跳过该文件")
-                continue
-            if check_md5_hex(md5_hex):
-                logger.info(f"[加载知识库]{path}内容已存在于知识库内，跳过")
-                continue
-            try:
-                documents:list[Document]=get_file_document(path)
-
-                if not documents:
-                    logger.info(f"[加载知识库]{path}内没有有效文本内容，跳过")
-                    continue
-                split_document:list[Document]=self.spliter.split_documents(documents)
-                if not split_document:
-                    logger.info(f"[加载知识库]{path}分片后没有有效文本内容，跳过")
-                    continue
-                self.vectors_store.add_documents(split_document)
-                save_md5_hex(md5_hex)
-                logger.info(f"[加载知识库]{path}内容加载成功")
-            except Exception as e:
-                logger.error(f"[加载知识库]{path}内容加载失败：{str(e)}",exc_info=True)
-                continue
+        lexical_index.build(documents)
+        self.lexical_index=lexical_index
+        logger.info(f"[词面索引]共索引{len(documents)}个文档")
+
+    def load_document(self)->dict:
+        """
+        增量导入 data_path 下的知识库文件，详见 rag.ingest.KnowledgeIngestor
+        有变化时发布新的索引代数，多进程部署的 worker 会滚动加载
+        """
+        stats=KnowledgeIngestor(self).run()
+        if stats["chunks_added"] or stats["chunks_deleted"]:
+            self.rebuild_lexical_index()
+            stats["generation"]=publish_generation(stats)
+        return stats
 
 if __name__ == '__main__':
     vs=VectorStoreService()
@@ -0,0 +1,339 @@
+import argparse
+import gc
+import os
+import select
+import signal
+import socket
+import time
+from typing import Optional
+
+import uvicorn
+
+import app as app_module
+from rag.index_generation import current_generation
+from utils.config_handler import chroma_config, rag_config
+from utils.metrics_handler import SharedMetrics, enable_shared_metrics
+from utils.logger_handler import logger, stop_logging
+
+
+"""
+多进程部署：python serve.py [--workers N] [--host H] [--port P]
+
+- 主进程绑定端口、加载只读数据（营养表、词面索引、numpy 向量索引、候选菜品词表）后 fork 出 worker，
+  只读数据通过写时复制共享（gc.freeze 避免垃圾回收触碰这些对象导致页面被复制），numpy 向量为 mmap，
+  所有 worker 共享同一份页缓存；worker 共用主进程的监听 socket
+- 结果缓存、向量化缓存的 SQLite 磁盘层作为跨进程共享层，fork 后各 worker 自动重新连接
+- 各 worker 定期把指标快照写到 serve.metrics_dir，/metrics 返回所有 worker 的汇总
+- 知识库导入在单独的进程中执行（python -m rag.ingest / python -m rag.bulk_import），完成后递增索引代数；
+  主进程发现代数变化（或收到 SIGHUP）后重新加载只读数据，逐个启动新 worker、等其开始接收请求后再让旧 worker
+  处理完在途请求退出，替换过程中始终有 worker 在接收请求
+- worker 意外退出时自动补齐；SIGTERM / SIGINT 让所有 worker 处理完在途请求后退出
+- 向量库需使用 numpy 后端；chroma 后端下默认拒绝以多进程启动（见 rag.yml 中 serve.allow_chroma）
+"""
+def default_workers() -> int:
+    # 容器中按 CPU 亲和性（cpuset）计算可用核数
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def check_vector_backend(workers: int, config: dict) -> bool:
+    """
+    chroma 后端下每个 worker 各自打开 Chroma 客户端，HNSW 索引在每个进程里各占一份内存，
+    fork 也无法共享；多进程部署默认拒绝，allow_chroma 为 true 时只警告
+    """
+    backend = chroma_config.get('backend', 'chroma')
+    if workers <= 1 or backend == 'numpy':
+        return True
+    message = (f"[多进程]向量库后端为 {backend}，{workers} 个 worker 将各自打开一份向量库客户端和索引，"
+               f"内存占用随 worker 数成倍增加")
+    if config.get('allow_chroma', False):
+        logger.warning("%s（rag.yml 中 serve.allow_chroma 为 true，继续启动）", message)
+        return True
+    logger.error("%s。可选处理方式：1) 在 config/chroma.yml 中设置 backend: numpy，执行 python -m rag.ingest 导入知识库后重新启动；"
+                 "2) 以单进程运行：python serve.py --workers 1；"
+                 "3) 在 config/rag.yml 中设置 serve.allow_chroma: true 强制以多进程启动", message)
+    return False
+
+
+def enable_shared_caches():
+    """结果缓存加上 SQLite 磁盘层，各 worker 通过它共享分析结果"""
+    cache_config = rag_config.get('result_cache') or {}
+    if cache_config.get('enabled', False):
+        rag_config['result_cache'] = {**cache_config, "disk_enabled": True}
+
+
+class _DrainMiddleware(object):
+    """排空阶段继续处理请求，但响应带上 Connection: close，客户端不再复用连到这个 worker 的长连接"""
+
+    def __init__(self, app):
+        self.app = app
+        self.draining = False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        async def send_with_close(message):
+            if self.draining and message["type"] == "http.response.start":
+                message = {**message, "headers": [*message.get("headers", []), (b"connection", b"close")]}
+            await send(message)
+
+        await self.app(scope, receive, send_with_close)
+
+
+class _WorkerServer(uvicorn.Server):
+    """
+    开始接收请求后通过管道通知主进程；收到 SIGTERM 后先排空 drain_seconds 秒再按 uvicorn 的流程停止，
+    避免客户端在长连接被关闭的瞬间发出请求而失败
+    """
+
+    def __init__(self, config: uvicorn.Config, ready_fd: int, drain: _DrainMiddleware, drain_seconds: float):
+        super().__init__(config)
+        self.ready_fd = ready_fd
+        self.master_pid = os.getppid()
+        self.drain = drain
+        self.drain_seconds = drain_seconds
+        self._drain_until: Optional[float] = None
+
+    def handle_exit(self, sig: int, frame) -> None:
+        if sig == signal.SIGTERM and self.drain_seconds > 0 and self._drain_until is None and self.started:
+            self.drain.draining = True
+            self._drain_until = time.monotonic() + self.drain_seconds
+            return
+        super().handle_exit(sig, frame)
+
+    async def on_tick(self, counter: int) -> bool:
+        if self._drain_until is not None and time.monotonic() >= self._drain_until:
+            self.should_exit = True
+        # 主进程被强制结束（kill -9）时 worker 不再有人管理，随之退出
+        if counter % 10 == 0 and os.getppid() != self.master_pid:
+            logger.warning("[多进程]主进程已退出，worker %d 停止", os.getpid())
+            self.should_exit = True
+        return await super().on_tick(counter)
+
+    async def startup(self, sockets: Optional[list[socket.socket]] = None) -> None:
+        await super().startup(sockets=sockets)
+        if self.started:
+            os.write(self.ready_fd, b"1")
+        os.close(self.ready_fd)
+        self.ready_fd = -1
+
+
+class Supervisor(object):
+    def __init__(self, host: str, port: int, workers: int, config: dict):
+        self.host = host
+        self.port = port
+        self.worker_count = workers
+        self.generation_poll = config.get('generation_poll', 5)
+        self.ready_timeout = config.get('ready_timeout', 60)
+        self.graceful_timeout = config.get('graceful_timeout', 30)
+        self.drain_seconds = config.get('drain_seconds', 2)
+        self.socket: Optional[socket.socket] = None
+        # worker 进程号 -> fork 该 worker 时主进程数据的加载批次；批次落后的 worker 在重新加载时被替换
+        self.workers: dict[int, int] = {}
+        self.epoch = 0
+        self.generation = 0
+        self._failed_generation: Optional[int] = None
+        self.metrics: Optional[SharedMetrics] = None
+        if config.get('metrics_dir'):
+            self.metrics = enable_shared_metrics(config['metrics_dir'], config.get('metrics_interval', 5))
+        self._should_exit = False
+        self._reload_requested = False
+
+    def _bind(self) -> socket.socket:
+        family = socket.AF_INET6 if ":" in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(2048)
+        return sock
+
+    def _preload(self):
+        # 旧 service 的对象在 unfreeze 后才能被回收；新的只读数据加载完成后重新冻结
+        gc.unfreeze()
+        result = app_module.preload_service()
+        gc.collect()
+        gc.freeze()
+        self.epoch += 1
+        self.generation = result["generation"]
+        if self.metrics is not None:
+            # 加载过程中的计数（如预热时的缓存查询）记在主进程的快照中
+            self.metrics.write()
+        logger.info("[多进程]已加载第%d代索引：%s", self.generation, result["timings"])
+
+    def _run_worker(self, ready_fd: int):
+        # 在 uvicorn 接管之前忽略退出信号：uvicorn 退出时会恢复原处理函数并重新发出捕获到的信号，
+        # 忽略后 run() 能正常返回，留出写完日志的机会
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(sig, signal.SIG_IGN)
+        drain = _DrainMiddleware(app_module.app)
+        config = uvicorn.Config(drain, lifespan="on", timeout_graceful_shutdown=self.graceful_timeout)
+        if self.metrics is not None:
+            self.metrics.start()
+        try:
+            _WorkerServer(config, ready_fd, drain, self.drain_seconds).run(sockets=[self.socket])
+        finally:
+            if self.metrics is not None:
+                self.metrics.stop()
+
+    def spawn(self) -> Optional[int]:
+        """fork 一个 worker 并等待它开始接收请求；就绪失败时结束该进程并返回 None"""
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            code = 1
+            try:
+                self._run_worker(write_fd)
+                code = 0
+            except BaseException:
+                logger.error("[多进程]worker 异常退出", exc_info=True)
+            finally:
+                stop_logging()
+                os._exit(code)
+        os.close(write_fd)
+        try:
+            readable, _, _ = select.select([read_fd], [], [], self.ready_timeout)
+            ready = bool(readable) and os.read(read_fd, 1) == b"1"
+        finally:
+            os.close(read_fd)
+        if not ready:
+            logger.error("[多进程]worker %d 未能在 %ss 内就绪", pid, self.ready_timeout)
+            self._stop_worker(pid, graceful=False)
+            return None
+        self.workers[pid] = self.epoch
+        logger.info("[多进程]worker %d 已就绪（第%d代索引）", pid, self.generation)
+        return pid
+
+    def _wait(self, pid: int, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                finished, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                return True
+            if finished:
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.1)
+
+    def _stop_worker(self, pid: int, graceful: bool = True):
+        self.workers.pop(pid, None)
+        try:
+            os.kill(pid, signal.SIGTERM if graceful else signal.SIGKILL)
+        except ProcessLookupError:
+            return
+        if not self._wait(pid, self.drain_seconds + self.graceful_timeout + 5 if graceful else 5):
+            logger.warning("[多进程]worker %d 未在 %ss 内退出，强制结束", pid, self.graceful_timeout)
+            os.kill(pid, signal.SIGKILL)
+            self._wait(pid, 5)
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            if self.workers.pop(pid, None) is not None:
+                logger.error("[多进程]worker %d 意外退出（%s），重新启动", pid, os.waitstatus_to_exitcode(status))
+
+    def reload(self):
+        """重新加载只读数据后逐个替换 worker：新 worker 就绪后旧 worker 才退出"""
+        previous = self.generation
+        try:
+            self._preload()
+        except Exception:
+            self._failed_generation = current_generation()
+            logger.error("[多进程]加载第%d代索引失败，继续使用第%d代", self._failed_generation, previous,
+                         exc_info=True)
+            return
+        self._failed_generation = None
+        for old_pid in [pid for pid, epoch in self.workers.items() if epoch != self.epoch]:
+            if self._should_exit:
+                return
+            if self.spawn() is None:
+                logger.error("[多进程]新 worker 启动失败，停止替换，其余 worker 继续使用旧索引")
+                return
+            self._stop_worker(old_pid)
+        logger.info("[多进程]已全部切换到第%d代索引", self.generation)
+
+    def _generation_changed(self) -> bool:
+        generation = current_generation()
+        return generation != self.generation and generation != self._failed_generation
+
+    def _handle_exit(self, sig, frame):
+        self._should_exit = True
+
+    def _handle_reload(self, sig, frame):
+        self._reload_requested = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_exit)
+        signal.signal(signal.SIGINT, self._handle_exit)
+        signal.signal(signal.SIGHUP, self._handle_reload)
+        self.socket = self._bind()
+        if self.metrics is not None:
+            # 上一次运行留下的快照不计入本次的汇总
+            self.metrics.clear()
+        self._preload()
+        logger.info("[多进程]监听 %s:%d，启动 %d 个 worker", self.host, self.port, self.worker_count)
+        next_poll = time.monotonic() + self.generation_poll
+        try:
+            while not self._should_exit:
+                self._reap()
+                if len(self.workers) < self.worker_count and self.spawn() is None:
+                    time.sleep(1)
+                    continue
+                if self._reload_requested or (time.monotonic() >= next_poll and self._generation_changed()):
+                    self._reload_requested = False
+                    self.reload()
+                if time.monotonic() >= next_poll:
+                    next_poll = time.monotonic() + self.generation_poll
+                time.sleep(0.2)
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        logger.info("[多进程]停止 %d 个 worker", len(self.workers))
+        pids = list(self.workers)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + self.drain_seconds + self.graceful_timeout + 5
+        for pid in pids:
+            if not self._wait(pid, max(0.0, deadline - time.monotonic())):
+                os.kill(pid, signal.SIGKILL)
+                self._wait(pid, 5)
+        self.workers.clear()
+        if self.socket is not None:
+            self.socket.close()
+
+
+def main():
+    serve_config = rag_config.get('serve') or {}
+    parser = argparse.ArgumentParser(description="多进程部署营养分析服务")
+    parser.add_argument("--host", default=serve_config.get('host', '0.0.0.0'))
+    parser.add_argument("--port", type=int, default=serve_config.get('port', 8000))
+    parser.add_argument("--workers", type=int, default=serve_config.get('workers', 0),
+                        help="worker 进程数，0 表示使用全部可用 CPU 核")
+    args = parser.parse_args()
+
+    workers = args.workers or default_workers()
+    if workers <= 1 or not hasattr(os, "fork"):
+        uvicorn.run(app_module.app, host=args.host, port=args.port)
+        return
+    if not check_vector_backend(workers, serve_config):
+        raise SystemExit(1)
+    if serve_config.get('shared_cache', True):
+        enable_shared_caches()
+    Supervisor(args.host, args.port, workers, serve_config).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_models import FakeChatModel, FakeEmbeddings  # noqa: E402
+from model import factory  # noqa: E402
+from utils.config_handler import chroma_config, rag_config  # noqa: E402
+
+
+"""
+测试使用 benchmarks/fake_models.py 中的本地假模型，所有持久化路径指向 pytest 的临时目录，
+不访问网络，也不会改动项目内的向量库、缓存和检查点
+"""
+@pytest.fixture
+def embeddings():
+    return FakeEmbeddings(size=16, latency=0)
+
+
+@pytest.fixture
+def isolated_config(tmp_path, monkeypatch):
+    """向量库（numpy 后端）、清单、索引代数、导入检查点和缓存全部放到临时目录，测试结束后恢复配置"""
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    monkeypatch.setitem(chroma_config, 'backend', "numpy")
+    monkeypatch.setitem(chroma_config, 'data_path', str(data_dir))
+    monkeypatch.setitem(chroma_config, 'manifest_store', str(tmp_path / "manifest.json"))
+    monkeypatch.setitem(chroma_config, 'generation_file', str(tmp_path / "index_generation.json"))
+    monkeypatch.setitem(chroma_config, 'numpy_store', {
+        **(chroma_config.get('numpy_store') or {}), "persist_directory": str(tmp_path / "numpy_db"),
+    })
+    monkeypatch.setitem(chroma_config, 'bulk_import', {
+        **(chroma_config.get('bulk_import') or {}), "checkpoint_dir": str(tmp_path / "checkpoints"),
+    })
+    monkeypatch.setitem(rag_config, 'embedding_cache', {
+        **(rag_config.get('embedding_cache') or {}), "disk_path": None,
+    })
+    monkeypatch.setitem(rag_config, 'result_cache', {
+        **(rag_config.get('result_cache') or {}), "enabled": False, "disk_enabled": False,
+    })
+    monkeypatch.setitem(rag_config, 'warmup', {**(rag_config.get('warmup') or {}), "on_startup": False})
+    return tmp_path
+
+
+@pytest.fixture
+def fake_models(monkeypatch, embeddings):
+    """替换模型客户端，测试结束后恢复"""
+    models = {
+        "version": FakeChatModel(latency=0),
+        "kcal": FakeChatModel(latency=0),
+        "embeddings": embeddings,
+    }
+    for key, model in models.items():
+        monkeypatch.setitem(factory._models, key, model)
+    return models
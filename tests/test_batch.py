@@ -0,0 +1,69 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app as app_module
+from utils.config_handler import rag_config
+
+
+@pytest.fixture
+def client(isolated_config, fake_models, monkeypatch):
+    # 每个测试使用新的 service（读取临时目录中的营养表和向量库）
+    monkeypatch.setattr(app_module, "_service", None)
+    monkeypatch.setitem(rag_config, 'image', {**(rag_config.get('image') or {}), "max_upload_mb": 1})
+    return TestClient(app_module.app)
+
+
+def test_bad_images_fail_only_their_own_items(client):
+    oversized = "data:image/png;base64," + "A" * (2 * 1024 * 1024)
+    response = client.post("/analyze_batch", json={"items": [
+        {"text": "一份米饭"},
+        {"image_url": oversized},
+        {"text": "一份宫保鸡丁"},
+    ]})
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["index"] for result in results] == [0, 1, 2]
+    assert results[0]["error"] is None and results[0]["result"]["total_calories"] > 0
+    assert "1MB" in results[1]["error"] and results[1]["result"] is None
+    assert results[2]["error"] is None and results[2]["result"]["items"]
+
+
+def test_invalid_model_output_fails_only_its_own_item(client, fake_models, monkeypatch):
+    fake_models["kcal"].dish_names = ["神秘菜", "米饭"]
+    service = app_module.get_service()
+    mark_llm = service._mark_llm
+
+    def broken_for_mystery_dish(result):
+        if any(item.get("name") == "神秘菜" for item in result.get("items", [])):
+            return {"items": [], "total_calories": "很多"}
+        return mark_llm(result)
+
+    monkeypatch.setattr(service, "_mark_llm", broken_for_mystery_dish)
+    response = client.post("/analyze_batch", json={"items": [{"text": "一份神秘菜"}, {"text": "一份米饭"}]})
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert results[0]["result"] is None and results[0]["error"]
+    assert results[1]["error"] is None and results[1]["result"]["items"][0]["name"] == "米饭"
+
+
+@pytest.mark.parametrize("max_concurrency", [0, -1, 1000])
+def test_max_concurrency_is_bounded(client, max_concurrency):
+    response = client.post("/analyze_batch", json={"items": [{"text": "米饭"}], "max_concurrency": max_concurrency})
+    assert response.status_code == 422
+
+
+def test_batch_body_limit_is_explicit(client, monkeypatch):
+    monkeypatch.setitem(rag_config, 'batch', {**(rag_config.get('batch') or {}), "max_body_mb": 1})
+    body = json.dumps({"items": [{"text": "米饭" * (300 * 1024)}]}).encode()
+    response = client.post("/analyze_batch", content=body, headers={"Content-Type": "application/json"})
+    assert response.status_code == 413
+
+
+def test_batch_rejects_chunked_body(client):
+    def chunks():
+        yield json.dumps({"items": [{"text": "米饭"}]}).encode()
+
+    response = client.post("/analyze_batch", content=chunks(), headers={"Content-Type": "application/json"})
+    assert response.status_code == 411
@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+from rag.bulk_import import BulkImporter, ImportCheckpoint, imported_files, iter_records
+from rag.index_generation import current_generation
+from rag.nutrition_index import NutritionIndex
+from rag.numpy_store import NumpyVectorStore
+
+
+class FlakyStore(object):
+    """第 fail_on_batch 批写入时抛出异常，模拟导入进程中途崩溃"""
+
+    def __init__(self, store: NumpyVectorStore, fail_on_batch: int):
+        self.store = store
+        self.fail_on_batch = fail_on_batch
+        self.batches = 0
+
+    def add_documents(self, documents, ids):
+        self.batches += 1
+        if self.batches == self.fail_on_batch:
+            raise RuntimeError("向量库写入失败")
+        return self.store.add_documents(documents, ids=ids)
+
+
+def write_jsonl(path, rows: int):
+    with open(path, "w", encoding="utf-8") as f:
+        for row in range(rows):
+            f.write(json.dumps({"name": f"菜品{row}", "calories": row}, ensure_ascii=False) + "\n")
+
+
+def test_resume_from_checkpoint(isolated_config, embeddings):
+    path = isolated_config / "dishes.jsonl"
+    write_jsonl(path, 50)
+    store = NumpyVectorStore(str(isolated_config / "numpy_db"), embeddings)
+
+    with pytest.raises(RuntimeError):
+        BulkImporter(FlakyStore(store, fail_on_batch=3), batch_size=10, workers=1).run(str(path))
+    assert len(store) == 20
+    assert current_generation() == 0
+
+    stats = BulkImporter(store, batch_size=10, workers=1).run(str(path))
+    assert stats["rows_skipped"] == 20
+    assert stats["rows_imported"] == 30
+    assert len(store) == 50
+    assert current_generation() == 1
+
+    # 内容未变化时整份跳过
+    assert BulkImporter(store, batch_size=10, workers=1).run(str(path))["rows_imported"] == 0
+    assert str(path) in imported_files()
+
+
+def test_changed_file_invalidates_checkpoint(isolated_config):
+    checkpoint = ImportCheckpoint(str(isolated_config / "checkpoints"), "dishes.jsonl")
+    checkpoint.save("md5-old", 20)
+    assert checkpoint.load("md5-old") == (20, False)
+    assert checkpoint.load("md5-new") == (0, False)
+
+
+def test_imported_records_reach_nutrition_index(isolated_config, embeddings):
+    path = isolated_config / "dishes.jsonl"
+    write_jsonl(path, 5)
+    BulkImporter(NumpyVectorStore(str(isolated_config / "numpy_db"), embeddings), batch_size=2).run(str(path))
+    index = NutritionIndex()
+    index.load()
+    assert index.lookup("菜品3") == {"name": "菜品3", "calories": 3}
+
+
+def test_malformed_json_array_stops_at_record_limit(tmp_path):
+    path = tmp_path / "broken.json"
+    path.write_text('[{"name": "米饭"}, {"name": "没有结束' + "x" * 5000, encoding="utf-8")
+    records = iter_records(str(path), max_record_chars=1000)
+    assert next(records) == {"name": "米饭"}
+    with pytest.raises(ValueError, match="第2条记录"):
+        next(records)
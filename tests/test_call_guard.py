@@ -0,0 +1,171 @@
+import asyncio
+import time
+
+import pytest
+from langchain_core.exceptions import OutputParserException
+
+from model.call_guard import CircuitBreaker, ModelGuard, ModelTimeoutError, ModelUnavailableError
+
+
+def make_guard(**config) -> ModelGuard:
+    config = {"parse_retries": 0, "circuit_breaker": {"failure_threshold": 2, "open_seconds": 0.05}, **config}
+    return ModelGuard("fake", 2, config)
+
+
+async def fail():
+    raise RuntimeError("upstream error")
+
+
+async def succeed():
+    return "ok"
+
+
+async def fail_times(guard: ModelGuard, times: int):
+    for _ in range(times):
+        with pytest.raises(RuntimeError):
+            await guard.call("stage", fail)
+
+
+def test_breaker_closed_open_half_open_closed():
+    breaker = CircuitBreaker(failure_threshold=2, open_seconds=0.05)
+    assert breaker.state == "closed"
+    assert breaker.record_failure() is False
+    assert breaker.record_failure() is True
+    assert breaker.state == "open"
+    assert breaker.acquire() is None
+
+    time.sleep(0.06)
+    assert breaker.state == "half_open"
+    assert breaker.acquire() == "probe"
+    # 探测结果出来之前其余请求被拒绝
+    assert breaker.acquire() is None
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.acquire() == "closed"
+
+
+def test_failed_probe_reopens():
+    breaker = CircuitBreaker(failure_threshold=1, open_seconds=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.acquire() == "probe"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert breaker.acquire() is None
+
+
+def test_guard_short_circuits_after_failures_and_recovers():
+    async def main():
+        guard = make_guard()
+        await fail_times(guard, 2)
+        with pytest.raises(ModelUnavailableError):
+            await guard.call("stage", succeed)
+        await asyncio.sleep(0.06)
+        assert await guard.call("stage", succeed) == "ok"
+        assert guard.breaker.state == "closed"
+
+    asyncio.run(main())
+
+
+def test_probe_resolved_when_parse_fails():
+    async def main():
+        guard = make_guard()
+        await fail_times(guard, 2)
+        await asyncio.sleep(0.06)
+
+        async def unparsable():
+            raise OutputParserException("bad json")
+
+        with pytest.raises(OutputParserException):
+            await guard.call("stage", unparsable)
+        # 解析失败说明上游可用，熔断关闭
+        assert guard.breaker.state == "closed"
+
+    asyncio.run(main())
+
+
+def test_cancelled_probe_lets_next_request_probe():
+    async def main():
+        guard = make_guard()
+        await fail_times(guard, 2)
+        await asyncio.sleep(0.06)
+
+        async def hang():
+            await asyncio.sleep(10)
+
+        probe = asyncio.ensure_future(guard.call("stage", hang))
+        await asyncio.sleep(0.01)
+        with pytest.raises(ModelUnavailableError):
+            await guard.call("stage", succeed)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        assert await guard.call("stage", succeed) == "ok"
+
+    asyncio.run(main())
+
+
+def test_timeout_counts_as_failure():
+    async def main():
+        guard = make_guard(deadlines={"stage": 0.01})
+
+        async def slow():
+            await asyncio.sleep(1)
+
+        for _ in range(2):
+            with pytest.raises(ModelTimeoutError):
+                await guard.call("stage", slow)
+        assert guard.breaker.state == "open"
+
+    asyncio.run(main())
+
+
+def test_stream_releases_slot_when_upstream_ends():
+    async def main():
+        guard = make_guard()
+
+        async def upstream():
+            for chunk in ("a", "b", "c"):
+                yield chunk
+
+        received = []
+        in_flight = []
+        async for chunk in guard.stream("stage", upstream):
+            received.append(chunk)
+            # 下游消费得慢：上游已经结束，名额应已释放
+            await asyncio.sleep(0.01)
+            in_flight.append(guard.stats()["in_flight"])
+        assert received == ["a", "b", "c"]
+        assert in_flight[-1] == 0
+        assert guard.semaphore._value == guard.max_concurrency
+
+    asyncio.run(main())
+
+
+def test_stream_error_after_chunks_and_early_close_release_slot():
+    async def main():
+        guard = make_guard()
+
+        async def broken():
+            yield "a"
+            raise RuntimeError("upstream error")
+
+        received = []
+        with pytest.raises(RuntimeError):
+            async for chunk in guard.stream("stage", broken):
+                received.append(chunk)
+        assert received == ["a"]
+
+        async def endless():
+            while True:
+                yield "x"
+                await asyncio.sleep(0)
+
+        stream = guard.stream("stage", endless)
+        async for _ in stream:
+            break
+        await stream.aclose()
+        assert guard.stats()["in_flight"] == 0
+        assert guard.semaphore._value == guard.max_concurrency
+
+    asyncio.run(main())
@@ -0,0 +1,43 @@
+import asyncio
+
+import pytest
+
+from model import dashscope_embeddings
+from model.dashscope_embeddings import DashScopeQueryEmbeddings
+from model.embedding_cache import CachedEmbeddings, aembed_queries, embed_queries
+
+
+@pytest.fixture
+def upstream_calls(monkeypatch):
+    """替换 DashScope 的请求函数，记录每次请求的输入和 text_type"""
+    calls = []
+
+    def fake_embed_with_retry(embeddings, input, text_type, model):
+        calls.append((list(input), text_type))
+        return [{"embedding": [float(len(text)), 1.0]} for text in input]
+
+    monkeypatch.setattr(dashscope_embeddings, "embed_with_retry", fake_embed_with_retry)
+    return calls
+
+
+@pytest.fixture
+def dashscope():
+    return DashScopeQueryEmbeddings(dashscope_api_key="test-key", model="text-embedding-v4")
+
+
+def test_sync_batch_is_one_query_call(dashscope, upstream_calls):
+    assert len(embed_queries(dashscope, ["a", "bb", "ccc"])) == 3
+    assert upstream_calls == [(["a", "bb", "ccc"], "query")]
+
+
+def test_async_batch_is_one_query_call(dashscope, upstream_calls):
+    vectors = asyncio.run(aembed_queries(dashscope, ["a", "bb", "ccc"]))
+    assert vectors == [[1.0, 1.0], [2.0, 1.0], [3.0, 1.0]]
+    assert upstream_calls == [(["a", "bb", "ccc"], "query")]
+
+
+def test_cached_async_batch_sends_only_misses_in_one_call(dashscope, upstream_calls):
+    cached = CachedEmbeddings(dashscope, "text-embedding-v4")
+    cached.embed_query("a")
+    asyncio.run(cached.aembed_queries(["a", "bb", "ccc"]))
+    assert upstream_calls == [(["a"], "query"), (["bb", "ccc"], "query")]
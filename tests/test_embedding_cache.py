@@ -0,0 +1,91 @@
+import asyncio
+import threading
+
+from model.embedding_cache import CachedEmbeddings
+from utils.cache_handler import LRUCache, SQLiteStore
+
+
+def test_key_contains_model_text_type_and_normalized_text(embeddings):
+    cached = CachedEmbeddings(embeddings, "text-embedding-v4")
+    assert cached._key(" 宫保鸡丁 ") == cached._key("宫保鸡丁")
+    assert cached._key("宫保鸡丁").startswith("text-embedding-v4:query:")
+    assert CachedEmbeddings(embeddings, "other-model")._key("宫保鸡丁") != cached._key("宫保鸡丁")
+
+
+def test_queries_are_cached_and_deduplicated(embeddings):
+    cached = CachedEmbeddings(embeddings, "m")
+    first = cached.embed_queries(["米饭", "米饭", "宫保鸡丁"])
+    assert embeddings.texts == 2
+    assert first[0] == first[1]
+
+    again = cached.embed_query("米饭")
+    assert embeddings.texts == 2
+    assert again == first[0]
+
+    asyncio.run(cached.aembed_queries(["宫保鸡丁", "清炒时蔬"]))
+    assert embeddings.texts == 3
+
+
+def test_documents_bypass_cache(embeddings):
+    cached = CachedEmbeddings(embeddings, "m")
+    cached.embed_documents(["米饭"])
+    cached.embed_documents(["米饭"])
+    assert embeddings.texts == 2
+    assert len(cached.memory) == 0
+
+    # 文档向量化的结果不会被当作查询向量返回
+    cached.embed_query("米饭")
+    assert embeddings.texts == 3
+
+
+def test_disk_layer_survives_new_instance(embeddings, tmp_path):
+    path = str(tmp_path / "embeddings.sqlite")
+    vector = CachedEmbeddings(embeddings, "m", disk_path=path).embed_query("米饭")
+    reopened = CachedEmbeddings(embeddings, "m", disk_path=path)
+    assert reopened.embed_query("米饭") == vector
+    assert embeddings.texts == 1
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_sqlite_store_evicts_by_access_time(tmp_path, monkeypatch):
+    monkeypatch.setattr(SQLiteStore, "EVICT_CHECK_INTERVAL", 1)
+    store = SQLiteStore(str(tmp_path / "store.sqlite"), max_entries=2)
+    store.set("a", b"1")
+    store.set("b", b"2")
+    assert store.get("a") == b"1"
+    store.set("c", b"3")
+    assert store.get("b") is None
+    assert store.get_many(["a", "c"]) == {"a": b"1", "c": b"3"}
+
+
+def test_async_disk_access_runs_off_event_loop(embeddings, tmp_path):
+    cached = CachedEmbeddings(embeddings, "m", disk_path=str(tmp_path / "embeddings.sqlite"))
+    threads = []
+    for name in ("get_many", "set_many"):
+        method = getattr(cached.disk, name)
+
+        def record(*args, _method=method, _name=name):
+            threads.append((_name, threading.get_ident()))
+            return _method(*args)
+        setattr(cached.disk, name, record)
+
+    async def run():
+        await cached.aembed_queries(["米饭"])
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(run())
+    assert [name for name, _ in threads] == ["get_many", "set_many"]
+    assert all(ident != loop_thread for _, ident in threads)
+    # 磁盘层已写入，新实例直接命中
+    assert CachedEmbeddings(embeddings, "m", disk_path=str(tmp_path / "embeddings.sqlite")).embed_query("米饭")
+    assert embeddings.texts == 1
@@ -0,0 +1,32 @@
+import json
+import shutil
+
+from rag.vector_store import VectorStoreService
+from utils.config_handler import chroma_config
+
+
+def write_dishes(data_dir, names: list[str]):
+    records = [{"name": name, "calories": 100} for name in names]
+    with open(data_dir / "dishes.json", "w", encoding="utf-8") as f:
+        json.dump(records, f, ensure_ascii=False)
+
+
+def test_unchanged_file_is_skipped(isolated_config, fake_models):
+    write_dishes(isolated_config / "data", ["米饭", "宫保鸡丁"])
+    first = VectorStoreService().load_document()
+    assert first["files_changed"] == 1 and first["chunks_added"] > 0
+
+    second = VectorStoreService().load_document()
+    assert second["files_skipped"] == 1 and second["chunks_added"] == 0
+
+
+def test_wiped_store_is_reingested_despite_manifest(isolated_config, fake_models):
+    write_dishes(isolated_config / "data", ["米饭", "宫保鸡丁"])
+    added = VectorStoreService().load_document()["chunks_added"]
+
+    shutil.rmtree(chroma_config['numpy_store']['persist_directory'])
+    service = VectorStoreService()
+    stats = service.load_document()
+    assert stats["files_skipped"] == 0
+    assert stats["chunks_added"] == added
+    assert len(service.vectors_store.get()["ids"]) == added
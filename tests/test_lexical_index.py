@@ -0,0 +1,37 @@
+import json
+
+from langchain_core.documents import Document
+
+from rag.lexical_index import LexicalIndex
+
+
+def record(name: str) -> Document:
+    return Document(page_content=json.dumps({"name": name, "kcal_per_100g": 100}, ensure_ascii=False))
+
+
+def build(*names: str, **kwargs) -> LexicalIndex:
+    index = LexicalIndex(**kwargs)
+    index.build([record(name) for name in names])
+    return index
+
+
+def test_full_name_inside_query_is_confident():
+    docs, confidence = build("宫保鸡丁", "米饭").search("宫保鸡丁盖饭")
+    assert json.loads(docs[0].page_content)["name"] == "宫保鸡丁"
+    assert confidence >= 0.8
+
+
+def test_single_character_name_needs_exact_match():
+    # 只用单字 gram 时，"面" 对 "面包" 的覆盖率足以越过阈值
+    index = build("面", "米饭", ngram_sizes=(1,))
+    docs, confidence = index.search("面包")
+    assert json.loads(docs[0].page_content)["name"] == "面"
+    assert confidence == 0.0
+
+    _, confidence = index.search(" 面 ")
+    assert confidence == 1.0
+
+
+def test_min_name_length_is_configurable():
+    _, confidence = build("面", ngram_sizes=(1,), min_name_length=1).search("面条")
+    assert confidence >= 0.8
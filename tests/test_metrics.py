@@ -0,0 +1,49 @@
+import json
+import os
+
+import pytest
+
+from utils.metrics_handler import ERRORS, STAGE_SECONDS, SharedMetrics, registry
+
+
+@pytest.fixture
+def clean_registry():
+    registry.reset()
+    yield registry
+    registry.reset()
+
+
+def sample(text: str, prefix: str) -> float:
+    return next(float(line.rsplit(" ", 1)[1]) for line in text.splitlines() if line.startswith(prefix))
+
+
+def test_shared_metrics_sum_all_worker_snapshots(clean_registry, tmp_path):
+    metrics = SharedMetrics(str(tmp_path / "metrics"))
+    metrics.clear()
+    ERRORS.inc(stage="step1", error_type="Timeout")
+    STAGE_SECONDS.observe(0.2, stage="step1", status="ok")
+    # 另一个 worker 的快照：同样的计数再来一份
+    with open(os.path.join(metrics.directory, "1.json"), "w", encoding="utf-8") as f:
+        json.dump(registry.snapshot(), f)
+    ERRORS.inc(stage="step1", error_type="Timeout")
+
+    text = metrics.render()
+    assert sample(text, 'nutrition_errors_total{stage="step1",error_type="Timeout"}') == 3
+    assert sample(text, 'nutrition_stage_seconds_count{stage="step1",status="ok"}') == 2
+    assert sample(text, 'nutrition_stage_seconds_bucket{stage="step1",status="ok",le="0.25"}') == 2
+    # 本进程的计数不受汇总影响
+    assert ERRORS.value(stage="step1", error_type="Timeout") == 2
+
+
+def test_worker_starts_from_zero_and_keeps_final_snapshot(clean_registry, tmp_path):
+    metrics = SharedMetrics(str(tmp_path / "metrics"), interval=60)
+    metrics.clear()
+    ERRORS.inc(stage="preload", error_type="OSError")
+    metrics.start()
+    assert ERRORS.value(stage="preload", error_type="OSError") == 0
+    ERRORS.inc(stage="step1", error_type="Timeout")
+    metrics.stop()
+
+    with open(os.path.join(metrics.directory, f"{os.getpid()}.json"), encoding="utf-8") as f:
+        snapshot = json.load(f)
+    assert snapshot["nutrition_errors_total"] == [[["step1", "Timeout"], 1.0]]
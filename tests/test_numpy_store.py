@@ -0,0 +1,86 @@
+import json
+import os
+
+import pytest
+
+from rag.numpy_store import NumpyVectorStore
+
+
+@pytest.fixture(params=[False, True], ids=["float32", "int8"])
+def store(request, tmp_path, embeddings):
+    return NumpyVectorStore(str(tmp_path / "numpy_db"), embeddings, quantize=request.param)
+
+
+def add_batches(store: NumpyVectorStore, batches: int, start: int = 0, size: int = 4):
+    for batch in range(start, start + batches):
+        texts = [f"菜品{batch}-{row}" for row in range(size)]
+        store.add_texts(texts, metadatas=[{"batch": batch} for _ in texts], ids=texts)
+
+
+def test_add_and_search(store):
+    add_batches(store, 3)
+    assert len(store) == 12
+    assert store.similarity_search("菜品1-2", k=1)[0].page_content == "菜品1-2"
+    hits = store.similarity_search_by_vectors([store.embeddings.embed_query("菜品2-0")], k=2)[0]
+    assert hits[0].id == "菜品2-0"
+    assert len(hits) == 2
+
+
+def test_adds_are_append_only_and_segments_merge(store):
+    add_batches(store, 8)
+    # 大小相同的段逐级合并，8 批合并为 1 个段
+    assert len(store._index.segments) == 1
+    add_batches(store, 1, start=8)
+    assert [segment.live_rows for segment in store._index.segments] == [32, 4]
+
+
+def test_same_id_updates_and_delete(store):
+    add_batches(store, 2)
+    store.add_texts(["新的内容"], ids=["菜品0-1"])
+    assert len(store) == 8
+    assert store.get(ids=["菜品0-1"])["documents"] == ["新的内容"]
+
+    assert store.delete(ids=["菜品0-0", "菜品1-3"]) is True
+    assert store.delete(ids=["不存在"]) is False
+    assert len(store) == 6
+    found = [doc.id for doc in store.similarity_search("菜品0-0", k=6)]
+    assert "菜品0-0" not in found and "菜品1-3" not in found
+    assert store.get(where={"batch": 1})["ids"] == ["菜品1-0", "菜品1-1", "菜品1-2"]
+
+
+def test_reload_switches_generation_atomically(store, tmp_path, embeddings):
+    add_batches(store, 1)
+    reader = NumpyVectorStore(store.persist_directory, embeddings, quantize=store.quantize)
+    assert len(reader) == 4
+
+    add_batches(store, 2, start=1)
+    store.delete(ids=["菜品0-0"])
+    # 读取方在 reload 之前一直使用自己的快照
+    assert len(reader) == 4
+    reader.reload()
+    assert len(reader) == len(store) == 11
+    assert reader.get(ids=["菜品0-0"])["ids"] == []
+
+    with open(os.path.join(store.persist_directory, NumpyVectorStore.CURRENT_FILE), encoding="utf-8") as f:
+        current = f.read().strip()
+    with open(os.path.join(store.persist_directory, "generations", f"{current}.json"), encoding="utf-8") as f:
+        manifest = json.load(f)
+    assert manifest["generation"] == reader._index.generation
+
+
+def test_compact_and_old_generations_are_collected(store):
+    add_batches(store, 5)
+    store.delete(ids=["菜品4-0"])
+    store.compact()
+    assert len(store._index.segments) == 1
+    assert not store._index.segments[0].deleted
+    assert len(store) == 19
+    generations = os.listdir(os.path.join(store.persist_directory, "generations"))
+    assert len([name for name in generations if name.endswith(".json")]) == NumpyVectorStore.KEEP_GENERATIONS
+
+
+def test_delete_everything(store):
+    add_batches(store, 2)
+    store.delete(ids=store.get()["ids"])
+    assert len(store) == 0
+    assert store.similarity_search("菜品0-0", k=2) == []
@@ -0,0 +1,52 @@
+import asyncio
+from typing import Any, AsyncIterator, Optional
+
+import pytest
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk
+
+from benchmarks.fake_models import FakeChatModel
+from model import factory
+from rag.rag_service import NutritionRAGService
+from utils.config_handler import rag_config
+
+
+class TruncatedStreamChatModel(FakeChatModel):
+    """流式输出在中途断开（只输出前 60%），非流式调用返回完整结果"""
+    streams: int = 0
+
+    async def _astream(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                       run_manager: Any = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        self.streams += 1
+        content = self._result(messages).generations[0].message.content
+        for chunk in self._chunks(content[:len(content) * 3 // 5]):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=chunk))
+
+
+@pytest.fixture
+def pipeline_config(isolated_config, fake_models, monkeypatch):
+    monkeypatch.setitem(rag_config, 'pipeline', {"enabled": True})
+    monkeypatch.setitem(rag_config, 'fused_text', {**(rag_config.get('fused_text') or {}), "enabled": False})
+
+
+def test_truncated_stream_fails_over_to_full_call(pipeline_config, monkeypatch):
+    model = TruncatedStreamChatModel(latency=0, dish_names=["宫保鸡丁", "清炒时蔬"])
+    monkeypatch.setitem(factory._models, "kcal", model)
+    service = NutritionRAGService()
+
+    estimated, prefetch = asyncio.run(service._aestimate(user_input="一份宫保鸡丁和清炒时蔬"))
+    assert [item["name"] for item in estimated["items"]] == ["宫保鸡丁", "清炒时蔬"]
+    assert estimated["items"][1]["weight_g"] == 150
+    # 流式阶段提前发起的检索保留下来
+    assert "宫保鸡丁" in prefetch
+    assert model.streams >= 1 and model.calls == model.streams + 1
+
+
+def test_complete_stream_is_used_directly(pipeline_config, fake_models):
+    fake_models["kcal"].dish_names = ["宫保鸡丁", "清炒时蔬"]
+    service = NutritionRAGService()
+    calls = fake_models["kcal"].calls
+    estimated, prefetch = asyncio.run(service._aestimate(user_input="一份宫保鸡丁和清炒时蔬"))
+    assert [item["name"] for item in estimated["items"]] == ["宫保鸡丁", "清炒时蔬"]
+    assert fake_models["kcal"].calls == calls + 1
+    assert set(prefetch) == {"宫保鸡丁", "清炒时蔬"}
@@ -0,0 +1,62 @@
+import asyncio
+import threading
+
+import pytest
+
+from rag.rag_service import NutritionRAGService
+from rag.result_cache import DiskResultCache
+from utils.config_handler import rag_config
+
+
+@pytest.fixture
+def service(isolated_config, fake_models, monkeypatch):
+    # 与 serve.py 的 enable_shared_caches 一致：开启 SQLite 磁盘层
+    monkeypatch.setitem(rag_config, 'result_cache', {
+        **(rag_config.get('result_cache') or {}), "enabled": True, "disk_enabled": True,
+        "disk_path": str(isolated_config / "results.sqlite"),
+    })
+    return NutritionRAGService()
+
+
+def record_threads(monkeypatch) -> list[tuple[str, int]]:
+    threads = []
+    for name in ("get", "set"):
+        method = getattr(DiskResultCache, name)
+
+        def record(self, *args, _method=method, _name=name):
+            threads.append((_name, threading.get_ident()))
+            return _method(self, *args)
+        monkeypatch.setattr(DiskResultCache, name, record)
+    return threads
+
+
+def test_async_analyze_reads_and_writes_disk_cache_off_event_loop(service, fake_models, monkeypatch):
+    threads = record_threads(monkeypatch)
+
+    async def run():
+        first = await service.analyze_async(user_input="一份米饭")
+        # 清空内存层，第二次请求只能从磁盘层命中
+        service.result_cache.backends[0].cache.clear()
+        second = await service.analyze_async(user_input="一份米饭")
+        return first, second, threading.get_ident()
+
+    first, second, loop_thread = asyncio.run(run())
+    assert second == first
+    assert [name for name, _ in threads] == ["get", "set", "get"]
+    assert all(ident != loop_thread for _, ident in threads)
+
+
+def test_batch_uses_disk_cache_off_event_loop(service, monkeypatch):
+    threads = record_threads(monkeypatch)
+
+    async def run():
+        requests = [{"text": "一份米饭"}, {"text": "一份宫保鸡丁"}]
+        first = await service.analyze_batch_async(requests)
+        service.result_cache.backends[0].cache.clear()
+        second = await service.analyze_batch_async(requests)
+        return first, second, threading.get_ident()
+
+    first, second, loop_thread = asyncio.run(run())
+    assert second == first
+    assert [name for name, _ in threads].count("set") == 2
+    assert all(ident != loop_thread for _, ident in threads)
@@ -0,0 +1,13 @@
+import serve
+from utils.config_handler import chroma_config, rag_config
+
+
+def test_shipped_config_allows_prefork():
+    assert serve.check_vector_backend(4, rag_config.get('serve') or {})
+
+
+def test_chroma_backend_refuses_prefork_unless_allowed(monkeypatch):
+    monkeypatch.setitem(chroma_config, 'backend', "chroma")
+    assert not serve.check_vector_backend(4, {"allow_chroma": False})
+    assert serve.check_vector_backend(4, {"allow_chroma": True})
+    assert serve.check_vector_backend(1, {"allow_chroma": False})
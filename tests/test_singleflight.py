@@ -0,0 +1,79 @@
+import asyncio
+import threading
+
+import pytest
+
+from utils.singleflight import AsyncSingleFlight, SingleFlight
+
+
+def test_concurrent_callers_share_the_leader_error():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    errors = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        raise ValueError("upstream failed")
+
+    def caller():
+        try:
+            flight.do("key", compute)
+        except ValueError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=caller)
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=caller) for _ in range(3)]
+    for follower in followers:
+        follower.start()
+    while flight.shared < 3:
+        threading.Event().wait(0.01)
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert len(errors) == 4
+    assert all(error is errors[0] for error in errors)
+    # 失败的调用不会留在表中，下一次调用重新计算
+    assert flight.do("key", lambda: "ok") == "ok"
+
+
+def test_do_many_propagates_batch_error_to_every_owned_key():
+    flight = SingleFlight()
+
+    def compute(keys):
+        raise RuntimeError(",".join(keys))
+
+    with pytest.raises(RuntimeError, match="a,b"):
+        flight.do_many(["a", "b", "a"], compute)
+    assert flight.do_many(["a"], lambda keys: {"a": 1}) == {"a": 1}
+
+
+def test_async_followers_receive_error_and_cancelling_one_does_not_cancel_others():
+    async def main():
+        flight = AsyncSingleFlight()
+        calls = 0
+
+        async def compute():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.05)
+            raise ValueError("boom")
+
+        tasks = [asyncio.ensure_future(flight.do("key", compute)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        tasks[0].cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        return calls, results, flight.shared
+
+    calls, results, shared = asyncio.run(main())
+    assert calls == 1
+    assert shared == 2
+    assert isinstance(results[0], asyncio.CancelledError)
+    assert all(isinstance(result, ValueError) for result in results[1:])
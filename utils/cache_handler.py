@@ -0,0 +1,186 @@
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Optional
+
+from utils.path_tool import get_abs_path
+
+
+"""
+通用缓存：进程内 LRU（可选 TTL）+ SQLite 磁盘存储
+SQLite 存储可以在多个进程间共享（多进程部署时作为各 worker 共用的缓存层），fork 后子进程自动重新连接
+"""
+class LRUCache(object):
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            created_at, value = entry
+            if self.ttl is not None and time.time() - created_at > self.ttl:
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: Any):
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+class SQLiteStore(object):
+    """
+    以 SQLite 为后端的 key -> bytes 存储，重启后仍然有效
+    超过 max_entries 时按最近访问时间淘汰，ttl 为 None 表示不过期
+    """
+    # 每写入多少次检查一次容量，避免每次写入都 COUNT(*)
+    EVICT_CHECK_INTERVAL = 128
+
+    def __init__(self, path: str, max_entries: int = 100000, ttl: Optional[float] = None):
+        self.path = get_abs_path(path)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._conn = self._connect()
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache(accessed_at)")
+        self._conn.commit()
+        _stores.add(self)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        # WAL 模式允许多个进程同时读、单个进程写
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _reopen_after_fork(self):
+        # SQLite 连接不能在 fork 出的子进程中继续使用；父进程的连接也不能在子进程中关闭
+        # （关闭时可能做 checkpoint、删除父进程仍在使用的 WAL 文件），保留引用不做任何操作
+        _inherited_connections.append(self._conn)
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: list[str]) -> dict[str, bytes]:
+        if not keys:
+            return {}
+        now = time.time()
+        found = {}
+        with self._lock:
+            # SQLite 单条语句的参数个数有上限，分段查询
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, value, created_at FROM cache WHERE key IN ({','.join('?' * len(part))})",
+                    part,
+                ).fetchall()
+                for key, value, created_at in rows:
+                    if self.ttl is not None and now - created_at > self.ttl:
+                        continue
+                    found[key] = value
+            if found:
+                self._conn.executemany(
+                    "UPDATE cache SET accessed_at=? WHERE key=?",
+                    [(now, key) for key in found],
+                )
+                self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set(self, key: str, value: bytes):
+        self.set_many({key: value})
+
+    def set_many(self, items: dict[str, bytes]):
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO cache(key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                [(key, value, now, now) for key, value in items.items()],
+            )
+            self._writes += len(items)
+            if self._writes >= self.EVICT_CHECK_INTERVAL:
+                self._writes = 0
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        if self.ttl is not None:
+            self._conn.execute("DELETE FROM cache WHERE created_at < ?", (time.time() - self.ttl,))
+        count = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+# 当前进程中的全部 SQLiteStore；fork 出的子进程中逐个重新连接
+_stores: "weakref.WeakSet[SQLiteStore]" = weakref.WeakSet()
+_inherited_connections: list[sqlite3.Connection] = []
+
+
+def _reopen_stores_after_fork():
+    for store in list(_stores):
+        store._reopen_after_fork()
+
+
+os.register_at_fork(after_in_child=_reopen_stores_after_fork)
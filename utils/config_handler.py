@@ -1,5 +1,9 @@
+import threading
+from collections.abc import MutableMapping
+
 import yaml
 from utils.path_tool import get_abs_path
+from utils.timing_handler import startup_timer
 
 
 """
@@ -26,6 +30,78 @@ def log_chroma_config(
     with open(config_path,"r",encoding=encoding) as f:
         return yaml.load(f, Loader=yaml.FullLoader)
 
-rag_config=log_rag_config()
-prompts_config=log_prompts_config()
-chroma_config=log_chroma_config()
+def log_nutrition_config(
+        config_path=get_abs_path("config/nutrition.yml"),
+        encoding="utf-8",
+):
+    with open(config_path,"r",encoding=encoding) as f:
+        return yaml.load(f, Loader=yaml.FullLoader)
+
+def log_logging_config(
+        config_path=get_abs_path("config/logging.yml"),
+        encoding="utf-8",
+):
+    with open(config_path,"r",encoding=encoding) as f:
+        return yaml.load(f, Loader=yaml.FullLoader)
+
+
+_LOADERS={
+    "rag_config":log_rag_config,
+    "prompts_config":log_prompts_config,
+    "chroma_config":log_chroma_config,
+    "nutrition_config":log_nutrition_config,
+    "logging_config":log_logging_config,
+}
+
+
+_configs:dict[str,dict]={}
+_configs_lock=threading.Lock()
+
+
+def get_config(name:str)->dict:
+    """首次使用时才解析对应的 yml，之后返回同一个 dict（运行时修改对所有使用方可见）"""
+    config=_configs.get(name)
+    if config is None:
+        with _configs_lock:
+            config=_configs.get(name)
+            if config is None:
+                with startup_timer.span(f"config:{name}"):
+                    config=_configs[name]=_LOADERS[name]()
+    return config
+
+
+class LazyConfig(MutableMapping):
+    """
+    配置的延迟代理：导入本模块以及 from utils.config_handler import rag_config 都不会解析 yml，
+    第一次读取键时才加载，之后所有读写都转发到 get_config 返回的同一个 dict
+    """
+    def __init__(self,name:str):
+        self._name=name
+
+    def _data(self)->dict:
+        return get_config(self._name)
+
+    def __getitem__(self,key):
+        return self._data()[key]
+
+    def __setitem__(self,key,value):
+        self._data()[key]=value
+
+    def __delitem__(self,key):
+        del self._data()[key]
+
+    def __iter__(self):
+        return iter(self._data())
+
+    def __len__(self):
+        return len(self._data())
+
+    def __repr__(self):
+        return f"LazyConfig({self._name!r})"
+
+
+rag_config=LazyConfig("rag_config")
+prompts_config=LazyConfig("prompts_config")
+chroma_config=LazyConfig("chroma_config")
+nutrition_config=LazyConfig("nutrition_config")
+logging_config=LazyConfig("logging_config")
@@ -0,0 +1,112 @@
+import base64
+import binascii
+import hashlib
+import io
+from typing import Optional
+
+from utils.logger_handler import logger
+
+
+"""
+图片上传处理：限制大小的分块读取（同时计算内容哈希）、可选的缩放/重新压缩、data URL 编解码
+缩放依赖 Pillow，未安装时原样返回图片
+"""
+READ_CHUNK_SIZE = 256 * 1024
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+    logger.info("[图片处理]未安装 Pillow，上传图片不做缩放")
+
+
+class ImageTooLargeError(ValueError):
+    def __init__(self, max_bytes: int):
+        super().__init__(f"图片大小超过 {max_bytes // (1024 * 1024)}MB 限制")
+        self.max_bytes = max_bytes
+
+
+class ImageDecodeError(ValueError):
+    pass
+
+
+async def read_upload(upload, max_bytes: int) -> tuple[bytes, str]:
+    """
+    分块读取 UploadFile，超过 max_bytes 立即停止并抛出 ImageTooLargeError
+    返回 (图片字节, sha256)，哈希在读取过程中增量计算，不需要再遍历一次
+    """
+    digest = hashlib.sha256()
+    buffer = bytearray()
+    while True:
+        chunk = await upload.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        if len(buffer) + len(chunk) > max_bytes:
+            raise ImageTooLargeError(max_bytes)
+        digest.update(chunk)
+        buffer += chunk
+    return bytes(buffer), digest.hexdigest()
+
+
+def decode_data_url(data_url: str, max_bytes: int) -> tuple[bytes, str]:
+    """data:<mime>;base64,<payload> -> (图片字节, mime)，按 base64 长度先估算大小，超限时不解码"""
+    header, _, payload = data_url.partition(";base64,")
+    mime = header[len("data:"):] or "image/jpeg"
+    if len(payload) * 3 // 4 > max_bytes:
+        raise ImageTooLargeError(max_bytes)
+    try:
+        return base64.b64decode(payload, validate=False), mime
+    except (binascii.Error, ValueError):
+        raise ImageDecodeError("图片 data URL 不是合法的 base64")
+
+
+def to_data_url(data: bytes, mime: str) -> str:
+    return f"data:{mime};base64,{base64.b64encode(data).decode('ascii')}"
+
+
+def downscale(data: bytes, mime: str, max_side: int, quality: int = 85, min_bytes: int = 0) -> tuple[bytes, str]:
+    """
+    长边超过 max_side 时等比缩放并重新压缩为 JPEG（有透明通道的保存为 PNG）
+    小于 min_bytes 且尺寸未超限的图片原样返回；未安装 Pillow 或无法解析时也原样返回
+    """
+    if Image is None or not max_side:
+        return data, mime
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            width, height = image.size
+            if max(width, height) <= max_side and len(data) < min_bytes:
+                return data, mime
+            # JPEG 在解码阶段直接按 1/2、1/4、1/8 缩小，大幅减少解码大图的耗时和内存
+            image.draft("RGB", (max_side, max_side))
+            # 重新编码不会保留 EXIF，先按方向标记旋转像素，否则手机竖拍的照片会变成横向
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((max_side, max_side))
+            output = io.BytesIO()
+            has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+            if has_alpha:
+                image.save(output, format="PNG", optimize=True)
+                new_mime = "image/png"
+            else:
+                image.convert("RGB").save(output, format="JPEG", quality=quality, optimize=True)
+                new_mime = "image/jpeg"
+    except Exception as e:
+        logger.warning("[图片处理]缩放失败，使用原图：%s", type(e).__name__)
+        return data, mime
+    resized = output.getvalue()
+    # 重新压缩后反而更大（已是小尺寸高压缩率的图片）时保留原图
+    if len(resized) >= len(data):
+        return data, mime
+    return resized, new_mime
+
+
+def prepare_image(data: bytes, mime: str, image_config: Optional[dict]) -> str:
+    """按 config/rag.yml 中 image.downscale 处理后编码为 data URL"""
+    downscale_config = (image_config or {}).get('downscale') or {}
+    if downscale_config.get('enabled', False):
+        data, mime = downscale(
+            data, mime,
+            max_side=downscale_config.get('max_side', 1280),
+            quality=downscale_config.get('jpeg_quality', 85),
+            min_bytes=downscale_config.get('min_bytes', 0),
+        )
+    return to_data_url(data, mime)
@@ -33,9 +33,21 @@ def load_estimation_prompts():
     path = prompts_config.get('estimation_prompt_path', 'prompts/estimation.txt')
     return _load_file_content(path)
 
+def load_advice_prompts():
+    """加载本地计算路径下的建议生成Prompt"""
+    path = prompts_config.get('advice_prompt_path', 'prompts/advice.txt')
+    return _load_file_content(path)
+
+def load_fused_prompts():
+    """加载文本融合模式（识别 + 热量计算一次完成）的Prompt"""
+    path = prompts_config.get('fused_prompt_path', 'prompts/fused.txt')
+    return _load_file_content(path)
+
 
 if __name__ == '__main__':
     # 测试加载
     print("Version Prompt:", len(load_version_prompts()))
     print("Kcal Prompt:", len(load_kcal_prompts()))
     print("Estimation Prompt:", len(load_estimation_prompts()))
+    print("Advice Prompt:", len(load_advice_prompts()))
+    print("Fused Prompt:", len(load_fused_prompts()))
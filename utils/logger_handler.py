@@ -1,54 +1,327 @@
+import atexit
+import contextvars
+import copy
+import json
 import logging
 import os
+import queue
+import re
+import threading
+import uuid
+import zlib
 from datetime import datetime
+from logging.handlers import QueueHandler, RotatingFileHandler, TimedRotatingFileHandler
+from typing import Optional
+
+from utils.config_handler import logging_config
+from utils.metrics_handler import LOG_RECORDS_DROPPED
 from utils.path_tool import get_abs_path
 
 LOG_ROOT=get_abs_path("logs")
 
-
-os.makedirs(LOG_ROOT,exist_ok=True)
-
 DEFAULT_LOG_FORMAT=logging.Formatter(
     '%(asctime)s - %(name)s - %(levelname)s -%(filename)s:%(lineno)d- %(message)s'
 )
 
+#data URL 以及连续的长 base64 串（图片内容）不写入日志
+_DATA_URL_PATTERN=re.compile(r"data:[\w.+/-]*;base64,[A-Za-z0-9+/=]*")
+_BASE64_PATTERN=re.compile(r"[A-Za-z0-9+/]{200,}={0,2}")
+
+#当前请求的 ID，由 app 的中间件设置；asyncio 任务、run_in_executor 的线程都会带上同一个 ID
+_request_id:contextvars.ContextVar[Optional[str]]=contextvars.ContextVar("request_id",default=None)
+
+#LogRecord 自带的属性，JSON 中其余属性（logger.info(..., extra={...}) 传入的）作为附加字段输出
+_RECORD_ATTRIBUTES=set(vars(logging.LogRecord("",0,"",0,"",None,None)))|{"message","asctime","request_id"}
+
+
+def new_request_id()->str:
+    return uuid.uuid4().hex
+
+
+def set_request_id(request_id:Optional[str])->contextvars.Token:
+    return _request_id.set(request_id)
+
+
+def reset_request_id(token:contextvars.Token):
+    _request_id.reset(token)
+
+
+def current_request_id()->Optional[str]:
+    return _request_id.get()
+
+
+def redact_base64(text:str)->str:
+    text=_DATA_URL_PATTERN.sub(lambda match:f"<data-url {len(match.group(0))} chars>",text)
+    return _BASE64_PATTERN.sub(lambda match:f"<base64 {len(match.group(0))} chars>",text)
+
+
+class RedactBase64Filter(logging.Filter):
+    """替换日志消息和异常信息中的 base64 图片内容，避免大段图片数据写入日志"""
+    def filter(self,record:logging.LogRecord)->bool:
+        message=record.getMessage()
+        redacted=redact_base64(message)
+        if redacted!=message:
+            record.msg=redacted
+            record.args=None
+        if record.exc_info and not record.exc_text:
+            record.exc_text=logging.Formatter().formatException(record.exc_info)
+        if record.exc_text:
+            record.exc_text=redact_base64(record.exc_text)
+        return True
+
+
+class RequestContextFilter(logging.Filter):
+    """在调用方线程上记下当前请求 ID（放入队列后再读取 contextvar 就拿不到了）"""
+    def filter(self,record:logging.LogRecord)->bool:
+        record.request_id=_request_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    按比例保留 INFO 及以下的日志，WARNING 及以上始终保留
+    有请求 ID 时按 ID 的哈希决定，同一请求的日志要么全部保留要么全部丢弃，便于完整地追踪一个请求
+    """
+    def __init__(self,rate:float):
+        super().__init__()
+        self.threshold=int(max(0.0,min(1.0,rate))*10000)
+
+    def filter(self,record:logging.LogRecord)->bool:
+        if record.levelno>=logging.WARNING or self.threshold>=10000:
+            return True
+        request_id=getattr(record,'request_id',None)
+        key=request_id if request_id else f"{record.created}:{record.lineno}"
+        if zlib.crc32(key.encode("utf-8"))%10000<self.threshold:
+            return True
+        LOG_RECORDS_DROPPED.inc(reason="sampled")
+        return False
+
+
+class JsonFormatter(logging.Formatter):
+    """每条记录输出一行 JSON：时间、级别、位置、request_id、消息，以及 extra 传入的字段（如 stage_timings）"""
+    def format(self,record:logging.LogRecord)->str:
+        payload={
+            "time":datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level":record.levelname,
+            "logger":record.name,
+            "location":f"{record.filename}:{record.lineno}",
+            "request_id":getattr(record,'request_id',None),
+            "message":record.getMessage(),
+        }
+        for key,value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                payload[key]=value
+        if record.exc_info and not record.exc_text:
+            record.exc_text=self.formatException(record.exc_info)
+        if record.exc_text:
+            payload["exception"]=record.exc_text
+        return json.dumps(payload,ensure_ascii=False,default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    业务线程只做消息格式化和入队，脱敏、序列化、写磁盘都由 LogListener 的后台线程完成
+    队列满时丢弃记录并计数，不阻塞请求
+    """
+    def prepare(self,record:logging.LogRecord)->logging.LogRecord:
+        #参数在这里合并进消息：入队后调用方可能修改参数对象；异常栈转成文本，后台线程不再持有 traceback
+        record=copy.copy(record)
+        record.msg=record.getMessage()
+        record.args=None
+        if record.exc_info:
+            record.exc_text=record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info=None
+        return record
+
+    def enqueue(self,record:logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc(reason="queue_full")
+
+
+class LogListener(object):
+    """
+    写日志的后台线程：从队列取出记录，按各 Handler 的级别交给控制台和文件 Handler
+    线程和结束标记由这里自己管理，stop() 在队列满时阻塞等待，结束标记一定能放进队列
+    """
+    _STOP=object()
+
+    def __init__(self,log_queue:queue.Queue,*handlers:logging.Handler):
+        self.queue=log_queue
+        self.handlers=handlers
+        self._thread:Optional[threading.Thread]=None
+
+    def start(self):
+        if self._thread is None:
+            self._thread=threading.Thread(target=self._run,name="log-listener",daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            record=self.queue.get()
+            if record is self._STOP:
+                return
+            for handler in self.handlers:
+                if record.levelno>=handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """写完队列中已有的日志后停止线程"""
+        if self._thread is None:
+            return
+        self.queue.put(self._STOP)
+        self._thread.join()
+        self._thread=None
+
+
+class _DeferredSetupHandler(logging.Handler):
+    """
+    导入模块时挂在日志器上的占位 Handler：第一条日志到达时才读取 logging.yml、创建日志文件并启动后台线程，
+    只导入模块的进程（脚本、测试、未被调用的代码路径）不付出这些开销
+    """
+    def __init__(self,name:str):
+        super().__init__()
+        self.logger_name=name
+
+    def handle(self,record:logging.LogRecord)->bool:
+        configured=get_logger(self.logger_name)
+        for handler in configured.handlers:
+            if record.levelno>=handler.level:
+                handler.handle(record)
+        return True
+
+    def emit(self,record:logging.LogRecord):
+        self.handle(record)
+
+
+#(日志器上的队列 Handler, 后台线程, 文件日志路径)
+_listeners:list[tuple[NonBlockingQueueHandler,LogListener,str]]=[]
+_setup_lock=threading.Lock()
+
+
+def _file_handler(log_file:str,config:dict)->logging.Handler:
+    #delay: 第一条日志写入时才创建文件，只导入模块的进程（脚本、测试）不会留下空日志文件
+    rotation=config.get('rotation') or {}
+    backup_count=rotation.get('backup_count',10)
+    if rotation.get('by','size')=="time":
+        return TimedRotatingFileHandler(log_file,when=rotation.get('when','midnight'),backupCount=backup_count,
+                                        encoding="utf-8",delay=True)
+    return RotatingFileHandler(log_file,maxBytes=int(rotation.get('max_mb',100)*1024*1024),backupCount=backup_count,
+                               encoding="utf-8",delay=True)
+
+
 def get_logger(
         name:str="agent",
         console_level:int=logging.INFO,
         file_level:int=logging.DEBUG,
         log_file=None,
 )-> logging.Logger:
+    with _setup_lock:
+        return _setup_logger(name,console_level,file_level,log_file)
+
+
+def _setup_logger(name:str,console_level:int,file_level:int,log_file)->logging.Logger:
     logger=logging.getLogger(name)
     logger.setLevel(logging.DEBUG)
 
+    for handler in [handler for handler in logger.handlers if isinstance(handler,_DeferredSetupHandler)]:
+        logger.removeHandler(handler)
     if logger.handlers:
         return logger
+    config=dict(logging_config)
     #控制台
     console_handler = logging.StreamHandler()
     console_handler.setLevel(console_level)
     console_handler.setFormatter(DEFAULT_LOG_FORMAT)
-
-    logger.addHandler(console_handler)
+    console_handler.addFilter(RedactBase64Filter())
 
 
     #文件Handler
     if not log_file:
+        os.makedirs(LOG_ROOT,exist_ok=True)
         log_file=os.path.join(LOG_ROOT,f"{name}_{datetime.now().strftime('%Y%m%d-%H%M%S')}.log")
 
-    file_handler=logging.FileHandler(log_file,encoding="utf-8")
+    file_handler=_file_handler(log_file,config)
     file_handler.setLevel(file_level)
-    file_handler.setFormatter(DEFAULT_LOG_FORMAT)
+    file_handler.setFormatter(JsonFormatter() if config.get('file_format','json')=="json" else DEFAULT_LOG_FORMAT)
+    file_handler.addFilter(RedactBase64Filter())
+
+    #日志器上只挂队列 Handler，控制台和文件 Handler 由后台线程驱动
+    log_queue=queue.Queue(maxsize=config.get('queue_size',10000))
+    queue_handler=NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter())
+    queue_handler.addFilter(SamplingFilter((config.get('sampling') or {}).get('info_rate',1.0)))
+    logger.addHandler(queue_handler)
 
-    logger.addHandler(file_handler)
+    listener=LogListener(log_queue,console_handler,file_handler)
+    listener.start()
+    _listeners.append((queue_handler,listener,log_file))
 
     return logger
 
 
+@atexit.register
+def stop_logging():
+    """写完队列中剩余的日志并停止后台线程（进程退出时自动调用）"""
+    while _listeners:
+        _listeners.pop()[1].stop()
+
+
+def _pause_logging_before_fork():
+    """
+    fork 前写完队列中的日志并停止后台线程：后台线程正在写文件/控制台时 fork，子进程继承的流缓冲区锁
+    处于持有状态，子进程再写日志会永久阻塞
+    """
+    for _,listener,_ in _listeners:
+        listener.stop()
+
+
+def _resume_logging_in_parent():
+    for _,listener,_ in _listeners:
+        listener.start()
+
+
+def _restart_logging_in_child():
+    """
+    fork 出的子进程（多进程部署的 worker 等）：换一个新队列并重新启动 LogListener；
+    文件日志改写到带进程号的文件，避免多个进程同时轮转同一个文件
+    """
+    for queue_handler,listener,log_file in _listeners:
+        log_queue=queue.Queue(maxsize=queue_handler.queue.maxsize)
+        queue_handler.queue=log_queue
+        listener.queue=log_queue
+        for handler in listener.handlers:
+            if isinstance(handler,logging.FileHandler):
+                root,ext=os.path.splitext(os.path.abspath(log_file))
+                handler.baseFilename=f"{root}-{os.getpid()}{ext}"
+                if handler.stream is not None:
+                    handler.stream.close()
+                    handler.stream=None
+        listener.start()
+
+
+os.register_at_fork(
+    before=_pause_logging_before_fork,
+    after_in_parent=_resume_logging_in_parent,
+    after_in_child=_restart_logging_in_child,
+)
+
+
+def deferred_logger(name:str="agent")->logging.Logger:
+    """返回日志器，但 Handler 等到第一条日志时才创建（见 _DeferredSetupHandler）"""
+    logger=logging.getLogger(name)
+    if not logger.handlers:
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(_DeferredSetupHandler(name))
+    return logger
+
+
 #快捷获取日志器
-logger=get_logger()
+logger=deferred_logger()
 
 if __name__ == '__main__':
     logger.info("信息日志")
     logger.error("错误日志")
     logger.warning("警告日志")
-    logger.debug("调试日志")
\ No newline at end of file
+    logger.debug("调试日志")
@@ -0,0 +1,345 @@
+import asyncio
+import contextvars
+import glob
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterable, Optional
+
+
+"""
+Prometheus 文本格式的计数器 / 直方图，以及按请求汇总的阶段耗时
+不依赖 prometheus_client，/metrics 输出 render_metrics() 的结果：
+单进程时为本进程的 registry，多进程部署（serve.py）时为所有 worker 指标快照的汇总
+"""
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: Optional[tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric(object):
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} 需要标签 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def _empty(self) -> "_Metric":
+        return type(self)(self.name, self.documentation, self.labelnames)
+
+    def snapshot(self) -> list:
+        """可 JSON 序列化的 [[标签值...], 值...] 列表，用于跨进程汇总"""
+        raise NotImplementedError
+
+    def merge(self, snapshot: list):
+        raise NotImplementedError
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._label_values(labels), 0.0)
+
+    def snapshot(self) -> list:
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def merge(self, snapshot: list):
+        with self._lock:
+            for key, value in snapshot:
+                key = tuple(key)
+                self._values[key] = self._values.get(key, 0.0) + value
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in sorted(values.items())
+        ]
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # 标签值 -> [各桶计数(非累计), 总和, 总数]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._label_values(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def _empty(self) -> "Histogram":
+        return Histogram(self.name, self.documentation, self.labelnames, self.buckets[:-1])
+
+    def snapshot(self) -> list:
+        with self._lock:
+            return [[list(key), list(entry[0]), entry[1], entry[2]] for key, entry in self._values.items()]
+
+    def merge(self, snapshot: list):
+        with self._lock:
+            for key, counts, total, count in snapshot:
+                # 桶边界不一致（不同版本的代码）的快照无法相加，跳过
+                if len(counts) != len(self.buckets):
+                    continue
+                entry = self._values.setdefault(tuple(key), [[0] * len(self.buckets), 0.0, 0])
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += total
+                entry[2] += count
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = {key: (list(entry[0]), entry[1], entry[2]) for key, entry in self._values.items()}
+        lines = []
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, ("le", _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+    def snapshot(self) -> dict[str, list]:
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def reset(self):
+        for metric in self._metrics.values():
+            metric.reset()
+
+    def render_merged(self, snapshots: Iterable[dict[str, list]]) -> str:
+        """把多个进程的快照按指标名、标签值相加后输出，计数器与直方图都可以直接求和"""
+        merged = {name: metric._empty() for name, metric in self._metrics.items()}
+        for snapshot in snapshots:
+            for name, samples in snapshot.items():
+                if name in merged:
+                    merged[name].merge(samples)
+        return "\n".join(metric.render() for metric in merged.values()) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+class SharedMetrics(object):
+    """
+    多进程部署时的指标汇总：每个 worker 每隔 interval 秒把本进程的指标快照写到共享目录下的 <pid>.json，
+    /metrics 落在任一 worker 上都读取目录中的全部快照求和后输出
+    已退出 worker 的快照保留在目录中，worker 被替换后计数器不会回退；主进程启动时清空目录
+    """
+
+    def __init__(self, directory: str, interval: float = 5.0):
+        self.directory = directory
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def clear(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for path in glob.glob(os.path.join(self.directory, "*.json*")):
+            os.remove(path)
+
+    def write(self):
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        # 后台线程与 /metrics 可能同时写，各自使用独立的临时文件
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(registry.snapshot(), f, ensure_ascii=False)
+        # 先写临时文件再替换，读取方不会读到写了一半的快照
+        os.replace(tmp_path, path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError:
+                pass
+
+    def start(self):
+        """
+        在 worker 进程中调用（fork 之后），启动定期写快照的后台线程
+        fork 继承的主进程计数由主进程自己的快照计入，worker 从零开始计数，避免汇总时重复计算
+        """
+        registry.reset()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="metrics-snapshot", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """worker 退出前写最后一次快照，保留退出前的计数"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.write()
+
+    def render(self) -> str:
+        # 先写入本进程的最新快照，保证本 worker 的计数是实时的
+        self.write()
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return registry.render_merged(snapshots)
+
+
+shared_metrics: Optional[SharedMetrics] = None
+
+
+def enable_shared_metrics(directory: str, interval: float = 5.0) -> SharedMetrics:
+    global shared_metrics
+    shared_metrics = SharedMetrics(directory, interval)
+    return shared_metrics
+
+
+def render_metrics() -> str:
+    return shared_metrics.render() if shared_metrics is not None else registry.render()
+
+STAGE_SECONDS = registry.register(Histogram(
+    "nutrition_stage_seconds", "各处理阶段耗时（秒）", ("stage", "status"),
+))
+ANALYZE_SECONDS = registry.register(Histogram(
+    "nutrition_analyze_seconds", "单次分析的端到端耗时（秒）", ("mode", "cache", "calc_path"),
+))
+ERRORS = registry.register(Counter(
+    "nutrition_errors_total", "按阶段和错误类型统计的失败次数", ("stage", "error_type"),
+))
+CACHE_LOOKUPS = registry.register(Counter(
+    "nutrition_cache_lookups_total", "缓存查询次数", ("cache", "result"),
+))
+RETRIEVAL_QUERIES = registry.register(Counter(
+    "nutrition_retrieval_queries_total", "按来源统计的菜品检索次数", ("source",),
+))
+MODEL_TOKENS = registry.register(Counter(
+    "nutrition_model_tokens_total", "模型调用消耗的 token 数", ("model", "kind"),
+))
+HTTP_REQUEST_SECONDS = registry.register(Histogram(
+    "nutrition_http_request_seconds", "HTTP 请求耗时（秒）", ("path", "method", "status"),
+))
+MODEL_GUARD_EVENTS = registry.register(Counter(
+    "nutrition_model_guard_events_total",
+    "模型调用保护事件：rejected/timeout/retry/hedge/hedge_won/circuit_open/short_circuit/fallback", ("model", "event"),
+))
+LOG_RECORDS_DROPPED = registry.register(Counter(
+    "nutrition_log_records_dropped_total", "被采样丢弃或因日志队列已满丢弃的日志条数", ("reason",),
+))
+
+
+#当前请求的阶段耗时 {stage: 秒}；asyncio 任务创建时复制上下文，提前发起的检索任务也记在同一个请求上
+_request_timings: contextvars.ContextVar[Optional[dict[str, float]]] = contextvars.ContextVar(
+    "request_timings", default=None)
+
+
+def start_request_timings() -> contextvars.Token:
+    return _request_timings.set({})
+
+
+def reset_request_timings(token: contextvars.Token):
+    _request_timings.reset(token)
+
+
+def current_timings() -> Optional[dict[str, float]]:
+    return _request_timings.get()
+
+
+@contextmanager
+def stage(name: str):
+    """记录一个阶段的耗时和失败类型，同步、异步代码中都可以使用"""
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except (asyncio.CancelledError, GeneratorExit):
+        #流水线中提前发起的检索被取消、客户端提前断开流式响应都属于正常情况，不计为错误
+        status = "cancelled"
+        raise
+    except BaseException as e:
+        status = "error"
+        ERRORS.inc(stage=name, error_type=type(e).__name__)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=name, status=status)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+
+def server_timing_header(timings: dict[str, float]) -> str:
+    """Server-Timing 头：stage;dur=毫秒，浏览器开发者工具可以直接展示"""
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
@@ -0,0 +1,149 @@
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Hashable, Iterable
+
+
+"""
+单飞合并：同一个 key 同时只执行一次计算，并发到达的调用方共享同一个结果（或同一个异常）
+"""
+class SingleFlight(object):
+    """线程版本，供同步的 analyze / retrieve_context 使用"""
+
+    class _Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, "SingleFlight._Call"] = {}
+        self.shared = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.shared += 1
+                leader = False
+            else:
+                call = self._Call()
+                self._calls[key] = call
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result
+
+    def do_many(self, keys: Iterable[Hashable], fn: Callable[[list], dict]) -> dict:
+        """
+        批量版本：已在途的 key 直接等待其结果，其余 key 一起交给 fn 计算
+        fn 接收 key 列表并返回 {key: 结果}，缺失的 key 结果为 None
+        """
+        waiting = {}
+        owned = {}
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                call = self._calls.get(key)
+                if call is not None:
+                    self.shared += 1
+                    waiting[key] = call
+                else:
+                    call = self._Call()
+                    self._calls[key] = call
+                    owned[key] = call
+
+        results = {}
+        if owned:
+            try:
+                computed = fn(list(owned))
+                for key, call in owned.items():
+                    call.result = computed.get(key)
+                    results[key] = call.result
+            except BaseException as e:
+                for call in owned.values():
+                    call.error = e
+                raise
+            finally:
+                with self._lock:
+                    for key in owned:
+                        self._calls.pop(key, None)
+                for call in owned.values():
+                    call.done.set()
+
+        for key, call in waiting.items():
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            results[key] = call.result
+        return results
+
+
+class AsyncSingleFlight(object):
+    """协程版本，在同一个事件循环内合并相同 key 的在途调用"""
+
+    def __init__(self):
+        self._futures: dict[Hashable, asyncio.Future] = {}
+        self.shared = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        future = self._futures.get(key)
+        if future is not None:
+            self.shared += 1
+            # shield: 某个等待方被取消时不影响其他调用方和正在进行的计算
+            return await asyncio.shield(future)
+
+        future = asyncio.ensure_future(fn())
+        self._register(key, future)
+        return await asyncio.shield(future)
+
+    async def do_many(self, keys: Iterable[Hashable], fn: Callable[[list], Awaitable[dict]]) -> dict:
+        """批量版本，语义同 SingleFlight.do_many"""
+        futures = {}
+        owned = []
+        for key in dict.fromkeys(keys):
+            future = self._futures.get(key)
+            if future is not None:
+                self.shared += 1
+                futures[key] = future
+            else:
+                owned.append(key)
+
+        if owned:
+            batch = asyncio.ensure_future(fn(owned))
+
+            async def pick(key):
+                return (await batch).get(key)
+
+            for key in owned:
+                futures[key] = asyncio.ensure_future(pick(key))
+                self._register(key, futures[key])
+
+        keys_in_order = list(futures)
+        results = await asyncio.gather(*(asyncio.shield(futures[key]) for key in keys_in_order))
+        return dict(zip(keys_in_order, results))
+
+    def _register(self, key: Hashable, future: asyncio.Future):
+        self._futures[key] = future
+
+        def on_done(done: asyncio.Future):
+            if self._futures.get(key) is done:
+                del self._futures[key]
+            # 标记异常已被读取，避免所有等待方都被取消时事件循环打印告警
+            if not done.cancelled():
+                done.exception()
+
+        future.add_done_callback(on_done)
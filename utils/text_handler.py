@@ -0,0 +1,8 @@
+import re
+import unicodedata
+
+
+def normalize_text(text: str) -> str:
+    """全角转半角、去首尾空白、合并连续空白并转小写，用于缓存键和菜品名匹配"""
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", " ", text).strip().lower()
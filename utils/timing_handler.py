@@ -0,0 +1,38 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+"""
+启动耗时统计：记录各组件（模块导入、配置、模型客户端、向量库、索引、预热）第一次初始化的耗时
+"""
+class StartupTimer(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._created_at = time.perf_counter()
+        self._components: dict[str, float] = {}
+
+    def record(self, component: str, seconds: float):
+        with self._lock:
+            # 同一组件多次记录时累加（例如多次预热）
+            self._components[component] = self._components.get(component, 0.0) + seconds
+
+    @contextmanager
+    def span(self, component: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(component, time.perf_counter() - start)
+
+    def report(self) -> dict:
+        with self._lock:
+            components = dict(self._components)
+        return {
+            # 组件之间可能嵌套（import:app 包含 import:rag_service），不做求和
+            "components": {name: round(seconds, 4) for name, seconds in components.items()},
+            "uptime_seconds": round(time.perf_counter() - self._created_at, 4),
+        }
+
+
+startup_timer = StartupTimer()